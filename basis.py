@@ -0,0 +1,141 @@
+#basis.py
+
+"""
+Low-dimensional stimulus bases
+
+A BasisBank holds K fixed images (Gaussian blobs, Gabor patches or a PCA
+basis learned from the composites in organised_by_imagery) plus a mean
+image. A stimulus is then a K-vector of coefficients: rendering a whole
+batch is one matrix multiply, and any image can be projected back onto the
+basis with a precomputed pseudo-inverse, so filtered selections can be
+turned into coefficient parents again.
+"""
+
+import glob
+import os
+from functools import lru_cache
+
+import numpy as np
+
+BASIS_TYPES = ('gaussian', 'gabor', 'pca')
+PCA_IMAGE_DIR = 'organised_by_imagery'
+
+# Standard deviation of uniform 0-255 noise, the contrast random coefficients are scaled to
+UNIFORM_STD = 255 / np.sqrt(12)
+
+class BasisBank:
+    """Render coefficient vectors to images and project images onto coefficients"""
+
+    def __init__(self, name, components, mean=None, stim_size=16):
+        """components: (K, stim_size * stim_size); mean: flat image added to every rendering (default mid-grey)"""
+        self.name = name
+        self.stim_size = stim_size
+        self.components = np.asarray(components, dtype=np.float32)
+        self.n_components = len(self.components)
+        if mean is None:
+            mean = np.full(stim_size * stim_size, 127.5)
+        self.mean = np.asarray(mean, dtype=np.float32).reshape(-1)
+        self.projection = np.linalg.pinv(self.components.astype(np.float64)).astype(np.float32)
+
+        # Coefficient scale that gives rendered noise about the pixel contrast of uniform noise
+        pixel_variance = float((self.components.astype(np.float64) ** 2).sum(axis=0).mean())
+        self.coefficient_std = UNIFORM_STD / np.sqrt(pixel_variance) if pixel_variance > 0 else 1.0
+
+    def render(self, coefficients):
+        """(..., K) coefficients -> (..., stim_size, stim_size) uint8 images"""
+        coefficients = np.asarray(coefficients, dtype=np.float32)
+        flat = coefficients @ self.components + self.mean
+        images = np.clip(np.rint(flat), 0, 255).astype(np.uint8)
+        return images.reshape(coefficients.shape[:-1] + (self.stim_size, self.stim_size))
+
+    def project(self, images):
+        """(..., stim_size, stim_size) images -> (..., K) least-squares coefficients"""
+        images = np.asarray(images, dtype=np.float32)
+        flat = images.reshape(images.shape[:-2] + (-1,)) - self.mean
+        return flat @ self.projection
+
+    def random_coefficients(self, rng, shape):
+        """Gaussian coefficients for `shape` fresh noise stimuli"""
+        shape = (shape,) if np.isscalar(shape) else tuple(shape)
+        return (rng.normal(0.0, 1.0, shape + (self.n_components,)) * self.coefficient_std).astype(np.float32)
+
+    def crossbreed(self, mother, father, rng, mutation_rate=0.1, mutation_scale=0.25):
+        """Uniform crossover of two stacks of coefficient vectors plus Gaussian mutation
+
+        Each coefficient mutates with probability mutation_rate by
+        N(0, mutation_scale * coefficient_std).
+        """
+        children = np.where(rng.random(mother.shape) < 0.5, mother, father).astype(np.float32)
+        mutate = rng.random(children.shape) < mutation_rate
+        steps = rng.normal(0.0, mutation_scale * self.coefficient_std, int(mutate.sum()))
+        children[mutate] += steps.astype(np.float32)
+        return children
+
+def _grid(stim_size):
+    """Pixel-centre coordinates of a stim_size x stim_size image"""
+    coords = np.arange(stim_size) + 0.5
+    return np.meshgrid(coords, coords, indexing='ij')
+
+def _normalise(components):
+    """Scale every component to unit length"""
+    norms = np.linalg.norm(components, axis=1, keepdims=True)
+    return components / np.where(norms > 0, norms, 1.0)
+
+def gaussian_basis(stim_size=16, grid=6, sigma=None):
+    """grid x grid isotropic Gaussian blobs tiling the image"""
+    ys, xs = _grid(stim_size)
+    spacing = stim_size / grid
+    sigma = spacing * 0.6 if sigma is None else sigma
+    centres = (np.arange(grid) + 0.5) * spacing
+    components = [np.exp(-((ys - cy) ** 2 + (xs - cx) ** 2) / (2 * sigma ** 2)).ravel()
+                  for cy in centres for cx in centres]
+    return BasisBank('gaussian', _normalise(np.array(components)), stim_size=stim_size)
+
+def gabor_basis(stim_size=16, frequencies=(1, 2, 3), orientations=4, grid=2):
+    """Even and odd Gabor patches at several frequencies (cycles per patch), orientations and positions"""
+    ys, xs = _grid(stim_size)
+    patch = stim_size / grid
+    sigma = patch / 2.5
+    components = []
+    for cy in (np.arange(grid) + 0.5) * patch:
+        for cx in (np.arange(grid) + 0.5) * patch:
+            envelope = np.exp(-((ys - cy) ** 2 + (xs - cx) ** 2) / (2 * sigma ** 2))
+            for frequency in frequencies:
+                for k in range(orientations):
+                    theta = np.pi * k / orientations
+                    phase = 2 * np.pi * frequency / patch * ((xs - cx) * np.cos(theta) + (ys - cy) * np.sin(theta))
+                    components.append((envelope * np.cos(phase)).ravel())
+                    components.append((envelope * np.sin(phase)).ravel())
+    return BasisBank('gabor', _normalise(np.array(components)), stim_size=stim_size)
+
+def pca_basis(image_dir=PCA_IMAGE_DIR, n_components=32, stim_size=16):
+    """Principal components of every composite image under image_dir (mean image included)"""
+    from PIL import Image
+
+    paths = sorted(glob.glob(os.path.join(image_dir, '**', '*.tif*'), recursive=True)
+                   + glob.glob(os.path.join(image_dir, '**', '*.png'), recursive=True))
+    if not paths:
+        raise FileNotFoundError(f'No composite images found under {image_dir}')
+    images = []
+    for path in paths:
+        with Image.open(path) as img:
+            img = img.convert('L')
+            if img.size != (stim_size, stim_size):
+                img = img.resize((stim_size, stim_size), Image.NEAREST)
+            images.append(np.asarray(img, dtype=np.float64).ravel())
+    data = np.array(images)
+    mean = data.mean(axis=0)
+    _, _, components = np.linalg.svd(data - mean, full_matrices=False)
+    n_components = min(n_components, len(data) - 1)
+    return BasisBank('pca', components[:n_components], mean, stim_size)
+
+@lru_cache(maxsize=None)
+def load_basis(name, stim_size=16, n_components=32):
+    """Build (once per process) the named basis: 'gaussian', 'gabor' or 'pca'"""
+    if name == 'gaussian':
+        return gaussian_basis(stim_size, grid=max(1, int(round(np.sqrt(n_components)))))
+    if name == 'gabor':
+        return gabor_basis(stim_size)
+    if name == 'pca':
+        return pca_basis(PCA_IMAGE_DIR, n_components, stim_size)
+    raise ValueError(f'Unknown stimulus basis {name!r}, expected one of {BASIS_TYPES}')
@@ -0,0 +1,251 @@
+#benchmarks.py
+
+"""
+Microbenchmarks for the GA, stimulus and I/O hot paths
+
+Each case is timed for every stim_size / population size combination and the
+results are appended to a JSON history. With --compare the run is checked
+against the previous entry and any case that got slower than the threshold
+is flagged as a regression (exit code 1).
+
+Usage:
+    python benchmarks.py                  # run everything and record it
+    python benchmarks.py --compare        # run, record and flag regressions
+    python benchmarks.py -k crossbreed    # only cases whose name contains 'crossbreed'
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import numpy as np
+
+from genetic_algorithm import crossbreed, generate_offspring, filter_selection, ideal_observer_select, OffspringSource
+from stimuli import generate_noise_pattern
+
+STIM_SIZES = [16, 32, 64]
+POPULATION_SIZES = [12, 24, 48]
+HISTORY_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_history.json')
+
+def _random_stimuli(count, stim_size):
+    """A list of random uint8 stimuli"""
+    return [np.random.randint(0, 256, (stim_size, stim_size), dtype=np.uint8) for _ in range(count)]
+
+def _target(stim_size):
+    """A target larger than the stimuli, as in the experiment (32x32 for 16x16 stimuli)"""
+    return np.random.randint(0, 256, (stim_size * 2, stim_size * 2), dtype=np.uint8)
+
+class _DataManagerContext:
+    """Create a ParticipantDataManager inside a throwaway working directory"""
+
+    def __enter__(self):
+        from data_saving import ParticipantDataManager
+        self.old_cwd = os.getcwd()
+        self.tmp_dir = tempfile.mkdtemp(prefix='grc_bench_')
+        os.chdir(self.tmp_dir)
+        self.manager = ParticipantDataManager('bench')
+        return self.manager
+
+    def __exit__(self, *exc):
+        os.chdir(self.old_cwd)
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+        return False
+
+def _case_crossbreed(stim_size, population):
+    p1, p2 = _random_stimuli(2, stim_size)
+    return lambda: crossbreed(p1, p2, stim_size)
+
+def _case_generate_offspring(stim_size, population):
+    parents = _random_stimuli(population, stim_size)
+    return lambda: generate_offspring(parents, stim_size)
+
+def _case_offspring_next_batch(stim_size, population):
+    parents = _random_stimuli(population, stim_size)
+    return lambda: OffspringSource(parents, stim_size).next_batch()
+
+def _case_filter_selection(stim_size, population):
+    stimuli = _random_stimuli(12, stim_size)
+    return lambda: filter_selection(stimuli[0], stimuli[1:])
+
+def _case_ideal_observer_select(stim_size, population):
+    stimuli = _random_stimuli(12, stim_size)
+    target = _target(stim_size)
+    return lambda: ideal_observer_select(stimuli, target)
+
+def _case_generate_noise_pattern(stim_size, population):
+    return lambda: generate_noise_pattern(stim_size)
+
+def _case_create_composite_image(stim_size, population):
+    from data_saving import ParticipantDataManager
+    arrays = _random_stimuli(population, stim_size)
+    manager = ParticipantDataManager.__new__(ParticipantDataManager)  # no folders needed
+    return lambda: manager.create_composite_image(arrays)
+
+def _case_save_selection_image(stim_size, population, manager):
+    array = _random_stimuli(1, stim_size)[0]
+    return lambda: manager.save_selection_image(array, 0, 0)
+
+def _case_save_composite_image(stim_size, population, manager):
+    array = _random_stimuli(1, stim_size)[0]
+    return lambda: manager.save_composite_image(array, 0)
+
+def _case_save_stimuli_as_csv(stim_size, population, manager):
+    stimuli = _random_stimuli(12, stim_size)
+    return lambda: manager.save_stimuli_as_csv(stimuli, 'G0', 0)
+
+SIZE_ONLY = [(s, None) for s in STIM_SIZES]
+SIZE_AND_POPULATION = [(s, p) for s in STIM_SIZES for p in POPULATION_SIZES]
+
+# Each case: name -> (parameter grid, setup returning a zero-argument callable, needs a data manager)
+CASES = {
+    'crossbreed': (SIZE_ONLY, _case_crossbreed, False),
+    'generate_offspring': (SIZE_AND_POPULATION, _case_generate_offspring, False),
+    'offspring_next_batch': (SIZE_AND_POPULATION, _case_offspring_next_batch, False),
+    'filter_selection': (SIZE_ONLY, _case_filter_selection, False),
+    'ideal_observer_select': (SIZE_ONLY, _case_ideal_observer_select, False),
+    'generate_noise_pattern': (SIZE_ONLY, _case_generate_noise_pattern, False),
+    'create_composite_image': (SIZE_AND_POPULATION, _case_create_composite_image, False),
+    'save_selection_image': (SIZE_ONLY, _case_save_selection_image, True),
+    'save_composite_image': (SIZE_ONLY, _case_save_composite_image, True),
+    'save_stimuli_as_csv': (SIZE_ONLY, _case_save_stimuli_as_csv, True),
+}
+
+def case_id(name, stim_size, population):
+    """Stable identifier of one parametrized case in the history"""
+    if population is None:
+        return f"{name}[stim_size={stim_size}]"
+    return f"{name}[stim_size={stim_size},population={population}]"
+
+def time_callable(func, repeats=5, min_time=0.05):
+    """Time func, calibrating the loop count so each repeat lasts at least min_time"""
+    loops = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(loops):
+            func()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time or loops >= 1_000_000:
+            break
+        loops *= 10 if elapsed < min_time / 10 else 2
+
+    samples = [elapsed / loops]
+    for _ in range(repeats - 1):
+        start = time.perf_counter()
+        for _ in range(loops):
+            func()
+        samples.append((time.perf_counter() - start) / loops)
+
+    return {
+        'median': statistics.median(samples),
+        'min': min(samples),
+        'loops': loops,
+        'repeats': repeats
+    }
+
+def run_benchmarks(keyword=None, repeats=5, min_time=0.05, quick=False):
+    """Run every (matching) case and return {case_id: timing}"""
+    results = {}
+    np.random.seed(0)
+
+    with _DataManagerContext() as manager:
+        for name, (grid, setup, needs_manager) in CASES.items():
+            if keyword and keyword not in name:
+                continue
+            if quick:
+                grid = grid[:1]
+            for stim_size, population in grid:
+                func = setup(stim_size, population, manager) if needs_manager else setup(stim_size, population)
+                cid = case_id(name, stim_size, population)
+                results[cid] = time_callable(func, repeats, min_time)
+                print(f"{cid:<60} {results[cid]['median'] * 1e6:>12.1f} us")
+
+    return results
+
+def _git_commit():
+    """Current git commit, if available"""
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def load_history(path=HISTORY_FILE):
+    """Load the benchmark history (a list of runs, oldest first)"""
+    if not os.path.exists(path):
+        return []
+    with open(path, 'r') as f:
+        return json.load(f)
+
+def save_run(results, path=HISTORY_FILE):
+    """Append a run to the benchmark history"""
+    history = load_history(path)
+    history.append({
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'commit': _git_commit(),
+        'python': platform.python_version(),
+        'machine': platform.node(),
+        'results': results
+    })
+    with open(path, 'w') as f:
+        json.dump(history, f, indent=2)
+    return history
+
+def compare_runs(baseline, current, threshold=0.10):
+    """Compare two result dicts and return the cases slower than threshold (relative)"""
+    regressions = []
+    print(f"{'case':<60} {'before (us)':>12} {'after (us)':>12} {'change':>8}")
+    for cid, timing in current.items():
+        if cid not in baseline:
+            continue
+        before = baseline[cid]['median']
+        after = timing['median']
+        change = (after - before) / before if before else 0.0
+        flag = ''
+        if change > threshold:
+            flag = '  REGRESSION'
+            regressions.append((cid, before, after, change))
+        print(f"{cid:<60} {before * 1e6:>12.1f} {after * 1e6:>12.1f} {change:>+8.1%}{flag}")
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="GA, stimulus and I/O microbenchmarks")
+    parser.add_argument('-k', '--keyword', help="only run cases whose name contains this")
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--min-time', type=float, default=0.05, help="seconds per repeat")
+    parser.add_argument('--quick', action='store_true', help="smallest parameters only")
+    parser.add_argument('--compare', action='store_true', help="flag regressions against the previous run")
+    parser.add_argument('--threshold', type=float, default=0.10, help="relative slowdown counted as a regression")
+    parser.add_argument('--history', default=HISTORY_FILE)
+    parser.add_argument('--no-save', action='store_true', help="do not record this run")
+    args = parser.parse_args(argv)
+
+    previous = load_history(args.history)
+    results = run_benchmarks(args.keyword, args.repeats, args.min_time, args.quick)
+
+    if not args.no_save:
+        save_run(results, args.history)
+
+    if args.compare:
+        if not previous:
+            print("No previous run to compare against")
+            return 0
+        print(f"\nComparing against run from {previous[-1]['timestamp']} ({previous[-1].get('commit')})")
+        regressions = compare_runs(previous[-1]['results'], results, args.threshold)
+        if regressions:
+            print(f"\n{len(regressions)} regression(s) above {args.threshold:.0%}")
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,211 @@
+#checkpoint.py
+
+"""
+Crash-safe session checkpoints and an append-only trial log
+
+TrialLog wraps the ExperimentHandler: every row passed through addData /
+nextEntry is also appended to a JSONL file as soon as it is complete, with
+fsync batched every few rows, so data survives a crash even though the
+ExperimentHandler only writes on close.
+
+save_checkpoint writes the full SessionState (parents, the offspring pairs
+already bred, batch index, RNG state, selections and convergence sums) to a small
+.npz after every trial, atomically. load_checkpoint restores it so the session
+continues at the exact next trial.
+"""
+
+import json
+import os
+import numpy as np
+from session_state import SessionState
+from genetic_algorithm import OffspringSource, AdaptiveMutation, genome_resolution
+from basis import load_basis
+
+CHECKPOINT_DIR = 'checkpoint'
+CHECKPOINT_FILE = 'session_checkpoint.npz'
+TRIAL_LOG_FILE = 'trial_log.jsonl'
+
+class TrialLog:
+    """Forward rows to an ExperimentHandler and append each finished row to a JSONL log"""
+
+    def __init__(self, exp_handler, path, sync_every=12):
+        """Open the log for appending; fsync after every `sync_every` rows"""
+        self.exp_handler = exp_handler
+        self.path = path
+        self.sync_every = sync_every
+        self.pending_sync = 0
+        self.row = {}
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.file = open(path, 'a', encoding='utf-8')
+
+    def __getattr__(self, name):
+        # Anything else (extraInfo, saveAsWideText, close...) goes to the real handler
+        return getattr(self.exp_handler, name)
+
+    def addData(self, name, value):
+        """Record a value for the current row"""
+        self.exp_handler.addData(name, value)
+        self.row[name] = value
+
+    def nextEntry(self):
+        """Finish the current row: append it to the log and hand it to the handler"""
+        self.exp_handler.nextEntry()
+        self.file.write(json.dumps(self.row, default=_json_default) + '\n')
+        self.file.flush()
+        self.row = {}
+        self.pending_sync += 1
+        if self.pending_sync >= self.sync_every:
+            self.sync()
+
+    def sync(self):
+        """Force buffered rows to disk"""
+        if self.pending_sync:
+            os.fsync(self.file.fileno())
+            self.pending_sync = 0
+
+    def close(self):
+        """Sync and close the log file"""
+        if not self.file.closed:
+            self.sync()
+            self.file.close()
+
+def _json_default(value):
+    """Serialise numpy scalars and arrays in log rows"""
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    return str(value)
+
+def _stack(arrays, stim_size):
+    """Stack a list of 2D arrays, keeping the shape when the list is empty"""
+    if not arrays:
+        return np.zeros((0, stim_size, stim_size), dtype=np.uint8)
+    return np.stack(arrays)
+
+def checkpoint_path(participant_dir):
+    """Where a participant's session checkpoint lives"""
+    return os.path.join(participant_dir, CHECKPOINT_DIR, CHECKPOINT_FILE)
+
+def trial_log_path(participant_dir):
+    """Where a participant's append-only trial log lives"""
+    return os.path.join(participant_dir, CHECKPOINT_DIR, TRIAL_LOG_FILE)
+
+def save_checkpoint(path, state, next_trial, extra=None):
+    """Atomically write the session state; the session resumes at `next_trial` of state.generation"""
+    convergence = state.convergence
+    selection_counts = [len(state.selections[gen]) for gen in range(state.generations)]
+    offspring = state.offspring
+
+    meta = {
+        'session_num': state.session_num,
+        'generations': state.generations,
+        'stim_size': state.stim_size,
+        'resolution_schedule': state.resolution_schedule,
+        'selections_per_trial': state.selections_per_trial,
+        'rank_selections': state.rank_selections,
+        'basis': ({'name': state.basis.name, 'n_components': state.basis.n_components}
+                  if state.basis is not None else None),
+        'generation': state.generation,
+        'next_trial': next_trial,
+        'batch_index': state.batch_index,
+        'selection_counts': selection_counts,
+        'mutation': ({'settings': state.mutation.settings, 'rate': state.mutation.rate,
+                      'sigma': state.mutation.sigma, 'diversity': state.mutation.diversity,
+                      'consistency': state.mutation.consistency}
+                     if state.mutation is not None else None),
+        'offspring_batches_drawn': offspring.batches_drawn if offspring is not None else None,
+        'rng_state': state.rng.bit_generator.state,
+        'convergence': {
+            'entropy_bins': convergence.entropy_bins,
+            'n_stimuli': convergence.n_stimuli,
+            'sq_norm_sum': convergence.sq_norm_sum,
+            'n_selected': convergence.n_selected,
+            'similarity_sum': convergence.similarity_sum,
+            'history': convergence.history
+        },
+        'extra': extra or {}
+    }
+
+    arrays = {
+        'meta': np.frombuffer(json.dumps(meta, default=_json_default).encode('utf-8'), dtype=np.uint8),
+        'parents': _stack(state.parents, state.stim_size),
+        'next_generation_parents': _stack(state.next_generation_parents, state.stim_size),
+        'parent_weights': np.asarray(state.parent_weights, dtype=np.float64),
+        'next_generation_weights': np.asarray(state.next_generation_weights, dtype=np.float64),
+        'offspring_drawn': (np.fromiter(sorted(offspring.drawn), dtype=np.int64) if offspring is not None
+                            else np.zeros(0, dtype=np.int64)),
+        'offspring_pending': (np.asarray(offspring.pending, dtype=np.int64)
+                              if offspring is not None and offspring.pending is not None
+                              else np.zeros(0, dtype=np.int64)),
+        'offspring_has_pending': np.array(offspring is not None and offspring.pending is not None),
+        'selections': _stack(state.all_selections(), state.stim_size),
+        'pixel_sum': convergence.pixel_sum,
+        'bin_counts': convergence.bin_counts
+    }
+    if convergence.target_array is not None:
+        arrays['target_array'] = convergence.target_array
+
+    # Write then rename, so a crash mid-write never leaves a corrupt checkpoint
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, **arrays)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+def load_checkpoint(path):
+    """Restore a SessionState from a checkpoint; returns (state, next_trial, extra)"""
+    with np.load(path) as data:
+        meta = json.loads(data['meta'].tobytes().decode('utf-8'))
+        arrays = {key: data[key] for key in data.files if key != 'meta'}
+
+    state = SessionState(meta['session_num'], meta['generations'], meta['stim_size'],
+                         resolution_schedule=meta.get('resolution_schedule'),
+                         selections_per_trial=meta.get('selections_per_trial', 1),
+                         rank_selections=meta.get('rank_selections', True),
+                         basis=(load_basis(meta['basis']['name'], meta['stim_size'], meta['basis']['n_components'])
+                                if meta.get('basis') else None))
+    state.generation = meta['generation']
+    state.resolution = genome_resolution(state.generation, state.resolution_schedule, state.stim_size)
+    state.batch_index = meta['batch_index']
+    state.parents = list(arrays['parents'])
+    state.next_generation_parents = list(arrays['next_generation_parents'])
+    # Checkpoints from before top-k trials have no weights: every parent came from one selection
+    state.parent_weights = [float(w) for w in arrays.get('parent_weights', np.ones(len(state.parents)))]
+    state.next_generation_weights = [float(w) for w in arrays.get(
+        'next_generation_weights', np.ones(len(state.next_generation_parents)))]
+    state.rng.bit_generator.state = meta['rng_state']
+    if meta.get('mutation') is not None:
+        state.mutation = AdaptiveMutation(**meta['mutation']['settings'])
+        for key in ('rate', 'sigma', 'diversity', 'consistency'):
+            setattr(state.mutation, key, meta['mutation'][key])
+    
+    # Rebuild the lazy offspring source with the pairs it has already used
+    if meta['offspring_batches_drawn'] is not None:
+        offspring = OffspringSource(state.parents, state.stim_size, state.rng, resolution=state.resolution,
+                                    mutation=state.mutation, basis=state.basis, weights=state.breeding_weights())
+        offspring.batches_drawn = meta['offspring_batches_drawn']
+        offspring.drawn = set(int(k) for k in arrays['offspring_drawn'])
+        if bool(arrays['offspring_has_pending']):
+            offspring.pending = [int(k) for k in arrays['offspring_pending']]
+        state.offspring = offspring
+
+    # Split the flat selection stack back into generations
+    offsets = np.cumsum([0] + meta['selection_counts'])
+    for gen in range(state.generations):
+        state.selections[gen] = list(arrays['selections'][offsets[gen]:offsets[gen + 1]])
+
+    convergence = state.convergence
+    convergence.target_array = arrays.get('target_array')
+    convergence.entropy_bins = meta['convergence']['entropy_bins']
+    convergence.n_stimuli = meta['convergence']['n_stimuli']
+    convergence.sq_norm_sum = meta['convergence']['sq_norm_sum']
+    convergence.n_selected = meta['convergence']['n_selected']
+    convergence.similarity_sum = meta['convergence']['similarity_sum']
+    convergence.history = meta['convergence']['history']
+    convergence.pixel_sum = arrays['pixel_sum']
+    convergence.bin_counts = arrays['bin_counts']
+
+    return state, meta['next_trial'], meta['extra']
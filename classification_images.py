@@ -0,0 +1,247 @@
+#classification_images.py
+
+"""
+Reverse-correlation classification images from full trial records
+
+For every main-task trial the classification image contribution is
+    chosen stimulus - mean of the 11 unchosen stimuli
+On top-k trials (selected_ids / selection_weights recorded) the chosen
+stimulus is the weighted mean of the k marks and only the 12 - k unmarked
+stimuli count as unchosen; unranked trials (no single selected_id) count the
+same way with equal weights. These are summed per generation for every participant and every group in a
+single streaming pass (one participant file, or one Parquet record batch, at
+a time), so memory stays at generations x stim_size^2 per image no matter how
+many trials are read. The final image weights each generation's mean
+difference by a per-generation weight.
+
+Trials come from the raw data/ CSVs plus participant_images/*/stimuli_csv, or
+from a dataset written by trial_dataset.py (--dataset).
+
+Usage: python classification_images.py [--dataset trial_dataset] [--weights uniform|linear]
+                                       [--groups organised_by_imagery/group_verification_results.csv]
+"""
+
+import argparse
+import ast
+import csv
+import glob
+import os
+
+import numpy as np
+
+from trial_dataset import STIMULI_PER_TRIAL, decode_stimuli, load_participant_rows
+
+OUTPUT_DIR = 'classification_images'
+GROUPS_FILE = os.path.join('organised_by_imagery', 'group_verification_results.csv')
+ALL_GROUP = 'all'
+
+def generation_weights(scheme, generations):
+    """Per-generation weights: 'uniform', 'linear' (later generations count more) or a list of numbers"""
+    if isinstance(scheme, str):
+        if scheme == 'uniform':
+            return np.ones(generations)
+        if scheme == 'linear':
+            return np.arange(1, generations + 1, dtype=np.float64)
+        raise ValueError(f"Unknown weighting scheme {scheme!r}")
+    weights = np.asarray(scheme, dtype=np.float64)
+    if len(weights) != generations:
+        raise ValueError(f"Expected {generations} generation weights, got {len(weights)}")
+    return weights
+
+def load_groups(path=GROUPS_FILE, valid_only=True):
+    """participant id -> group name from a group_verification_results.csv file"""
+    groups = {}
+    if not os.path.exists(path):
+        return groups
+    with open(path, newline='', encoding='utf-8') as f:
+        for row in csv.DictReader(f):
+            if valid_only and str(row.get('valid', 'True')).strip().lower() != 'true':
+                continue
+            groups[str(row['participant_id']).strip()] = row['group'].strip()
+    return groups
+
+def _parse_list(value):
+    """A list column as written by ExperimentHandler ('[3, 7]'), or None when empty"""
+    import pandas as pd
+
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return list(value)
+    if value is None or pd.isna(value) or not str(value).strip():
+        return None
+    return list(ast.literal_eval(str(value)))
+
+def selection_weight_matrix(rows, n_stimuli=STIMULI_PER_TRIAL):
+    """(n, n_stimuli) weight of each stimulus in each trial's selection: the marks' weights summing to 1, 0 unmarked
+
+    Top-k rows use selected_ids / selection_weights; single-choice rows put
+    all the weight on selected_id. Rows with no selection are all zero.
+    """
+    import pandas as pd
+
+    weights = np.zeros((len(rows), n_stimuli))
+    ids_column = rows['selected_ids'] if 'selected_ids' in rows else [None] * len(rows)
+    weights_column = rows['selection_weights'] if 'selection_weights' in rows else [None] * len(rows)
+    for row, (selected_id, ids, marks) in enumerate(zip(rows['selected_id'], ids_column, weights_column)):
+        ids = _parse_list(ids)
+        if ids:
+            marks = _parse_list(marks) or [1.0] * len(ids)
+            weights[row, ids] = marks
+        elif not pd.isna(selected_id):
+            weights[row, int(selected_id)] = 1.0
+    totals = weights.sum(axis=1, keepdims=True)
+    return np.divide(weights, totals, out=weights, where=totals > 0)
+
+def trial_differences(stimuli, weights):
+    """(n, 12, H, W) stimuli and (n, 12) selection weights -> (n, H, W) weighted marks minus mean-unmarked images"""
+    stimuli = np.asarray(stimuli, dtype=np.float64)
+    weights = np.asarray(weights, dtype=np.float64)
+    unmarked = (weights == 0).astype(np.float64)
+    marked_mean = np.einsum('ns,nshw->nhw', weights, stimuli)
+    unmarked_mean = np.einsum('ns,nshw->nhw', unmarked, stimuli) / unmarked.sum(axis=1)[:, None, None]
+    return marked_mean - unmarked_mean
+
+class ClassificationImageAccumulator:
+    """Per-generation sums of chosen-minus-unchosen images for any number of keys (participants, groups)"""
+
+    def __init__(self, generations=12, stim_size=16):
+        self.generations = generations
+        self.stim_size = stim_size
+        self.sums = {}
+        self.counts = {}
+
+    def _buffers(self, key):
+        if key not in self.sums:
+            self.sums[key] = np.zeros((self.generations, self.stim_size, self.stim_size))
+            self.counts[key] = np.zeros(self.generations, dtype=np.int64)
+        return self.sums[key], self.counts[key]
+
+    def add(self, keys, stimuli, weights, generations):
+        """Add a batch of trials (stimuli with their selection_weights rows) to every key in `keys`"""
+        if len(weights) == 0:
+            return
+        generations = np.asarray(generations, dtype=np.int64)
+        if generations.min() < 0 or generations.max() >= self.generations:
+            raise ValueError(f"Generation outside 0..{self.generations - 1}")
+        differences = trial_differences(stimuli, weights)
+
+        # One per-generation reduction for the batch, shared by every key it belongs to
+        batch_sums = np.zeros((self.generations, self.stim_size, self.stim_size))
+        np.add.at(batch_sums, generations, differences)
+        batch_counts = np.bincount(generations, minlength=self.generations)
+        for key in keys:
+            sums, counts = self._buffers(key)
+            sums += batch_sums
+            counts += batch_counts
+
+    def image(self, key, weights):
+        """Weighted mean over generations of the per-generation mean difference"""
+        sums, counts = self.sums[key], self.counts[key]
+        present = counts > 0
+        weights = np.where(present, weights, 0.0)
+        if weights.sum() == 0:
+            return np.zeros((self.stim_size, self.stim_size))
+        means = sums[present] / counts[present][:, None, None]
+        return np.tensordot(weights[present], means, axes=1) / weights.sum()
+
+    def images(self, weights):
+        """{key: classification image} for everything accumulated"""
+        return {key: self.image(key, weights) for key in self.sums}
+
+def _trial_batch(participant, rows, stim_size):
+    """(participant, stimuli, weights, generations) for the rows that have stimuli and a selection, or None"""
+    rows = rows[rows['stimuli'].notna() & rows['generation'].notna()]
+    weights = selection_weight_matrix(rows)
+    selected = weights.sum(axis=1) > 0
+    if not selected.any():
+        return None
+    rows = rows[selected]
+    return (participant, decode_stimuli(rows['stimuli'], stim_size), weights[selected],
+            rows['generation'].to_numpy(dtype=np.int64))
+
+def iter_raw_trials(data_dir='data', images_dir='participant_images', stim_size=16):
+    """Yield (participant, stimuli, weights, generations) for each data file's main-task trials"""
+    for data_file in sorted(glob.glob(os.path.join(data_dir, 'participant_*.csv'))):
+        participant, tables = load_participant_rows(data_file, images_dir)
+        rows = tables.get('main')
+        if rows is None:
+            continue
+        batch = _trial_batch(participant, rows, stim_size)
+        if batch is not None:
+            yield batch
+
+def iter_dataset_trials(path, stim_size=16, batch_size=4096):
+    """Yield (participant, stimuli, weights, generations) record batches from an exported dataset"""
+    import pyarrow.dataset as ds
+
+    dataset = ds.dataset(os.path.join(path, 'kind=main'), format='parquet', partitioning='hive')
+    # Datasets exported before top-k selections have no selected_ids / selection_weights
+    columns = [column for column in ('participant', 'generation', 'selected_id', 'selected_ids',
+                                     'selection_weights', 'stimuli') if column in dataset.schema.names]
+    for batch in dataset.to_batches(columns=columns, batch_size=batch_size):
+        table = batch.to_pandas()
+        for participant, rows in table.groupby('participant', sort=False):
+            batch = _trial_batch(str(participant), rows, stim_size)
+            if batch is not None:
+                yield batch
+
+def compute_classification_images(trials, groups=None, generations=12, stim_size=16, weights='uniform'):
+    """One pass over (participant, stimuli, selection weights, generations) batches
+
+    Returns ({participant: image}, {group: image}); every participant also
+    counts towards the 'all' group.
+    """
+    groups = groups or {}
+    accumulator = ClassificationImageAccumulator(generations, stim_size)
+    for participant, stimuli, selection, trial_generations in trials:
+        keys = [('participant', participant), ('group', ALL_GROUP)]
+        if participant in groups:
+            keys.append(('group', groups[participant]))
+        accumulator.add(keys, stimuli, selection, trial_generations)
+
+    images = accumulator.images(generation_weights(weights, generations))
+    participant_images = {name: image for (kind, name), image in images.items() if kind == 'participant'}
+    group_images = {name: image for (kind, name), image in images.items() if kind == 'group'}
+    return participant_images, group_images
+
+def save_images(images, out_dir, prefix):
+    """Write each image as .npy (raw) and .png (mid-grey = 0, scaled to the largest absolute value)
+
+    Stored arrays are upside down relative to the screen, so the PNG is
+    flipped vertically like the selection images in data_saving.
+    """
+    from PIL import Image
+
+    os.makedirs(out_dir, exist_ok=True)
+    for key, image in images.items():
+        stem = os.path.join(out_dir, f"{prefix}_{key}")
+        np.save(f"{stem}.npy", image)
+        scale = np.abs(image).max()
+        display = 127.5 + (127.5 * image / scale if scale > 0 else 0)
+        img = Image.fromarray(np.clip(np.rint(display), 0, 255).astype(np.uint8))
+        img.transpose(Image.FLIP_TOP_BOTTOM).save(f"{stem}.png")  # Screen orientation
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compute reverse-correlation classification images")
+    parser.add_argument('--data-dir', default='data')
+    parser.add_argument('--images-dir', default='participant_images')
+    parser.add_argument('--dataset', default=None, help="Read trials from an exported trial dataset instead")
+    parser.add_argument('--groups', default=GROUPS_FILE)
+    parser.add_argument('--weights', default='uniform', choices=['uniform', 'linear'])
+    parser.add_argument('--generations', type=int, default=12)
+    parser.add_argument('--stim-size', type=int, default=16)
+    parser.add_argument('--out', default=OUTPUT_DIR)
+    args = parser.parse_args(argv)
+
+    if args.dataset:
+        trials = iter_dataset_trials(args.dataset, args.stim_size)
+    else:
+        trials = iter_raw_trials(args.data_dir, args.images_dir, args.stim_size)
+    participant_images, group_images = compute_classification_images(
+        trials, load_groups(args.groups), args.generations, args.stim_size, args.weights)
+
+    save_images(participant_images, args.out, 'participant')
+    save_images(group_images, args.out, 'group')
+    print(f"Wrote {len(participant_images)} participant and {len(group_images)} group images to {args.out}")
+
+if __name__ == "__main__":
+    main()
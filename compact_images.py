@@ -0,0 +1,375 @@
+#compact_images.py
+
+"""
+Compact legacy participant_images folders into one array container each
+
+A participant folder written by ParticipantDataManager holds every selection
+and composite three times (png/, tiff/, csv/ and composites/) plus one CSV
+per shown stimulus in stimuli_csv/ - thousands of small files. This tool
+bulk-loads a folder:
+  - CSVs are read on a thread pool and parsed in batches with one vectorized
+    numpy call per batch instead of one parser call per file
+  - PNG/TIFF copies are decoded on the same pool and checked against the CSV
+    arrays: TIFF == PNG, and PNG == flipud(CSV) - or == CSV in folders
+    written before the images were flipped; the manifest counts which
+and writes <participant_dir>/compact.npz (compressed: selections, composites
+and stimuli with their generation/trial/phase indices) next to
+compact_manifest.json (source files, counts, any inconsistencies).
+
+With --prune the now redundant copies (tiff/, csv/, composite TIFF/CSV files
+and stimuli_csv/) are deleted once the container has been read back and
+matches. PNGs are kept as the viewable copy, stimuli_grids/ and checkpoint/
+are never touched. Folders with inconsistencies are never pruned.
+
+Folders that already have a container are skipped unless --force is given.
+A forced rebuild of a pruned folder takes each image's orientation from the
+manifest (it refuses if that is unknown or mixed) and keeps the stored
+stimuli when stimuli_csv/ is gone.
+
+trial_dataset.py reads stimuli from the container when stimuli_csv/ is gone.
+
+Usage: python compact_images.py [--images-dir participant_images] [--workers 8] [--prune] [--force] [participant_dir ...]
+"""
+
+import argparse
+import glob
+import io
+import json
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import numpy as np
+
+from shared_storage import atomic_write
+
+CONTAINER_FILE = 'compact.npz'
+MANIFEST_FILE = 'compact_manifest.json'
+CONTAINER_VERSION = 1
+PARSE_BATCH = 512  # CSV files parsed together by one worker
+
+SELECTION_PATTERN = re.compile(r'selection_p(?P<participant>.+)_g(?P<generation>\d+)_t(?P<trial>\d+)$')
+COMPOSITE_PATTERN = re.compile(r'composite_p(?P<participant>.+)_(?:g(?P<generation>\d+)|all)$')
+STIMULUS_PATTERN = re.compile(r'(?P<participant>.+)_(?P<phase>G\d+|training)_T(?P<trial>\d+)_stim(?P<index>\d+)$')
+METADATA_PATTERN = re.compile(r'(?P<participant>.+)_(?P<phase>G\d+|training)_T(?P<trial>\d+)_metadata$')
+
+def _read_bytes(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+def _parse_csv_batch(paths):
+    """Parse a batch of same-shaped integer CSVs with one vectorized call -> (n, H, W) uint8"""
+    contents = [_read_bytes(path) for path in paths]
+    first = contents[0].decode('ascii').strip().splitlines()
+    shape = (len(first), first[0].count(',') + 1)
+    text = ','.join(content.decode('ascii').strip() for content in contents).replace('\n', ',')
+    values = np.fromstring(text, dtype=np.int64, sep=',')
+    if values.size != len(paths) * shape[0] * shape[1]:
+        # A malformed or differently shaped file: parse one by one so the error names it
+        return np.stack([_parse_csv_file(path, shape) for path in paths])
+    return _to_uint8(values, paths).reshape((len(paths),) + shape)
+
+def _parse_csv_file(path, shape):
+    array = np.loadtxt(path, delimiter=',', dtype=np.int64, ndmin=2)
+    if array.shape != shape:
+        raise ValueError(f"{path}: expected a {shape[0]}x{shape[1]} array, found {array.shape}")
+    return _to_uint8(array, [path])
+
+def _to_uint8(values, paths):
+    if values.size and (values.min() < 0 or values.max() > 255):
+        raise ValueError(f"Values outside 0-255 in {paths[0]}" + (f" (or one of {len(paths)} files)" if len(paths) > 1 else ''))
+    return values.astype(np.uint8)
+
+def parse_csv_arrays(paths, pool):
+    """Parse many small CSV arrays on a thread pool -> (n, H, W) uint8 in path order"""
+    if not paths:
+        return np.zeros((0, 0, 0), dtype=np.uint8)
+    batches = [paths[i:i + PARSE_BATCH] for i in range(0, len(paths), PARSE_BATCH)]
+    return np.concatenate(list(pool.map(_parse_csv_batch, batches)))
+
+def _load_image(path):
+    from PIL import Image
+    with Image.open(path) as img:
+        return np.asarray(img.convert('L'), dtype=np.uint8)
+
+def load_images(paths, pool):
+    """Decode PNG/TIFF files on a thread pool (None entries stay None)"""
+    return list(pool.map(lambda path: _load_image(path) if path else None, paths))
+
+def _scan(directory, pattern, extensions):
+    """{match key: {ext: path}} for files in directory whose stem matches pattern"""
+    found = {}
+    for path in sorted(glob.glob(os.path.join(directory, '*'))):
+        stem, ext = os.path.splitext(os.path.basename(path))
+        ext = ext.lower().lstrip('.')
+        match = pattern.match(stem)
+        if match and ext in extensions:
+            found.setdefault(stem, {})[ext] = path
+    return found
+
+def participant_from_dir(participant_dir):
+    """participant_<id>_<YYYYmmdd>_<HHMMSS> -> <id>"""
+    parts = os.path.basename(os.path.normpath(participant_dir)).split('_')
+    return '_'.join(parts[1:-2]) if len(parts) > 3 else parts[-1]
+
+def _load_copies(entries, pool, problems, orientations, kind, recorded_orientation=None, pruned=False):
+    """Arrays for {stem: {ext: path}} entries (CSV orientation), checking every copy against the others
+
+    An entry with only image copies left (after a prune) is oriented with
+    recorded_orientation ('flipped' or 'unflipped', from the manifest);
+    without one, ValueError is raised rather than guessing. In a pruned
+    folder missing CSV/TIFF copies are expected and not reported.
+    """
+    stems = sorted(entries)
+    csv_stems = [stem for stem in stems if 'csv' in entries[stem]]
+    csv_arrays = dict(zip(csv_stems, parse_csv_arrays([entries[stem]['csv'] for stem in csv_stems], pool)))
+    pngs = load_images([entries[stem].get('png') for stem in stems], pool)
+    tiffs = load_images([entries[stem].get('tiff') or entries[stem].get('tif') for stem in stems], pool)
+
+    arrays = []
+    for stem, png, tiff in zip(stems, pngs, tiffs):
+        array = csv_arrays.get(stem)
+        images = {name: image for name, image in (('png', png), ('tiff', tiff)) if image is not None}
+        missing = [name for name, copy in (('csv', array), ('png', png), ('tiff', tiff))
+                   if copy is None and not (pruned and name != 'png')]
+        if missing:
+            problems.append(f"{kind} {stem}: no {'/'.join(missing)} copy")
+        if not images:
+            arrays.append(array)
+            continue
+        if png is not None and tiff is not None and not np.array_equal(png, tiff):
+            problems.append(f"{kind} {stem}: tiff differs from png")
+        image = next(iter(images.values()))
+        if array is None:
+            if recorded_orientation is None:
+                raise ValueError(f"{kind} {stem}: only image copies left and no single recorded orientation")
+            array = np.flipud(image) if recorded_orientation == 'flipped' else image
+            orientations[recorded_orientation] += 1
+        elif image.shape == array.shape and np.array_equal(image, np.flipud(array)):
+            orientations['flipped'] += 1
+        elif image.shape == array.shape and np.array_equal(image, array):
+            # Written before the images were flipped
+            orientations['unflipped'] += 1
+        else:
+            problems.append(f"{kind} {stem}: images differ from csv")
+        arrays.append(array)
+    return stems, arrays
+
+def _stack(arrays, stim_size):
+    return np.stack(arrays) if arrays else np.zeros((0, stim_size, stim_size), dtype=np.uint8)
+
+def read_manifest(participant_dir):
+    """A folder's compact_manifest.json as a dict, or None"""
+    path = os.path.join(participant_dir, MANIFEST_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+def recorded_orientation(manifest):
+    """'flipped' or 'unflipped' if every image a manifest checked had that orientation, else None"""
+    counts = (manifest or {}).get('image_orientation') or {}
+    found = [name for name in ('flipped', 'unflipped') if counts.get(name)]
+    return found[0] if len(found) == 1 else None
+
+def compact_participant(participant_dir, pool, stim_size=16):
+    """Load and verify one participant folder -> (arrays for the container, manifest dict)"""
+    participant = participant_from_dir(participant_dir)
+    previous = read_manifest(participant_dir)
+    orientation = recorded_orientation(previous)
+    pruned = bool(previous and previous.get('pruned'))
+    problems = []
+    orientations = {'flipped': 0, 'unflipped': 0}  # How the PNG/TIFF copies relate to the CSV arrays
+
+    # Selections: png/, tiff/, csv/ copies of the same array
+    selections = {}
+    for format_dir in ('csv', 'png', 'tiff'):
+        for stem, files in _scan(os.path.join(participant_dir, format_dir), SELECTION_PATTERN,
+                                 ('csv', 'png', 'tiff', 'tif')).items():
+            selections.setdefault(stem, {}).update(files)
+    selection_stems, selection_arrays = _load_copies(selections, pool, problems, orientations, 'selection',
+                                                     orientation, pruned)
+    selection_keys = [SELECTION_PATTERN.match(stem) for stem in selection_stems]
+
+    # Composites: one folder holding all three formats
+    composites = _scan(os.path.join(participant_dir, 'composites'), COMPOSITE_PATTERN, ('csv', 'png', 'tiff', 'tif'))
+    composite_stems, composite_arrays = _load_copies(composites, pool, problems, orientations, 'composite',
+                                                     orientation, pruned)
+    composite_keys = [COMPOSITE_PATTERN.match(stem) for stem in composite_stems]
+
+    # Shown stimuli: CSV only, plus one metadata CSV per trial
+    stimuli_dir = os.path.join(participant_dir, 'stimuli_csv')
+    stimuli = _scan(stimuli_dir, STIMULUS_PATTERN, ('csv',))
+    stimulus_stems = sorted(stimuli, key=lambda stem: (STIMULUS_PATTERN.match(stem).group('phase'),
+                                                        int(STIMULUS_PATTERN.match(stem).group('trial')),
+                                                        int(STIMULUS_PATTERN.match(stem).group('index'))))
+    stimulus_keys = [STIMULUS_PATTERN.match(stem) for stem in stimulus_stems]
+    stimulus_arrays = parse_csv_arrays([stimuli[stem]['csv'] for stem in stimulus_stems], pool)
+    trial_metadata = []
+    for stem, files in sorted(_scan(stimuli_dir, METADATA_PATTERN, ('csv',)).items()):
+        lines = _read_bytes(files['csv']).decode('utf-8').strip().splitlines()
+        if len(lines) >= 2:
+            trial_metadata.append(dict(zip(lines[0].split(','), lines[1].split(','))))
+
+    stored_stimuli = None
+    if not stimulus_stems and previous and previous.get('pruned'):
+        # stimuli_csv/ was pruned: the old container holds the only copy
+        container = load_container(participant_dir)
+        if container is None:
+            raise ValueError(f"{participant_dir}: pruned folder without its container")
+        stored_stimuli = {name: container[name] for name in
+                          ('stimuli', 'stimuli_phase', 'stimuli_trial', 'stimuli_index')}
+        trial_metadata = previous.get('trial_metadata', [])
+
+    arrays = {
+        'selections': _stack(selection_arrays, stim_size),
+        'selection_generation': np.array([int(m.group('generation')) for m in selection_keys], dtype=np.int16),
+        'selection_trial': np.array([int(m.group('trial')) for m in selection_keys], dtype=np.int16),
+        'composites': _stack(composite_arrays, stim_size),
+        # -1 marks the mega-composite of all generations
+        'composite_generation': np.array([int(m.group('generation') or -1) for m in composite_keys], dtype=np.int16),
+        'stimuli': stimulus_arrays if len(stimulus_stems) else _stack([], stim_size),
+        'stimuli_phase': np.array([m.group('phase') for m in stimulus_keys], dtype='U16'),
+        'stimuli_trial': np.array([int(m.group('trial')) for m in stimulus_keys], dtype=np.int16),
+        'stimuli_index': np.array([int(m.group('index')) for m in stimulus_keys], dtype=np.int16),
+    }
+    if stored_stimuli is not None:
+        arrays.update(stored_stimuli)
+
+    def relative(paths):
+        return sorted(os.path.relpath(path, participant_dir) for path in paths)
+
+    manifest = {
+        'version': CONTAINER_VERSION,
+        'participant': participant,
+        'participant_dir': os.path.basename(os.path.normpath(participant_dir)),
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'counts': {'selections': len(selection_stems), 'composites': len(composite_stems),
+                   'stimuli': len(arrays['stimuli']), 'trials': len(trial_metadata)},
+        'arrays': {name: {'shape': list(array.shape), 'dtype': str(array.dtype)} for name, array in arrays.items()},
+        'image_orientation': orientations,
+        'trial_metadata': trial_metadata,
+        'inconsistencies': problems,
+        'sources': {
+            'selections': relative(path for files in selections.values() for path in files.values()),
+            'composites': relative(path for files in composites.values() for path in files.values()),
+            'stimuli': relative(files['csv'] for files in stimuli.values()),
+        },
+        'pruned': list((previous or {}).get('pruned', [])),
+    }
+    return arrays, manifest
+
+def write_container(participant_dir, arrays, manifest):
+    """Write compact.npz and compact_manifest.json atomically"""
+    buffer = io.BytesIO()
+    np.savez_compressed(buffer, **arrays)
+    atomic_write(os.path.join(participant_dir, CONTAINER_FILE), buffer.getvalue())
+    write_manifest(participant_dir, manifest)
+
+def write_manifest(participant_dir, manifest):
+    atomic_write(os.path.join(participant_dir, MANIFEST_FILE),
+                 json.dumps(manifest, indent=2).encode('utf-8'))
+
+def load_container(participant_dir):
+    """Arrays of a participant's compact.npz as a dict, or None if the folder has not been compacted"""
+    path = os.path.join(participant_dir, CONTAINER_FILE)
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as data:
+        return {name: data[name] for name in data.files}
+
+def stimuli_lookup(container):
+    """{(phase, trial): (n, H, W) stimuli in display order} from a loaded container"""
+    lookup = {}
+    order = np.lexsort((container['stimuli_index'], container['stimuli_trial'], container['stimuli_phase']))
+    for row in order:
+        key = (str(container['stimuli_phase'][row]), int(container['stimuli_trial'][row]))
+        lookup.setdefault(key, []).append(container['stimuli'][row])
+    return {key: np.stack(arrays) for key, arrays in lookup.items()}
+
+def load_selections(participant_dir, pool, stim_size=16):
+    """(selections, generations, trials) of one folder, from its container or else its csv/ copies"""
+    container = load_container(participant_dir)
+    if container is not None:
+        return (container['selections'], container['selection_generation'].astype(np.int64),
+                container['selection_trial'].astype(np.int64))
+    entries = _scan(os.path.join(participant_dir, 'csv'), SELECTION_PATTERN, ('csv',))
+    stems = sorted(entries)
+    keys = [SELECTION_PATTERN.match(stem) for stem in stems]
+    arrays = parse_csv_arrays([entries[stem]['csv'] for stem in stems], pool) if stems else _stack([], stim_size)
+    return (arrays, np.array([int(m.group('generation')) for m in keys], dtype=np.int64),
+            np.array([int(m.group('trial')) for m in keys], dtype=np.int64))
+
+def prune_redundant(participant_dir, arrays, manifest):
+    """Delete the copies the container replaces, after reading it back; returns the removed paths"""
+    stored = load_container(participant_dir)
+    if stored is None or any(not np.array_equal(stored[name], array) for name, array in arrays.items()):
+        raise RuntimeError(f"{participant_dir}: container does not read back identically, not pruning")
+
+    removed = list(manifest.get('pruned', []))
+    keep_png = lambda path: path.lower().endswith('.png')  # noqa: E731
+    for path in manifest['sources']['selections'] + manifest['sources']['composites'] + manifest['sources']['stimuli']:
+        if not keep_png(path):
+            os.remove(os.path.join(participant_dir, path))
+            removed.append(path)
+    for path in glob.glob(os.path.join(participant_dir, 'stimuli_csv', '*_metadata.csv')):
+        os.remove(path)
+        removed.append(os.path.relpath(path, participant_dir))
+    # Drop the format folders that are now empty
+    for folder in ('tiff', 'csv', 'stimuli_csv'):
+        path = os.path.join(participant_dir, folder)
+        if os.path.isdir(path) and not os.listdir(path):
+            os.rmdir(path)
+    return sorted(set(removed))
+
+def compact(participant_dirs, workers=8, prune=False, stim_size=16, force=False):
+    """Compact every folder (already compacted ones only with force); returns {participant_dir: manifest}"""
+    manifests = {}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for participant_dir in participant_dirs:
+            previous = read_manifest(participant_dir)
+            if not force and (os.path.exists(os.path.join(participant_dir, CONTAINER_FILE))
+                              or (previous and previous.get('pruned'))):
+                print(f"{os.path.basename(participant_dir)}: already compacted, skipped (--force to rebuild)")
+                continue
+            try:
+                arrays, manifest = compact_participant(participant_dir, pool, stim_size)
+            except ValueError as e:
+                print(f"{os.path.basename(participant_dir)}: not compacted: {e}")
+                continue
+            write_container(participant_dir, arrays, manifest)
+            counts = manifest['counts']
+            print(f"{os.path.basename(participant_dir)}: {counts['selections']} selections, "
+                  f"{counts['composites']} composites, {counts['stimuli']} stimuli")
+            for problem in manifest['inconsistencies']:
+                print(f"  {problem}")
+            if prune:
+                if manifest['inconsistencies']:
+                    print("  Not pruned: copies disagree")
+                else:
+                    manifest['pruned'] = prune_redundant(participant_dir, arrays, manifest)
+                    write_manifest(participant_dir, manifest)
+                    print(f"  Pruned {len(manifest['pruned'])} redundant files")
+            manifests[participant_dir] = manifest
+    return manifests
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compact participant_images folders into array containers")
+    parser.add_argument('participant_dirs', nargs='*', help="Folders to compact (default: all under --images-dir)")
+    parser.add_argument('--images-dir', default='participant_images')
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--stim-size', type=int, default=16)
+    parser.add_argument('--prune', action='store_true', help="Delete TIFF/CSV copies once the container verifies")
+    parser.add_argument('--force', action='store_true', help="Rebuild folders that already have a container")
+    args = parser.parse_args(argv)
+
+    participant_dirs = args.participant_dirs or sorted(
+        path for path in glob.glob(os.path.join(args.images_dir, 'participant_*')) if os.path.isdir(path))
+    if not participant_dirs:
+        print("No participant folders found")
+        return
+    compact(participant_dirs, args.workers, args.prune, args.stim_size, args.force)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,349 @@
+#composite_similarity.py
+
+"""
+Pairwise similarity of all composites, hierarchical clustering and nearest neighbours
+
+Every composite found by spectral_analysis.collect_composites (the
+organised_by_imagery/<group>/ folders and participant_images/*/composites)
+is flattened into a feature row. The full N x N SSE and Pearson correlation
+matrices are computed block by block - one (B x d) @ (d x B) Gram product per
+block pair gives both - and written to .npy memmaps, so memory stays at a
+few B x B blocks however many composites there are.
+
+The state lives in <out>/ (index.json, features.npy, sse.npy,
+correlation.npy). A rerun keys composites by content hash and only computes
+the rows and columns of new ones, growing the matrices block by block; a
+state built by an older composite loader (spectral_analysis.LOADER_VERSION)
+is rebuilt.
+
+Analyses:
+  - mean correlation / SSE within and between imagery groups (accumulated
+    over the blocks as well)
+  - average-linkage clustering on 1 - correlation (nearest-neighbour chain,
+    exact), cut into as many clusters as there are groups and compared with
+    them by the adjusted Rand index. Clustering needs an N x N matrix in
+    memory, so above --max-cluster composites an evenly spaced subset is used
+  - --neighbours PATH lists the closest composites to any image
+
+Usage: python composite_similarity.py [--out composite_similarity] [--block 1024] [--max-cluster 5000]
+                                      [--neighbours path/to/image.png] [-k 10]
+"""
+
+import argparse
+import csv
+import json
+import os
+
+import numpy as np
+
+from classification_images import GROUPS_FILE, load_groups
+from spectral_analysis import (IMAGERY_DIR, PARTICIPANT_IMAGES_DIR, UNASSIGNED_GROUP, collect_composites,
+                               LOADER_VERSION, file_hash, load_composite)
+
+OUTPUT_DIR = 'composite_similarity'
+INDEX_FILE = 'index.json'
+FEATURES_FILE = 'features.npy'
+MATRIX_FILES = {'sse': 'sse.npy', 'correlation': 'correlation.npy'}
+BLOCK_SIZE = 1024
+
+def _block_similarities(a, b):
+    """SSE and correlation between every row of a (m, d) and b (n, d), from one Gram product"""
+    a = np.asarray(a, dtype=np.float64)
+    b = np.asarray(b, dtype=np.float64)
+    d = a.shape[1]
+    gram = a @ b.T
+    sq_a = np.einsum('ij,ij->i', a, a)
+    sq_b = np.einsum('ij,ij->i', b, b)
+    sse = np.maximum(sq_a[:, None] + sq_b[None, :] - 2.0 * gram, 0.0)
+
+    mean_a, mean_b = a.mean(axis=1), b.mean(axis=1)
+    std_a = np.sqrt(np.maximum(sq_a / d - mean_a ** 2, 0.0))
+    std_b = np.sqrt(np.maximum(sq_b / d - mean_b ** 2, 0.0))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        correlation = (gram / d - np.outer(mean_a, mean_b)) / np.outer(std_a, std_b)
+    correlation = np.clip(np.nan_to_num(correlation, nan=0.0), -1.0, 1.0)  # Flat composites correlate 0
+    return sse.astype(np.float32), correlation.astype(np.float32)
+
+class SimilarityStore:
+    """Composite index, features and the two similarity matrices on disk"""
+
+    def __init__(self, out_dir=OUTPUT_DIR, block_size=BLOCK_SIZE):
+        self.out_dir = out_dir
+        self.block_size = block_size
+        self.entries = []  # [{'hash', 'path', 'group', 'participant', 'generation'}] in matrix order
+        index_path = os.path.join(out_dir, INDEX_FILE)
+        if os.path.exists(index_path):
+            with open(index_path, encoding='utf-8') as f:
+                index = json.load(f)
+            if index.get('loader_version') == LOADER_VERSION:
+                self.entries = index['entries']
+            else:
+                print(f"{index_path} was built with an older composite loader; rebuilding")
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _path(self, name):
+        return os.path.join(self.out_dir, name)
+
+    def matrix(self, metric):
+        """Read-only memmap of the 'sse' or 'correlation' matrix"""
+        return np.load(self._path(MATRIX_FILES[metric]), mmap_mode='r')
+
+    def features(self):
+        return np.load(self._path(FEATURES_FILE), mmap_mode='r')
+
+    def update(self, composites):
+        """Add composites [(path, group, participant, generation)] not yet indexed; returns how many were added"""
+        known = {entry['hash'] for entry in self.entries}
+        new_entries, new_features = [], []
+        for path, group, participant, generation in composites:
+            digest = file_hash(path)
+            if digest in known:
+                continue
+            known.add(digest)
+            image = load_composite(path)
+            if new_features and image.shape != new_features[0].shape:
+                raise ValueError(f"{path}: composites have different sizes")
+            new_entries.append({'hash': digest, 'path': path, 'group': group, 'participant': participant,
+                                'generation': generation})
+            new_features.append(image)
+        if not new_entries:
+            return 0
+
+        os.makedirs(self.out_dir, exist_ok=True)
+        n_old, n_new = len(self.entries), len(new_entries)
+        n = n_old + n_new
+        added = np.stack(new_features).reshape(n_new, -1).astype(np.float32)
+        if n_old and added.shape[1] != self.features().shape[1]:
+            raise ValueError("New composites differ in size from the indexed ones")
+
+        # Grow into temporary files, then rename, so an interrupted update leaves the old state intact
+        features = np.lib.format.open_memmap(self._path(FEATURES_FILE + '.tmp'), 'w+', np.float32, (n, added.shape[1]))
+        matrices = {metric: np.lib.format.open_memmap(self._path(name + '.tmp'), 'w+', np.float32, (n, n))
+                    for metric, name in MATRIX_FILES.items()}
+        if n_old:
+            features[:n_old] = self.features()
+            for metric, matrix in matrices.items():
+                old = self.matrix(metric)
+                for start in range(0, n_old, self.block_size):
+                    stop = min(start + self.block_size, n_old)
+                    matrix[start:stop, :n_old] = old[start:stop]
+                del old
+        features[n_old:] = added
+
+        # Only the new rows (and, by symmetry, columns) need computing
+        for row in range(n_old, n, self.block_size):
+            rows = slice(row, min(row + self.block_size, n))
+            for col in range(0, rows.stop, self.block_size):
+                cols = slice(col, min(col + self.block_size, rows.stop))
+                sse, correlation = _block_similarities(features[rows], features[cols])
+                for metric, block in (('sse', sse), ('correlation', correlation)):
+                    matrices[metric][rows, cols] = block
+                    matrices[metric][cols, rows] = block.T
+
+        features.flush()
+        del features
+        for metric, matrix in matrices.items():
+            matrix.flush()
+        del matrices
+        os.replace(self._path(FEATURES_FILE + '.tmp'), self._path(FEATURES_FILE))
+        for name in MATRIX_FILES.values():
+            os.replace(self._path(name + '.tmp'), self._path(name))
+        self.entries.extend(new_entries)
+        with open(self._path(INDEX_FILE + '.tmp'), 'w', encoding='utf-8') as f:
+            json.dump({'loader_version': LOADER_VERSION, 'entries': self.entries}, f, indent=1)
+        os.replace(self._path(INDEX_FILE + '.tmp'), self._path(INDEX_FILE))
+        return n_new
+
+    def group_means(self, labels=None):
+        """{(group_a, group_b): (mean correlation, mean SSE)} over all pairs of distinct composites"""
+        labels = np.asarray(labels if labels is not None else [entry['group'] for entry in self.entries])
+        names = sorted(set(labels.tolist()))
+        onehot = (labels[:, None] == np.array(names)[None, :]).astype(np.float64)
+        sums = {metric: np.zeros((len(names), len(names))) for metric in MATRIX_FILES}
+        for metric in MATRIX_FILES:
+            matrix = self.matrix(metric)
+            for start in range(0, len(labels), self.block_size):
+                block = np.asarray(matrix[start:start + self.block_size], dtype=np.float64)
+                rows = onehot[start:start + len(block)]
+                # Leave out each composite paired with itself
+                diagonal = block[np.arange(len(block)), start + np.arange(len(block))]
+                sums[metric] += rows.T @ block @ onehot - rows.T @ (diagonal[:, None] * rows)
+            del matrix
+        sizes = onehot.sum(axis=0)
+        pairs = np.outer(sizes, sizes) - np.diag(sizes)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            correlation, sse = sums['correlation'] / pairs, sums['sse'] / pairs
+        return {(a, b): (correlation[i, j], sse[i, j])
+                for i, a in enumerate(names) for j, b in enumerate(names) if i <= j}
+
+    def nearest(self, query, k=10, metric='correlation'):
+        """k closest indexed composites to an index or image path: [(entry, value)], best first"""
+        if isinstance(query, (int, np.integer)):
+            values = np.asarray(self.matrix(metric)[query], dtype=np.float64)
+            exclude = query
+        else:
+            image = load_composite(query).reshape(1, -1)
+            features = self.features()
+            values = np.concatenate([_block_similarities(image, features[start:start + self.block_size])
+                                     [0 if metric == 'sse' else 1][0]
+                                     for start in range(0, len(features), self.block_size)]).astype(np.float64)
+            exclude = None
+        order = np.argsort(values if metric == 'sse' else -values, kind='stable')
+        order = [i for i in order if i != exclude][:k]
+        return [(self.entries[i], values[i]) for i in order]
+
+def average_linkage(distances):
+    """Average-linkage hierarchical clustering of a dense distance matrix (nearest-neighbour chain)
+
+    Returns a scipy-style (N - 1, 4) linkage matrix: merged cluster ids,
+    distance and new cluster size, merges sorted by distance.
+    """
+    D = np.array(distances, dtype=np.float64)
+    n = len(D)
+    if n < 2:
+        return np.zeros((0, 4))
+    np.fill_diagonal(D, np.inf)
+    sizes = np.ones(n)
+    active = np.ones(n, dtype=bool)
+    merges = []
+    chain = []
+    while len(merges) < n - 1:
+        if not chain:
+            chain.append(int(np.flatnonzero(active)[0]))
+        a = chain[-1]
+        b = int(np.argmin(D[a]))
+        if len(chain) > 1 and D[a, chain[-2]] <= D[a, b]:
+            b = chain[-2]  # Prefer the previous chain element on ties so the chain terminates
+        if len(chain) > 1 and b == chain[-2]:
+            chain.pop()
+            chain.pop()
+            merges.append((a, b, D[a, b]))
+            # Lance-Williams update for average linkage, the merged cluster keeps slot a
+            merged = (sizes[a] * D[a] + sizes[b] * D[b]) / (sizes[a] + sizes[b])
+            D[a], D[:, a] = merged, merged
+            D[a, a] = np.inf
+            D[b], D[:, b] = np.inf, np.inf
+            sizes[a] += sizes[b]
+            active[b] = False
+        else:
+            chain.append(b)
+
+    # Sort by distance and relabel through a union-find over the merged representatives
+    merges.sort(key=lambda merge: merge[2])
+    parent = list(range(n))
+    cluster_id = list(range(n))
+    size = [1] * n
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    linkage = np.zeros((n - 1, 4))
+    for step, (a, b, distance) in enumerate(merges):
+        root_a, root_b = find(a), find(b)
+        first, second = sorted((cluster_id[root_a], cluster_id[root_b]))
+        parent[root_b] = root_a
+        size[root_a] += size[root_b]
+        cluster_id[root_a] = n + step
+        linkage[step] = (first, second, distance, size[root_a])
+    return linkage
+
+def cut_tree(linkage, n_clusters):
+    """Flat cluster labels (0..n_clusters-1) from the first N - n_clusters merges of a linkage matrix"""
+    n = len(linkage) + 1
+    parent = list(range(2 * n - 1))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for step in range(n - max(n_clusters, 1)):
+        first, second = int(linkage[step, 0]), int(linkage[step, 1])
+        parent[find(first)] = n + step
+        parent[find(second)] = n + step
+    roots = [find(i) for i in range(n)]
+    _, labels = np.unique(roots, return_inverse=True)
+    return labels
+
+def adjusted_rand_index(labels_a, labels_b):
+    """Agreement between two labelings of the same items, 1 = identical, about 0 = chance"""
+    _, a = np.unique(labels_a, return_inverse=True)
+    _, b = np.unique(labels_b, return_inverse=True)
+    table = np.zeros((a.max() + 1, b.max() + 1))
+    np.add.at(table, (a, b), 1)
+    pairs = lambda x: (x * (x - 1) / 2).sum()  # noqa: E731
+    index, rows, cols = pairs(table), pairs(table.sum(axis=1)), pairs(table.sum(axis=0))
+    expected = rows * cols / pairs(np.array([len(a)]))
+    maximum = (rows + cols) / 2
+    return (index - expected) / (maximum - expected) if maximum != expected else 1.0
+
+def cluster_composites(store, max_items=5000):
+    """Average-linkage clusters of (a subset of) the composites vs their groups: (indices, labels, ARI)"""
+    groups = np.array([entry['group'] for entry in store.entries])
+    known = np.flatnonzero(groups != UNASSIGNED_GROUP)
+    if len(known) < 2:
+        return known, np.zeros(len(known), dtype=np.int64), float('nan')
+    if len(known) > max_items:
+        known = known[np.linspace(0, len(known) - 1, max_items).astype(np.int64)]
+    correlation = store.matrix('correlation')
+    distances = 1.0 - np.asarray(correlation[np.ix_(known, known)], dtype=np.float64)
+    del correlation
+    n_groups = len(set(groups[known].tolist()))
+    labels = cut_tree(average_linkage(distances), n_groups)
+    return known, labels, adjusted_rand_index(groups[known], labels)
+
+def write_outputs(store, out_dir, indices, labels, group_means):
+    """group_similarity.csv and clusters.csv"""
+    with open(os.path.join(out_dir, 'group_similarity.csv'), 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['group_a', 'group_b', 'mean_correlation', 'mean_sse'])
+        for (a, b), (correlation, sse) in group_means.items():
+            writer.writerow([a, b, f"{correlation:.6g}", f"{sse:.6g}"])
+    with open(os.path.join(out_dir, 'clusters.csv'), 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['path', 'group', 'participant', 'generation', 'cluster'])
+        for index, label in zip(indices, labels):
+            entry = store.entries[index]
+            writer.writerow([entry['path'], entry['group'], entry['participant'], entry['generation'], int(label)])
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Pairwise similarity, clustering and neighbours of composites")
+    parser.add_argument('--imagery-dir', default=IMAGERY_DIR)
+    parser.add_argument('--participant-images', default=PARTICIPANT_IMAGES_DIR)
+    parser.add_argument('--groups', default=GROUPS_FILE)
+    parser.add_argument('--out', default=OUTPUT_DIR)
+    parser.add_argument('--block', type=int, default=BLOCK_SIZE, help="Rows per matrix block")
+    parser.add_argument('--max-cluster', type=int, default=5000, help="Most composites clustered at once")
+    parser.add_argument('--neighbours', default=None, help="Image (or index) to list the nearest composites of")
+    parser.add_argument('-k', type=int, default=10)
+    parser.add_argument('--metric', default='correlation', choices=sorted(MATRIX_FILES))
+    args = parser.parse_args(argv)
+
+    store = SimilarityStore(args.out, args.block)
+    added = store.update(collect_composites(args.imagery_dir, args.participant_images, load_groups(args.groups)))
+    print(f"Added {added} composites; {len(store)} indexed")
+    if len(store) < 2:
+        return
+
+    if args.neighbours is not None:
+        query = int(args.neighbours) if args.neighbours.isdigit() else args.neighbours
+        for entry, value in store.nearest(query, args.k, args.metric):
+            print(f"{value:>12.4g}  {entry['group']:<12}{entry['path']}")
+        return
+
+    group_means = store.group_means()
+    indices, labels, ari = cluster_composites(store, args.max_cluster)
+    write_outputs(store, args.out, indices, labels, group_means)
+    print(f"{'group_a':<12}{'group_b':<12}{'mean r':>10}{'mean SSE':>14}")
+    for (a, b), (correlation, sse) in group_means.items():
+        print(f"{a:<12}{b:<12}{correlation:>10.3f}{sse:>14.4g}")
+    print(f"Average-linkage clusters of {len(indices)} grouped composites vs imagery groups: ARI {ari:.3f}")
+
+if __name__ == "__main__":
+    main()
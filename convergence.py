@@ -0,0 +1,125 @@
+#convergence.py
+
+import numpy as np
+from genetic_algorithm import calculate_similarity
+
+class ConvergenceMonitor:
+    """Track per-generation convergence metrics incrementally, one trial at a time"""
+
+    def __init__(self, target_array=None, stim_size=16, entropy_bins=16):
+        """Initialise running sums for a stim_size x stim_size population"""
+        self.stim_size = stim_size
+        self.entropy_bins = entropy_bins
+        self.target_array = None
+        if target_array is not None:
+            # Resize the target once instead of on every similarity call
+            self.target_array = self._resize_target(target_array)
+        self.history = []
+        self.reset()
+
+    def _resize_target(self, target_array):
+        """Match the target to the stimulus size (same resizing as calculate_similarity)"""
+        if target_array.shape == (self.stim_size, self.stim_size):
+            return target_array.astype(float)
+        from PIL import Image
+        img = Image.fromarray(target_array)
+        img = img.resize((self.stim_size, self.stim_size), Image.NEAREST)
+        return np.array(img).astype(float)
+
+    def reset(self):
+        """Clear the running sums at the start of a generation"""
+        n_pixels = self.stim_size * self.stim_size
+        self.n_stimuli = 0
+        self.pixel_sum = np.zeros(n_pixels, dtype=float)
+        self.sq_norm_sum = 0.0
+        self.bin_counts = np.zeros((n_pixels, self.entropy_bins), dtype=np.int64)
+        self.n_selected = 0
+        self.similarity_sum = 0.0
+
+    def update(self, stimuli_arrays, selected_array=None):
+        """Add one trial's stimuli (and the selected stimulus) to the running sums"""
+        stack = np.asarray(stimuli_arrays).reshape(len(stimuli_arrays), -1)
+        values = stack.astype(float)
+
+        # Sums needed for the mean pairwise squared distance
+        self.n_stimuli += stack.shape[0]
+        self.pixel_sum += values.sum(axis=0)
+        self.sq_norm_sum += float(np.einsum('ij,ij->', values, values))
+
+        # Per-pixel histograms of quantised grey levels for the entropy
+        bins = (stack.astype(np.int64) * self.entropy_bins) // 256
+        flat_index = np.arange(stack.shape[1]) * self.entropy_bins + bins
+        self.bin_counts += np.bincount(
+            flat_index.ravel(), minlength=self.bin_counts.size
+        ).reshape(self.bin_counts.shape)
+
+        if selected_array is not None and self.target_array is not None:
+            self.similarity_sum += float(calculate_similarity(selected_array, self.target_array))
+            self.n_selected += 1
+
+    def mean_pairwise_distance(self):
+        """Mean squared Euclidean distance between all pairs of stimuli seen so far"""
+        n = self.n_stimuli
+        if n < 2:
+            return 0.0
+        mean_sq_norm = self.sq_norm_sum / n
+        centroid_sq_norm = float(np.dot(self.pixel_sum, self.pixel_sum)) / (n * n)
+        return 2.0 * n / (n - 1) * (mean_sq_norm - centroid_sq_norm)
+
+    def pixel_entropy(self):
+        """Mean per-pixel Shannon entropy (bits) of the quantised grey levels"""
+        if self.n_stimuli == 0:
+            return 0.0
+        p = self.bin_counts / self.n_stimuli
+        with np.errstate(divide='ignore', invalid='ignore'):
+            terms = np.where(p > 0, p * np.log2(p), 0.0)
+        return float(-terms.sum(axis=1).mean())
+
+    def target_similarity(self):
+        """Mean similarity between selected stimuli and the target (lower is more similar)"""
+        if self.n_selected == 0:
+            return None
+        return self.similarity_sum / self.n_selected
+
+    def end_generation(self, generation):
+        """Store the metrics for a finished generation and reset the running sums"""
+        metrics = {
+            'generation': generation,
+            'selected_target_similarity': self.target_similarity(),
+            'mean_pairwise_distance': self.mean_pairwise_distance(),
+            'pixel_entropy': self.pixel_entropy()
+        }
+        self.history.append(metrics)
+        self.reset()
+        return metrics
+
+    def log_generation(self, exp_handler, metrics):
+        """Write a generation summary row through the experiment handler"""
+        exp_handler.addData('trial_type', 'generation_summary')
+        for key, value in metrics.items():
+            exp_handler.addData(key, value)
+        exp_handler.nextEntry()
+
+    def should_stop(self, patience=2, min_improvement=0.01, min_generations=3,
+                    min_entropy=None):
+        """Early-stopping rule based on the stored generation history
+
+        Stops when the selected-vs-target similarity has improved by less than
+        min_improvement (relative) for `patience` generations, or when the pixel
+        entropy has collapsed below min_entropy.
+        """
+        if len(self.history) < max(min_generations, 1):
+            return False
+
+        if min_entropy is not None and self.history[-1]['pixel_entropy'] < min_entropy:
+            return True
+
+        similarities = [m['selected_target_similarity'] for m in self.history]
+        if len(similarities) <= patience or any(s is None for s in similarities[-patience - 1:]):
+            return False
+
+        best_before = min(similarities[:-patience])
+        recent_best = min(similarities[-patience:])
+        if best_before == 0:
+            return True
+        return (best_before - recent_best) / best_before < min_improvement
@@ -1,28 +1,33 @@
 import os
 import numpy as np
-import pandas as pd
 from PIL import Image, ImageOps
-import csv
-from datetime import datetime
+from shared_storage import SharedStore
 
 class ParticipantDataManager:
     """Class to manage all data saving operations for a participant"""
     
-    def __init__(self, participant_id):
-        """Initialize the data manager with participant ID and create folder structure"""
+    def __init__(self, participant_id, participant_dir=None, store=None):
+        """Initialize the data manager with participant ID and create folder structure
+        
+        Pass an existing participant_dir to keep writing into it (e.g. when resuming).
+        All files are written through `store` (a SharedStore; by default unbuffered
+        atomic writes under the working directory).
+        """
         self.participant_id = participant_id
-        self.timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        self.participant_dir = self._setup_participant_folders()
+        self.store = store if store is not None else SharedStore()
+        if participant_dir is not None:
+            # participant_<id>_<YYYYmmdd>_<HHMMSS>: reuse the original timestamp
+            self.timestamp = '_'.join(os.path.basename(os.path.normpath(participant_dir)).split('_')[-2:])
+        else:
+            self.timestamp = None
+        self.participant_dir = self._setup_participant_folders(participant_dir)
+        self.run_id = os.path.basename(os.path.normpath(self.participant_dir))
         
-    def _setup_participant_folders(self):
+    def _setup_participant_folders(self, participant_dir=None):
         """Create folder structure for a participant's data"""
-        # Create main participant directory
-        base_dir = os.path.join(os.getcwd(), 'participant_images')
-        if not os.path.exists(base_dir):
-            os.makedirs(base_dir)
-        
-        # Create participant-specific directory
-        participant_dir = os.path.join(base_dir, f'participant_{self.participant_id}_{self.timestamp}')
+        # Create participant-specific directory; the store makes its name unique across stations
+        if participant_dir is None:
+            participant_dir, self.timestamp = self.store.create_participant_dir(self.participant_id)
         if not os.path.exists(participant_dir):
             os.makedirs(participant_dir)
         
@@ -58,18 +63,15 @@ class ParticipantDataManager:
         img = Image.fromarray(array)
         #img = ImageOps.exif_transpose(img)  # Handle EXIF orientation - does not work Pillow & PsychoPy have diff coordinate systems
         img = img.transpose(Image.FLIP_TOP_BOTTOM)  # Explicitly flip vertically
-        img.save(png_path)
+        self.store.write_image(png_path, img, 'PNG')
         
         # Save as TIFF
         tiff_path = os.path.join(self.participant_dir, 'tiff', f'{filename_base}.tiff')
-        img.save(tiff_path)
+        self.store.write_image(tiff_path, img, 'TIFF')
         
         # Save as CSV
         csv_path = os.path.join(self.participant_dir, 'csv', f'{filename_base}.csv')
-        with open(csv_path, 'w', newline='') as csvfile:
-            writer = csv.writer(csvfile)
-            for row in array:
-                writer.writerow(row)
+        self.store.write_csv(csv_path, array.copy())
         
         return {
             'png': png_path,
@@ -101,18 +103,15 @@ class ParticipantDataManager:
         png_path = os.path.join(composites_dir, f'{filename_base}.png')
         img = Image.fromarray(composite_array)
         img = img.transpose(Image.FLIP_TOP_BOTTOM)  # Explicitly flip vertically
-        img.save(png_path)
+        self.store.write_image(png_path, img, 'PNG')
         
         # Save as TIFF
         tiff_path = os.path.join(composites_dir, f'{filename_base}.tiff')
-        img.save(tiff_path)
+        self.store.write_image(tiff_path, img, 'TIFF')
         
         # Save as CSV
         csv_path = os.path.join(composites_dir, f'{filename_base}.csv')
-        with open(csv_path, 'w', newline='') as csvfile:
-            writer = csv.writer(csvfile)
-            for row in composite_array:
-                writer.writerow(row)
+        self.store.write_csv(csv_path, composite_array.copy())
         
         return {
             'png': png_path,
@@ -129,11 +128,12 @@ class ParticipantDataManager:
         filename = f"{self.participant_id}_G{generation}_T{trial}_grid.png"
         filepath = os.path.join(stimuli_grid_dir, filename)
         
-        # Capture the window content
-        win.getMovieFrame()
+        # Capture the window content (taken back off the window's movie frame list)
+        frame = win.getMovieFrame()
+        win.movieFrames.pop()
         
         # Save the captured frame
-        win.saveMovieFrames(filepath)
+        self.store.write_image(filepath, frame, 'PNG')
         
         return filepath
     
@@ -148,11 +148,8 @@ class ParticipantDataManager:
             filename = f"{self.participant_id}_{phase}_T{trial}_stim{i}.csv"
             filepath = os.path.join(csv_dir, filename)
             
-            with open(filepath, 'w', newline='') as csvfile:
-                writer = csv.writer(csvfile)
-                # Write the array data
-                for row in stim_array:
-                    writer.writerow(row)
+            # Write the array data
+            self.store.write_csv(filepath, stim_array.copy())
             
             csv_files.append(filepath)
         
@@ -160,9 +157,17 @@ class ParticipantDataManager:
         meta_filename = f"{self.participant_id}_{phase}_T{trial}_metadata.csv"
         meta_filepath = os.path.join(csv_dir, meta_filename)
         
-        with open(meta_filepath, 'w', newline='') as csvfile:
-            writer = csv.writer(csvfile)
-            writer.writerow(['participant_id', 'phase', 'trial', 'timestamp', 'num_stimuli'])
-            writer.writerow([self.participant_id, phase, trial, self.timestamp, len(stimuli_arrays)])
+        self.store.write_csv(meta_filepath, [
+            ['participant_id', 'phase', 'trial', 'timestamp', 'num_stimuli'],
+            [self.participant_id, phase, trial, self.timestamp, len(stimuli_arrays)]
+        ])
         
-        return csv_files
\ No newline at end of file
+        return csv_files
+    
+    def flush(self):
+        """Wait until every buffered write has reached disk"""
+        self.store.flush()
+    
+    def update_run(self, **fields):
+        """Record run progress (status, generation...) in the shared run index, if there is one"""
+        self.store.update_run(self.run_id, **fields)
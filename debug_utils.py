@@ -25,8 +25,7 @@ Return when you press Enter or Escape
 """
 from psychopy import event, visual, core
 import numpy as np
-import json
-import os
+from layout_utils import layouts
 
 def debug_element(win, element, name="element", element_index=0, total_elements=1):
     """Show debug info for an element and allow position/size adjustments with navigation"""
@@ -103,7 +102,7 @@ def debug_element(win, element, name="element", element_index=0, total_elements=
         elif 'left' in keys:
             element.pos = (element.pos[0] - step_size, element.pos[1])
         elif 'right' in keys:
-            element.pos = (element.pos[0] + step_step, element.pos[1])
+            element.pos = (element.pos[0] + step_size, element.pos[1])
         elif 'equal' in keys or 'plus' in keys:
             if hasattr(element, 'size'):
                 element.setSize((element.size[0] + size_step, element.size[1] + size_step))
@@ -117,54 +116,12 @@ def debug_element(win, element, name="element", element_index=0, total_elements=
             outline.width = element.size[0]
             outline.height = element.size[1]
 
-def save_layout(elements_dict, filename="layout.json"):
-    """Save element positions and sizes to a JSON file"""
-    layout = {}
-    for name, element in elements_dict.items():
-        # Convert positions and sizes to serializable format
-        pos = [float(element.pos[0]), float(element.pos[1])] if hasattr(element, 'pos') else None
-        size = [float(element.size[0]), float(element.size[1])] if hasattr(element, 'size') else None
-        
-        layout[name] = {
-            "pos": pos,
-            "size": size
-        }
-    
-    with open(filename, 'w') as f:
-        json.dump(layout, f, indent=2)
-    
-    print(f"Layout saved to {filename}")
-
-def load_layout(elements_dict, filename="layout.json"):
-    """Load element positions and sizes from a JSON file"""
-    if not os.path.exists(filename):
-        print(f"Layout file {filename} not found")
-        return False
-    
-    try:
-        with open(filename, 'r') as f:
-            layout = json.load(f)
-        
-        for name, element in elements_dict.items():
-            if name in layout:
-                if layout[name]["pos"] and hasattr(element, 'pos'):
-                    element.pos = tuple(layout[name]["pos"])
-                if layout[name]["size"] and hasattr(element, 'size'):
-                    element.setSize(tuple(layout[name]["size"]))
-        
-        print(f"Layout loaded from {filename}")
-        return True
-    except Exception as e:
-        print(f"Error loading layout: {e}")
-        return False
-
 def debug_ui_section(win, elements_dict, section_name):
     """Debug all elements in a section with navigation and save their layout"""
     print(f"Debugging {section_name} UI elements")
     
-    # Try to load existing layout first
-    layout_file = f"{section_name}_layout.json"
-    loaded = load_layout(elements_dict, layout_file)
+    # Start from the saved layout, if there is one
+    loaded = layouts.apply(section_name, elements_dict)
     
     # Convert dictionary to list for ordered navigation
     element_names = list(elements_dict.keys())
@@ -187,12 +144,12 @@ def debug_ui_section(win, elements_dict, section_name):
             current_index -= 1
         elif result == "save":
             # Save the layout and exit
-            save_layout(elements_dict, layout_file)
+            layouts.save(section_name, elements_dict)
             return True
         elif result == "cancel":
             print("Debugging canceled")
             return False
     
     # If we've gone through all elements
-    save_layout(elements_dict, layout_file)
+    layouts.save(section_name, elements_dict)
     return True
\ No newline at end of file
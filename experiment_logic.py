@@ -1,95 +1,182 @@
 #experiment_logic.py
 
-from psychopy import event, core
-from stimuli import generate_noise_pattern, create_image_from_array
-from genetic_algorithm import filter_selection, generate_offspring, ideal_observer_select
-from ui_components import create_text_screen, create_stimuli_grid, show_message
+from psychopy import visual, event, core
+from stimuli import create_image_from_array
+from genetic_algorithm import (filter_selection, filter_top_k, ideal_observer_select, ideal_observer_rank, rank_weights,
+                               marked_selection)
+from ui_components import create_text_screen, create_stimuli_grid, show_message, apply_saved_layout
 from data_saving import ParticipantDataManager
+from session_state import SessionState
+from basis import load_basis
+from checkpoint import save_checkpoint
 from experiment_setup import params
+from tracing import tracer
+from metrics import metrics
 import numpy as np
 
-# Global variables for tracking experiment state
-current_session = 1
-current_generation = 0
-current_parents = []
-next_generation_parents = []
-current_batches = None
-current_batch_index = 0
+def filter_and_record(state, data_manager, stimuli_arrays, chosen_ids, weights, generation, trial, ranked=True):
+    """Filter the chosen stimuli, save the trial's selection and keep the filtered ones as parents
 
-#data saving bits
-participant_selections = {}  # Dictionary to store all selections by generation
-participant_dir = None
-timestamp = None
+    chosen_ids are best first when ranked; unranked marks are in click order
+    and the selection is their mean.
+    """
+    chosen_arrays = [stimuli_arrays[i] for i in chosen_ids]
+    selected_array = marked_selection(chosen_arrays, ranked)
+    non_chosen_arrays = [array for j, array in enumerate(stimuli_arrays) if j not in chosen_ids]
 
-def run_trial(win, exp_handler, generation, trial, target_stim, target_array=None, debug_mode=False, data_manager=None):
-    """Run a single trial of the main experiment"""
-    global current_batch_index, next_generation_parents, participant_selections
+    # Apply filtering to the selection, or to every marked stimulus with the trial's weighted contrast
+    with tracer.span('filter_selection', generation=generation, trial=trial):
+        if len(chosen_ids) == 1:
+            filtered_arrays = [filter_selection(chosen_arrays[0], non_chosen_arrays)]
+        else:
+            filtered_arrays = list(filter_top_k(chosen_arrays, weights, non_chosen_arrays))
+
+    # Save the selection image
+    with tracer.span('selection_write', generation=generation, trial=trial), metrics.disk_write():
+        data_manager.save_selection_image(selected_array, generation, trial)
+
+    # Track the selection for composites and add the parents for next generation
+    state.record_selections(stimuli_arrays, selected_array, filtered_arrays, weights)
+
+def _mark_top_k(win, mouse, target_label, target_stim, stim_objects, k, ranked=True):
+    """Let the participant mark k stimuli (click again to unmark) and submit with space; returns (ids best first, rt)"""
+    prompt = (f"Click your {k} best matches, best first. Click again to unmark. Press SPACE to continue."
+              if ranked else f"Click your {k} best matches. Click again to unmark. Press SPACE to continue.")
+    instructions = visual.TextStim(win, text=prompt, pos=(0, -0.45), height=0.03, color='black', wrapWidth=1.8)
+    frames = [visual.Rect(win, width=stim.size[0] * 1.15, height=stim.size[1] * 1.15, pos=stim.pos,
+                          lineColor='red', lineWidth=4, fillColor=None) for stim in stim_objects]
+    labels = [visual.TextStim(win, text='', pos=(stim.pos[0] + stim.size[0] * 0.4, stim.pos[1] + stim.size[1] * 0.4),
+                              height=0.04, color='red', bold=True) for stim in stim_objects]
+    marked = []
+    was_pressed = False
+    event.clearEvents(eventType='keyboard')
+    start_time = core.getTime()
+
+    while True:
+        target_label.draw()
+        target_stim.draw()
+        for i, stim in enumerate(stim_objects):
+            stim.draw()
+            if i in marked:
+                frames[i].draw()
+                if ranked:
+                    labels[i].text = str(marked.index(i) + 1)
+                    labels[i].draw()
+        instructions.color = 'black' if len(marked) == k else 'grey'
+        instructions.draw()
+        win.flip()
+        metrics.frame()
+
+        # Toggle the stimulus under the mouse on each new click
+        pressed = mouse.getPressed()[0]
+        if pressed and not was_pressed:
+            mouse_pos = mouse.getPos()
+            for i, stim in enumerate(stim_objects):
+                if stim.contains(mouse_pos):
+                    if i in marked:
+                        marked.remove(i)
+                    elif len(marked) < k:
+                        marked.append(i)
+                    break
+        was_pressed = pressed
+
+        keys = event.getKeys(['space', 'return', 'escape'])
+        if 'escape' in keys:
+            win.close()
+            core.quit()
+        if keys and len(marked) == k:
+            return marked, core.getTime() - start_time
+
+def run_trial(win, exp_handler, state, trial, target_stim, target_array=None, debug_mode=False, data_manager=None):
+    """Run a single trial of the main experiment for the given SessionState
+
+    With state.selections_per_trial = k > 1 the k best stimuli are marked
+    (by clicking, or by the ideal observer) and all become weighted parents.
+    k and the ranking come from the state, so a resumed session keeps the
+    settings it was checkpointed with.
+    """
+    generation = state.generation
+    k = state.selections_per_trial
+    ranked = state.rank_selections
+    weights = rank_weights(k, ranked)
     
-    # Get stimuli for this trial
-    if generation == 0:
-        # First generation: random noise patterns
-        stimuli_arrays = [generate_noise_pattern() for _ in range(12)]
-    else:
-        # Later generations: use offspring from previous generation
-        stimuli_arrays = current_batches[current_batch_index]
-        current_batch_index += 1
+    metrics.set_position(state.session_num, generation, trial)
+    
+    # Get stimuli for this trial (noise in generation 0, otherwise offspring)
+    with tracer.span('stimulus_generation', generation=generation, trial=trial):
+        stimuli_arrays = state.next_stimuli()
 
     # Create PsychoPy stimuli from arrays
-    stim_objects = [create_image_from_array(win, array) for array in stimuli_arrays]
+    with tracer.span('imagestim_construction', generation=generation, trial=trial):
+        stim_objects = [create_image_from_array(win, array) for array in stimuli_arrays]
     
+    if params["mode"] == "ideal_observer" and target_array is None:
+        raise ValueError("Target array must be provided for ideal observer mode")
+
     # Show target
-    target_label = create_text_screen(win, "Target Letter", pos=(0, 0.7), height=0.05)
+    if params["mode"] == "ideal_observer":
+        target_label = create_text_screen(win, "Target Letter (Ideal Observer Mode)", pos=(0, 0.8), height=0.05)
+    else:
+        target_label = create_text_screen(win, "Target Letter", pos=(0, 0.7), height=0.05)
+    target_stim.pos = (0, 0.35)
+    
+    # Position stimuli in a grid
+    positions = create_stimuli_grid(stim_objects)
+    for i, stim in enumerate(stim_objects):
+        stim.pos = positions[i]
+
+    # Create a dictionary of all UI elements
+    ui_elements = {
+        "target_label": target_label,
+        "target_stim": target_stim
+    }
+    
+    # Add stimuli to the UI elements dictionary
+    for i, stim in enumerate(stim_objects):
+        ui_elements[f"stimulus_{i}"] = stim
 
-    # If in debug mode, allow adjusting the UI elements
+    # If in debug mode, allow adjusting the UI elements, otherwise use the saved layout
     if debug_mode:
         from debug_utils import debug_ui_section
         
-        # Create a dictionary of all UI elements
-        ui_elements = {
-            "target_label": target_label,
-            "target_stim": target_stim
-        }
-        
-        # Add stimuli to the UI elements dictionary
-        for i, stim in enumerate(stim_objects):
-            ui_elements[f"stimulus_{i}"] = stim
-        
         # Debug the UI elements
         debug_ui_section(win, ui_elements, "main_task")
+    else:
+        apply_saved_layout("main_task", ui_elements)
     
     # If in ideal observer mode, select the most similar stimulus automatically
     if params["mode"] == "ideal_observer":
-        if target_array is None:
-            raise ValueError("Target array must be provided for ideal observer mode")
-            
-        # Show target
-        target_label = create_text_screen(win, "Target Letter (Ideal Observer Mode)", pos=(0, 0.8), height=0.05)
-
-        target_stim.pos = (0, 0.35)
         target_stim.draw()
-        
-        # Position stimuli in a grid
-        positions = create_stimuli_grid(stim_objects)
-        for i, stim in enumerate(stim_objects):
-            stim.pos = positions[i]
+        for stim in stim_objects:
             stim.draw()
         
-        win.flip()
+        with tracer.span('first_flip', generation=generation, trial=trial):
+            win.flip()
+        metrics.frame()
 
         # Save the stimuli grid
         participant_id = exp_handler.extraInfo['participant']
-        grid_filepath = data_manager.save_stimuli_grid(win, generation, trial)
-        csv_filepaths = data_manager.save_stimuli_as_csv(stimuli_arrays, f"G{generation}", trial)
+        with tracer.span('grid_capture', generation=generation, trial=trial), metrics.disk_write():
+            grid_filepath = data_manager.save_stimuli_grid(win, generation, trial)
+        with tracer.span('stimuli_csv_write', generation=generation, trial=trial), metrics.disk_write():
+            csv_filepaths = data_manager.save_stimuli_as_csv(stimuli_arrays, f"G{generation}", trial)
 
         # Simulate thinking time
         core.wait(0.2)
         
-        # Select stimulus using ideal observer
-        selected_id = ideal_observer_select(stimuli_arrays, target_array)
-        selected_array = stimuli_arrays[selected_id]
+        # Select stimulus (or mark the top k, best first) using ideal observer
+        if k > 1:
+            chosen_ids = ideal_observer_rank(stimuli_arrays, target_array, k)
+            if not ranked:
+                # Unranked marks come in no particular order, as a participant's clicks would
+                chosen_ids = [int(i) for i in state.rng.permutation(chosen_ids)]
+        else:
+            chosen_ids = [ideal_observer_select(stimuli_arrays, target_array)]
+        selected_id = chosen_ids[0] if ranked else None  # Unranked: no single stimulus is the selection
         
-        # Highlight selected stimulus
-        stim_objects[selected_id].setSize((0.22, 0.22))  # Make selected stimulus larger
+        # Highlight selected stimuli
+        for i in chosen_ids:
+            stim_objects[i].setSize((0.22, 0.22))  # Make selected stimulus larger
         
         # Redraw everything with selected stimulus highlighted
         target_label.draw()
@@ -100,35 +187,23 @@ def run_trial(win, exp_handler, generation, trial, target_stim, target_array=Non
         win.flip()
         core.wait(0.2)  # Show selection briefly
         
-        # Get non-selected arrays for filtering
-        non_selected_arrays = [stimuli_arrays[j] for j in range(12) if j != selected_id]
-        
-        # Apply filtering to selected image
-        filtered_array = filter_selection(selected_array, non_selected_arrays)
-
-        # Save the selection image
-        data_manager.save_selection_image(selected_array, generation, trial)
-
-        # Track the selection for composites
-        participant_selections[generation].append(selected_array)
-        
-        # Add to parents for next generation
-        if not next_generation_parents:
-            next_generation_parents = []
-        
-        if filtered_array is not None:
-            next_generation_parents.append(filtered_array)
+        filter_and_record(state, data_manager, stimuli_arrays, chosen_ids, weights, generation, trial, ranked)
         
         # Save data
-        exp_handler.addData('session', 1)
+        exp_handler.addData('session', state.session_num)
         exp_handler.addData('generation', generation)
         exp_handler.addData('trial', trial)
         exp_handler.addData('selected_id', selected_id)
+        if k > 1:
+            exp_handler.addData('selected_ids', chosen_ids)
+            exp_handler.addData('selection_weights', [float(w) for w in weights])
         exp_handler.addData('rt', 0.2)  # Simulated reaction time
         exp_handler.addData('mode', 'ideal_observer')
+        exp_handler.addData('genome_resolution', state.resolution)
         exp_handler.addData('stimuli_grid', grid_filepath)
         exp_handler.addData('stimuli_csv', csv_filepaths)
         exp_handler.nextEntry()
+        metrics.trial_completed()
         
         # Wait between trials
         core.wait(params["inter_trial_interval"])
@@ -136,21 +211,20 @@ def run_trial(win, exp_handler, generation, trial, target_stim, target_array=Non
 
     # Manual mode - rest of the function as before
     
-    target_stim.pos = (0, 0.35)
     target_stim.draw()
-    
-    # Position stimuli in a grid
-    positions = create_stimuli_grid(stim_objects)
-    for i, stim in enumerate(stim_objects):
-        stim.pos = positions[i]
+    for stim in stim_objects:
         stim.draw()
     
-    win.flip()
+    with tracer.span('first_flip', generation=generation, trial=trial):
+        win.flip()
+    metrics.frame()
 
     # Save the stimuli grid
     participant_id = exp_handler.extraInfo['participant']
-    grid_filepath = data_manager.save_stimuli_grid(win, generation, trial)
-    csv_filepaths = data_manager.save_stimuli_as_csv(stimuli_arrays, f"G{generation}", trial)
+    with tracer.span('grid_capture', generation=generation, trial=trial), metrics.disk_write():
+        grid_filepath = data_manager.save_stimuli_grid(win, generation, trial)
+    with tracer.span('stimuli_csv_write', generation=generation, trial=trial), metrics.disk_write():
+        csv_filepaths = data_manager.save_stimuli_as_csv(stimuli_arrays, f"G{generation}", trial)
 
     # Wait for mouse click on a stimulus
     mouse = event.Mouse(visible=True, win=win)
@@ -161,6 +235,10 @@ def run_trial(win, exp_handler, generation, trial, target_stim, target_array=Non
     while any(mouse.getPressed()):
         core.wait(0.01)
     
+    if k > 1:
+        chosen_ids, reaction_time = _mark_top_k(win, mouse, target_label, target_stim, stim_objects, k, ranked)
+        clicked = True
+    
     while not clicked:
         # Redraw everything on each frame
         target_label.draw()
@@ -192,43 +270,14 @@ def run_trial(win, exp_handler, generation, trial, target_stim, target_array=Non
             stim.draw()
 
         win.flip()
+        metrics.frame()
         
         # Check for clicks
         if mouse.getPressed()[0]:  # Left mouse button pressed
             for i, stim in enumerate(stim_objects):
                 if stim.contains(mouse_pos):
-                    selected_id = i
-                    selected_array = stimuli_arrays[i]
+                    chosen_ids = [i]
                     reaction_time = core.getTime() - start_time
-                    
-                    # Get non-selected arrays for filtering
-                    non_selected_arrays = [stimuli_arrays[j] for j in range(12) if j != i]
-                    
-                    # Apply filtering to selected image
-                    filtered_array = filter_selection(selected_array, non_selected_arrays)
-
-                    #save the selection image
-                    data_manager.save_selection_image(selected_array, generation, trial)
-
-                    #track the selection for composites
-                    participant_selections[generation].append(selected_array)
-                    
-                    # Add to parents for next generation
-                    if not next_generation_parents:
-                        next_generation_parents = []
-                    
-                    if filtered_array is not None:
-                        next_generation_parents.append(filtered_array)
-                    
-                    # Save data
-                    exp_handler.addData('session', 1)
-                    exp_handler.addData('generation', generation)
-                    exp_handler.addData('trial', trial)
-                    exp_handler.addData('selected_id', selected_id)
-                    exp_handler.addData('rt', reaction_time)
-                    exp_handler.addData('stimuli_grid', grid_filepath)
-                    exp_handler.nextEntry()
-                    
                     clicked = True
                     break
             
@@ -236,30 +285,60 @@ def run_trial(win, exp_handler, generation, trial, target_stim, target_array=Non
             win.close()
             core.quit()
 
+    selected_id = chosen_ids[0] if ranked else None  # Unranked: no single stimulus is the selection
+    tracer.instant('response', generation=generation, trial=trial, rt=reaction_time)
+    metrics.observe_rt(reaction_time)
+    
+    filter_and_record(state, data_manager, stimuli_arrays, chosen_ids, weights, generation, trial, ranked)
+    
+    # Save data
+    exp_handler.addData('session', state.session_num)
+    exp_handler.addData('generation', generation)
+    exp_handler.addData('trial', trial)
+    exp_handler.addData('selected_id', selected_id)
+    if k > 1:
+        exp_handler.addData('selected_ids', chosen_ids)
+        exp_handler.addData('selection_weights', [float(w) for w in weights])
+    exp_handler.addData('rt', reaction_time)
+    exp_handler.addData('genome_resolution', state.resolution)
+    exp_handler.addData('stimuli_grid', grid_filepath)
+    exp_handler.addData('stimuli_csv', csv_filepaths)
+    exp_handler.nextEntry()
+    metrics.trial_completed()
+
     # Wait for mouse button release before continuing to next trial
     core.wait(params['inter_trial_interval'])
     while any(mouse.getPressed()):
         core.wait(0.01)
 
 
-def run_session(win, exp_handler, session_num, target_stim, target_array=None, debug_mode=False, data_manager=None):
-    """Run a complete session of the experiment"""
-    global current_session, current_generation, current_parents
-    global next_generation_parents, current_batches, current_batch_index
-    global participant_selections
-    
-    # Initialize session variables
-    current_session = session_num
-    current_parents = []
-    next_generation_parents = []
-    current_batches = None
-    current_batch_index = 0
+def run_session(win, exp_handler, session_num, target_stim, target_array=None, debug_mode=False, data_manager=None,
+                seed=None, checkpoint_file=None, resume=None, checkpoint_extra=None):
+    """Run a complete session of the experiment and return its SessionState
+
+    If checkpoint_file is given the state is checkpointed after every trial.
+    resume=(state, next_trial) continues a session restored from a checkpoint.
+    """
+    if resume is not None:
+        state, resume_trial = resume
+        start_generation = state.generation
+    else:
+        basis = None
+        if params.get('stimulus_basis'):
+            basis = load_basis(params['stimulus_basis'], params['stim_size'], params.get('basis_components', 36))
+        state = SessionState(session_num, params['generations'], params['stim_size'], target_array, seed,
+                             params.get('resolution_schedule'), params.get('adaptive_mutation', False), basis,
+                             params.get('selections_per_trial', 1), params.get('rank_selections', True))
+        start_generation, resume_trial = 0, None
+    last_generation = params['generations'] - 1
     
-    # Initialize participant selections tracking
-    participant_selections = {gen: [] for gen in range(12)}
+    def checkpoint(next_trial):
+        if checkpoint_file is not None:
+            with tracer.span('checkpoint', generation=state.generation, trial=next_trial), metrics.disk_write():
+                save_checkpoint(checkpoint_file, state, next_trial, checkpoint_extra)
     
     # Show session start message
-    if params["mode"] == "manual":
+    if params["mode"] == "manual" and resume is None:
         session_text = f"""
         Starting Session {session_num}
         
@@ -268,42 +347,71 @@ def run_session(win, exp_handler, session_num, target_stim, target_array=None, d
         In each trial, you will see 12 different patterns.
         Select the pattern that best matches your target.
         """
+        if state.selections_per_trial > 1:
+            session_text = session_text.replace(
+                "Select the pattern that best matches your target.",
+                f"Mark the {state.selections_per_trial} patterns that best match your target,"
+                + (" best first," if state.rank_selections else "")
+                + " then press SPACE.")
         show_message(win, session_text)
     
     # Run all generations for this session
-    for gen in range(params['generations']):
-        current_generation = gen
-        
-        # If not first generation, prepare offspring
-        if gen > 0:
-            # Use parents from previous generation
-            current_parents = next_generation_parents
-            next_generation_parents = []
-            
-            # Generate offspring
-            current_batches = generate_offspring(current_parents)
-            current_batch_index = 0
+    for gen in range(start_generation, params['generations']):
+        if resume_trial is not None and gen == start_generation:
+            # Resumed mid-generation: offspring and composites were restored/saved already
+            first_trial = resume_trial
+        else:
+            # If not first generation, generate offspring from the previous generation's parents
+            with tracer.span('offspring_generation', generation=gen, parents=len(state.next_generation_parents)):
+                state.start_generation(gen)
             
             # Create and save composite for the previous generation
-            if participant_selections[gen-1]:
-                composite = data_manager.create_composite_image(participant_selections[gen-1])
-                data_manager.save_composite_image(composite, gen-1)
+            if gen > 0 and state.selections[gen-1]:
+                with tracer.span('composite_write', generation=gen-1):
+                    composite = data_manager.create_composite_image(state.selections[gen-1])
+                    data_manager.save_composite_image(composite, gen-1)
+            
+            first_trial = 0
+            checkpoint(first_trial)
         
         # Run all trials for this generation
-        for trial in range(12):  # 12 trials per generation
-            run_trial(win, exp_handler, gen, trial, target_stim, target_array, debug_mode, data_manager)
+        for trial in range(first_trial, 12):  # 12 trials per generation
+            run_trial(win, exp_handler, state, trial, target_stim, target_array, debug_mode, data_manager)
+            checkpoint(trial + 1)
+        
+        # Log convergence metrics for this generation
+        generation_metrics = state.convergence.end_generation(gen)
+        if state.mutation is not None:
+            generation_metrics.update(mutation_rate=state.mutation.rate, mutation_sigma=state.mutation.sigma)
+        state.convergence.log_generation(exp_handler, generation_metrics)
+        
+        # Write this generation's trace spans and buffered files at the generation boundary
+        tracer.flush()
+        with tracer.span('store_flush', generation=gen), metrics.disk_write():
+            data_manager.flush()
+        data_manager.update_run(generation=gen)
+        
+        # Stop early once the population has converged
+        if params["early_stopping"] and state.convergence.should_stop(
+                patience=params["convergence_patience"],
+                min_improvement=params["convergence_min_improvement"],
+                min_generations=params["convergence_min_generations"],
+                min_entropy=params["convergence_min_entropy"]):
+            print(f"Converged after generation {gen}, stopping early")
+            last_generation = gen
+            break
     
     # Create and save composite for the last generation
-    if participant_selections[11]:
-        composite = data_manager.create_composite_image(participant_selections[11])
-        data_manager.save_composite_image(composite, 11)
+    if state.selections[last_generation]:
+        composite = data_manager.create_composite_image(state.selections[last_generation])
+        data_manager.save_composite_image(composite, last_generation)
     
     # Create and save mega-composite of all selections
-    all_selections = []
-    for gen in range(12):
-        all_selections.extend(participant_selections[gen])
+    all_selections = state.all_selections(last_generation)
     
     if all_selections:
         mega_composite = data_manager.create_composite_image(all_selections)
         data_manager.save_composite_image(mega_composite)
-
+    data_manager.flush()
+    
+    return state
@@ -1,6 +1,5 @@
 #Experiment_setup.py
 
-from psychopy import visual, core, data, event, gui, logging
 import os
 from datetime import datetime
 
@@ -8,11 +7,31 @@ from datetime import datetime
 params = {
     "generations": 12,
     "trials_per_gen": 12,
+    "selections_per_trial": 1, # Top-k trials: mark the k best stimuli, each becoming a weighted parent (1: single click)
+    "rank_selections": True, # In top-k trials, weight marks by click order (best first) instead of equally
     "sessions": 1,
     "stim_size": 16,
     "inter_trial_interval": 0.2,
     "mode" : "manual", # "manual" or "ideal_observer"
-    "debug": False
+    "debug": False,
+    "apply_layouts": True, # Use the layouts saved in debug mode (layout_settings/) in every mode
+    "tracing": False, # Record per-trial timing spans to <participant_dir>/traces
+    "metrics_port": None, # Serve live Prometheus metrics on 127.0.0.1:<port>/metrics (e.g. 9464)
+    "storage_root": None, # Shared drive holding data/ and participant_images/ for several stations (default: working directory)
+    "station": None, # Name of this station in the run index and temporary file names (default: host name)
+    "buffered_writes": False, # Write image/CSV files on a background thread, flushed at each generation boundary
+    "run_index": None, # Local SQLite run index written directly by this station (single-station setups only).
+                       # With storage_root set, stations append to <storage_root>/run_journal/ instead and
+                       # `python shared_storage.py --root <storage_root> --index <local path>` builds the index
+    "early_stopping": False, # Stop the session once the population has converged
+    "convergence_patience": 2, # Generations without improvement before stopping
+    "convergence_min_improvement": 0.01, # Relative target-similarity improvement that counts
+    "convergence_min_generations": 3,
+    "convergence_min_entropy": None, # Stop if mean pixel entropy (bits) drops below this
+    "adaptive_mutation": False, # Gaussian mutation tuned each generation to diversity and selection consistency
+    "resolution_schedule": None, # Coarse-to-fine genome, e.g. [(0, 4), (3, 8), (6, 16)] = (first generation, resolution)
+    "stimulus_basis": None, # Evolve basis coefficients instead of pixels: "gaussian", "gabor" or "pca"
+    "basis_components": 36 # Number of basis images (Gaussian grid is rounded to a square)
 }
 
 # Constants for filtering
@@ -22,21 +41,27 @@ THRESHOLD = 30
 PRESERVATION_FACTOR = 0.95
 NOISE_REDUCTION_FACTOR = 0.1
 
-def setup_experiment():
-    """Set up the experiment environment and return handlers"""
-    # Create experiment info dialog
-    exp_info = {
-        'participant': '',
-        'session': '001',
-        'fullscreen': True
-    }
+def setup_experiment(exp_info=None):
+    """Set up the experiment environment and return handlers
+    
+    If exp_info is given (e.g. when resuming a session) the info dialog is skipped.
+    """
+    from psychopy import visual, core, data, gui, logging
     
-    dlg = gui.DlgFromDict(dictionary=exp_info, sortKeys=False, title='Genetic Reverse Correlation Task')
-    if not dlg.OK:
-        core.quit()  # User pressed cancel
+    # Create experiment info dialog
+    if exp_info is None:
+        exp_info = {
+            'participant': '',
+            'session': '001',
+            'fullscreen': True
+        }
+        
+        dlg = gui.DlgFromDict(dictionary=exp_info, sortKeys=False, title='Genetic Reverse Correlation Task')
+        if not dlg.OK:
+            core.quit()  # User pressed cancel
     
     # Create data file name and path
-    data_dir = os.path.join(os.getcwd(), 'data')
+    data_dir = os.path.join(params.get('storage_root') or os.getcwd(), 'data')
     if not os.path.exists(data_dir):
         os.makedirs(data_dir)
     
@@ -1,92 +1,328 @@
 #genetic_algorithm.py
 
-from PIL import Image
 import numpy as np
-import random
 
-def crossbreed(parent1, parent2, stim_size=16):
+def random_index(rng, high):
+    """A uniform integer in [0, high) from a numpy Generator or the legacy np.random module"""
+    if hasattr(rng, 'integers'):
+        return rng.integers(0, high)
+    return rng.randint(0, high)
+
+def random_bytes(rng, shape):
+    """Uniform uint8 values from a numpy Generator or the legacy np.random module"""
+    if hasattr(rng, 'integers'):
+        return rng.integers(0, 256, shape, dtype=np.uint8)
+    return rng.randint(0, 256, shape, dtype=np.uint8)
+
+def crossbreed(parent1, parent2, stim_size=16, rng=None):
     """Crossbreed two parent images to create a child"""
-    child = np.zeros((stim_size, stim_size), dtype=np.uint8)
+    rng = np.random if rng is None else rng
+    shape = (stim_size, stim_size)
+    
+    # Uniform crossover: choose from either parent with 50% probability
+    child = np.where(rng.random(shape) < 0.5, parent1, parent2).astype(np.uint8)
     
-    # Uniform crossover with normalization
-    for i in range(stim_size):
-        for j in range(stim_size):
-            # Choose from either parent with 50% probability
-            if random.random() < 0.5:
-                gray_value = parent1[i, j]
-            else:
-                gray_value = parent2[i, j]
-            
-            # Mutation (1% chance)
-            if random.random() < 0.01:
-                gray_value = random.randint(0, 255)
-            
-            child[i, j] = gray_value
+    # Mutation (1% chance) to a uniform random grey value
+    mutate = rng.random(shape) < 0.01
+    child[mutate] = random_bytes(rng, int(mutate.sum()))
     
     return child
 
-def generate_offspring(parents, stim_size=16):
-    """Generate offspring from parents"""
-    if len(parents) < 2:
-        raise ValueError('Insufficient parents for breeding')
+def crossbreed_batch(parents, first, second, rng=None, mutation=None):
+    """Crossbreed parents[first[k]] with parents[second[k]] for every k in one vectorized step"""
+    rng = np.random if rng is None else rng
+    shape = (len(first),) + parents.shape[1:]
     
-    child_array = []
+    # Uniform crossover: choose from either parent with 50% probability
+    children = np.where(rng.random(shape) < 0.5, parents[first], parents[second]).astype(np.uint8)
     
-    # Create all possible parent combinations
-    for i in range(len(parents)):
-        for j in range(len(parents)):
-            child_array.append(crossbreed(parents[i], parents[j], stim_size))
+    if mutation is not None:
+        return mutation.mutate(children, rng)
     
-    # Shuffle all children
-    random.shuffle(child_array)
+    # Mutation (1% chance) to a uniform random grey value
+    mutate = rng.random(shape) < 0.01
+    children[mutate] = random_bytes(rng, int(mutate.sum()))
     
-    # Split into batches of 12 stimuli each
-    batches = []
-    for i in range(0, len(child_array), 12):
-        batch = child_array[i:i+12]
-        # Ensure each batch has exactly 12 stimuli
-        if len(batch) == 12:
-            batches.append(batch)
-    
-    return batches
+    return children
+
+# Standard deviation of uniform 0-255 noise, the diversity of a fresh population
+UNIFORM_STD = 255 / np.sqrt(12)
+
+def population_diversity(parents):
+    """Mean per-pixel standard deviation across a (..., n, H, W) parent pool, relative to uniform noise"""
+    parents = np.asarray(parents, dtype=np.float64)
+    return parents.std(axis=-3).mean(axis=(-2, -1)) / UNIFORM_STD
+
+def selection_consistency(composite, previous_composite):
+    """Correlation (clipped to 0-1) between this and last generation's composites, over the last two axes"""
+    if previous_composite is None:
+        return np.zeros(np.shape(composite)[:-2])
+    a = np.asarray(composite, dtype=np.float64)
+    b = np.asarray(previous_composite, dtype=np.float64)
+    a = a - a.mean(axis=(-2, -1), keepdims=True)
+    b = b - b.mean(axis=(-2, -1), keepdims=True)
+    norm = np.sqrt((a * a).sum(axis=(-2, -1)) * (b * b).sum(axis=(-2, -1)))
+    correlation = (a * b).sum(axis=(-2, -1)) / np.where(norm > 0, norm, 1.0)
+    return np.clip(correlation, 0.0, 1.0)
+
+def adaptive_mutation_schedule(diversity, consistency, base_rate=0.01, target_diversity=0.5,
+                               min_rate=0.002, max_rate=0.05, base_sigma=64.0, min_sigma=4.0):
+    """Mutation rate and Gaussian step size for the measured diversity and selection consistency
+
+    Rate scales up as the parent pool loses diversity (base_rate at target_diversity);
+    the step size shrinks as consecutive generations' selections agree.
+    """
+    diversity = np.asarray(diversity, dtype=np.float64)
+    consistency = np.asarray(consistency, dtype=np.float64)
+    rate = np.clip(base_rate * target_diversity / np.maximum(diversity, 1e-3), min_rate, max_rate)
+    sigma = np.maximum(base_sigma * (1.0 - consistency), min_sigma)
+    return rate, sigma
+
+def gaussian_mutation(children, rate, sigma, rng=None):
+    """Perturb each pixel with probability `rate` by N(0, sigma) grey levels, in place
+
+    rate and sigma may be scalars or arrays broadcasting against the leading axes of children.
+    """
+    rng = np.random if rng is None else rng
+    rate = np.asarray(rate, dtype=np.float64)
+    sigma = np.asarray(sigma, dtype=np.float64)
+    lead = children.ndim - rate.ndim
+    rate = rate.reshape(rate.shape + (1,) * lead)
+    sigma = sigma.reshape(sigma.shape + (1,) * lead)
+
+    mutate = rng.random(children.shape) < rate
+    steps = rng.normal(0.0, 1.0, int(mutate.sum())) * np.broadcast_to(sigma, children.shape)[mutate]
+    children[mutate] = np.clip(np.round(children[mutate] + steps), 0, 255).astype(np.uint8)
+    return children
+
+class AdaptiveMutation:
+    """Gaussian mutation whose rate and step size are re-tuned at the start of every generation"""
+
+    def __init__(self, base_rate=0.01, target_diversity=0.5, min_rate=0.002, max_rate=0.05,
+                 base_sigma=64.0, min_sigma=4.0):
+        self.settings = dict(base_rate=base_rate, target_diversity=target_diversity, min_rate=min_rate,
+                             max_rate=max_rate, base_sigma=base_sigma, min_sigma=min_sigma)
+        self.rate = base_rate
+        self.sigma = base_sigma
+        self.diversity = 1.0
+        self.consistency = 0.0
+
+    def update(self, parents, composite=None, previous_composite=None):
+        """Measure the new parent pool and selections and set this generation's rate and sigma"""
+        self.diversity = float(population_diversity(parents))
+        self.consistency = float(selection_consistency(composite, previous_composite)) if composite is not None else 0.0
+        rate, sigma = adaptive_mutation_schedule(self.diversity, self.consistency, **self.settings)
+        self.rate, self.sigma = float(rate), float(sigma)
+
+    def mutate(self, children, rng=None):
+        """Apply this generation's Gaussian mutation to a batch of children"""
+        return gaussian_mutation(children, self.rate, self.sigma, rng)
+
+def downsample_genome(arrays, resolution):
+    """Block-average the last two axes of full-size images down to a resolution x resolution genome"""
+    arrays = np.asarray(arrays)
+    size = arrays.shape[-1]
+    if resolution is None or resolution >= size:
+        return arrays
+    if size % resolution:
+        raise ValueError(f'Genome resolution {resolution} does not divide stimulus size {size}')
+    factor = size // resolution
+    blocks = arrays.reshape(arrays.shape[:-2] + (resolution, factor, resolution, factor))
+    return np.round(blocks.mean(axis=(-3, -1))).astype(np.uint8)
+
+def upsample_genome(genomes, stim_size):
+    """Expand the last two axes of coarse genomes to stim_size, each genome cell becoming a square block"""
+    factor = stim_size // genomes.shape[-1]
+    if factor == 1:
+        return genomes
+    return np.repeat(np.repeat(genomes, factor, axis=-2), factor, axis=-1)
+
+def genome_resolution(generation, schedule=None, stim_size=16):
+    """Resolution a generation evolves at under a coarse-to-fine schedule of (first_generation, resolution) pairs"""
+    resolution = stim_size
+    for first_generation, level in sorted(schedule or ()):
+        if generation >= first_generation:
+            resolution = level
+    return min(resolution, stim_size)
+
+class OffspringSource:
+    """Breed 12-stimulus batches lazily from a parent pool
+
+    Ordered parent pairs (self-pairs included, as in generate_offspring) are
+    sampled without replacement only when a batch is requested, so time and
+    memory scale with the number of trials run rather than with parents^2.
+    At most n^2 // batch_size batches are available, like the eager version.
+    With a coarse `resolution`, parents are block-averaged to that genome size
+    once, children are bred at that size and upsampled for display. With a
+    BasisBank `basis`, parents are projected to coefficient vectors once and
+    children are bred as coefficients and rendered in one matrix multiply.
+    With parent `weights` (top-k trials), pairs are drawn without replacement
+    with probability proportional to the product of their parents' weights.
+    """
+
+    def __init__(self, parents, stim_size=16, rng=None, batch_size=12, resolution=None, mutation=None,
+                 basis=None, weights=None):
+        if len(parents) < 2:
+            raise ValueError('Insufficient parents for breeding')
+        self.parents = np.asarray(parents, dtype=np.uint8)
+        self.stim_size = stim_size
+        self.resolution = resolution if resolution is not None and resolution < stim_size else None
+        self.mutation = mutation  # None for the fixed 1% uniform-replacement mutation
+        self.basis = basis
+        if basis is not None:
+            self.genomes = basis.project(self.parents)
+        else:
+            self.genomes = downsample_genome(self.parents, self.resolution)
+        self.rng = np.random if rng is None else rng
+        self.weights = None if weights is None else np.asarray(weights, dtype=np.float64)
+        if self.weights is not None and self.weights.shape != (len(parents),):
+            raise ValueError('Need one weight per parent')
+        self.batch_size = batch_size
+        self.n_pairs = len(parents) * len(parents)
+        self.n_batches = self.n_pairs // batch_size
+        self.batches_drawn = 0
+        self.drawn = set()     # Pair indices (i * n + j) already used
+        self.pending = None    # Shuffled remaining pairs once most have been drawn
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.batches_drawn >= self.n_batches:
+            raise StopIteration
+        return self.next_batch()
+
+    def _draw_pairs(self, count):
+        """Sample `count` unused pair indices"""
+        if self.pending is None and self.weights is not None:
+            # Weighted order of every unused pair at once: exponential keys divided by the pair weight,
+            # smallest first, is a weighted sample without replacement
+            remaining = np.setdiff1d(np.arange(self.n_pairs), np.fromiter(self.drawn, dtype=np.int64, count=len(self.drawn)))
+            pair_weights = np.outer(self.weights, self.weights).ravel()[remaining]
+            keys = -np.log1p(-self.rng.random(len(remaining))) / pair_weights
+            self.pending = list(remaining[np.argsort(keys, kind='stable')])
+
+        # Rejection sampling is cheap while few pairs are used; past half, shuffle the rest once
+        if self.pending is None and len(self.drawn) + count > self.n_pairs // 2:
+            remaining = np.setdiff1d(np.arange(self.n_pairs), np.fromiter(self.drawn, dtype=np.int64, count=len(self.drawn)))
+            self.pending = list(self.rng.permutation(remaining))
+        
+        if self.pending is not None:
+            pairs, self.pending = self.pending[:count], self.pending[count:]
+        else:
+            pairs = []
+            while len(pairs) < count:
+                k = int(random_index(self.rng, self.n_pairs))
+                if k not in self.drawn and k not in pairs:
+                    pairs.append(k)
+        
+        self.drawn.update(int(k) for k in pairs)
+        return np.asarray(pairs, dtype=np.int64)
+
+    def next_batch(self):
+        """Breed and return the next batch as a list of arrays"""
+        if self.batches_drawn >= self.n_batches:
+            raise ValueError('Offspring exhausted: no complete batch of children left')
+        pairs = self._draw_pairs(self.batch_size)
+        first, second = np.divmod(pairs, len(self.parents))
+        self.batches_drawn += 1
+        if self.basis is not None:
+            children = self.basis.crossbreed(self.genomes[first], self.genomes[second], self.rng)
+            return list(self.basis.render(children))
+        children = crossbreed_batch(self.genomes, first, second, self.rng, self.mutation)
+        return list(upsample_genome(children, self.stim_size))
+
+def generate_offspring(parents, stim_size=16, rng=None):
+    """Generate offspring from parents (every complete batch of 12, eagerly)"""
+    return list(OffspringSource(parents, stim_size, rng))
 
 def filter_selection(selected_data, non_selected_data_list, threshold=30, 
                     preservation_factor=0.95, noise_reduction_factor=0.1):
     """Filter the selected image using implementation three"""
     # Calculate average of non-selected images
-    avg_non_selected = np.zeros_like(selected_data, dtype=float)
-    for non_selected in non_selected_data_list:
-        avg_non_selected += non_selected
-    avg_non_selected /= len(non_selected_data_list)
+    avg_non_selected = np.mean(np.asarray(non_selected_data_list, dtype=float), axis=0)
     
-    # Apply filtering algorithm (implementation three)
-    filtered_data = np.zeros_like(selected_data, dtype=np.uint8)
+    return filter_selection_batch(selected_data, avg_non_selected, threshold,
+                                  preservation_factor, noise_reduction_factor)
+
+def rank_weights(k, ranked=True):
+    """Parent weights of a trial's k marked stimuli, best first: linear in rank (k, k-1 ... 1) or equal, summing to 1"""
+    weights = np.arange(k, 0, -1, dtype=np.float64) if ranked else np.ones(k)
+    return weights / weights.sum()
+
+def marked_selection(chosen, ranked=True):
+    """What a top-k trial contributes to composites: the best mark when ranked, else the mean of all marks
+
+    chosen is (..., k, H, W), best first when ranked; unranked marks carry
+    no order, so none of them stands for the trial on its own.
+    """
+    chosen = np.asarray(chosen)
+    if ranked:
+        return chosen[..., 0, :, :]
+    return np.rint(chosen.mean(axis=-3)).astype(np.uint8)
+
+def filter_top_k(chosen_list, weights, non_chosen_list, threshold=30,
+                 preservation_factor=0.95, noise_reduction_factor=0.1):
+    """Filter a trial's marked stimuli (best first) against the average of the unmarked ones"""
+    avg_non_chosen = np.mean(np.asarray(non_chosen_list, dtype=float), axis=0)
+
+    return filter_top_k_batch(np.asarray(chosen_list), weights, avg_non_chosen, threshold,
+                              preservation_factor, noise_reduction_factor)
+
+def filter_top_k_batch(chosen, weights, avg_non_chosen, threshold=30,
+                       preservation_factor=0.95, noise_reduction_factor=0.1):
+    """Implementation three for k marked stimuli per trial, with signal pixels found by a weighted contrast
+
+    chosen is (..., k, H, W), weights (..., k) or (k,) summing to 1 and
+    avg_non_chosen (..., H, W). A pixel counts as signal where the weighted
+    mean of the marked stimuli differs from the unmarked average by more than
+    threshold; there every marked stimulus is preserved, elsewhere each is
+    pulled towards the unmarked average. With k = 1 this is filter_selection_batch.
+    """
+    chosen_values = np.asarray(chosen, dtype=float)
+    avg_non_chosen = np.asarray(avg_non_chosen, dtype=float)[..., None, :, :]
+    weights = np.asarray(weights, dtype=float)
+    contrast = np.einsum('...k,...kij->...ij', weights, chosen_values)[..., None, :, :] - avg_non_chosen
+    difference = chosen_values - avg_non_chosen
+
+    new_values = np.where(
+        np.abs(contrast) > threshold,
+        np.round(chosen_values * preservation_factor),
+        np.round(chosen_values - (noise_reduction_factor * difference))
+    )
+
+    return np.clip(new_values, 0, 255).astype(np.uint8)
+
+def filter_selection_batch(selected_data, avg_non_selected, threshold=30,
+                           preservation_factor=0.95, noise_reduction_factor=0.1):
+    """Implementation three applied elementwise to any stack of selections and non-selected averages"""
+    selected_values = np.asarray(selected_data, dtype=float)
+    difference = selected_values - avg_non_selected
     
-    for i in range(selected_data.shape[0]):
-        for j in range(selected_data.shape[1]):
-            selected_value = selected_data[i, j]
-            avg_value = avg_non_selected[i, j]
-            difference = selected_value - avg_value
-            
-            if abs(difference) > threshold:
-                # For significant differences (potential signal features)
-                new_value = round(selected_value * preservation_factor)
-            else:
-                # For smaller differences (likely noise)
-                new_value = round(selected_value - (noise_reduction_factor * difference))
-            
-            # Ensure values stay within valid range [0,255]
-            filtered_data[i, j] = max(0, min(255, new_value))
+    # Significant differences (potential signal features) are preserved,
+    # smaller differences (likely noise) are pulled towards the average
+    new_values = np.where(
+        np.abs(difference) > threshold,
+        np.round(selected_values * preservation_factor),
+        np.round(selected_values - (noise_reduction_factor * difference))
+    )
     
-    return filtered_data
+    # Ensure values stay within valid range [0,255]
+    return np.clip(new_values, 0, 255).astype(np.uint8)
+
+def resize_target(target_array, shape):
+    """Resize the target to a stimulus shape with nearest-neighbour sampling"""
+    if target_array.shape == tuple(shape):
+        return target_array
+    from PIL import Image
+    img = Image.fromarray(target_array)
+    img = img.resize((shape[1], shape[0]), Image.NEAREST)
+    return np.array(img)
 
 def calculate_similarity(image_array, target_array):
     """Calculate similarity between an image and the target (lower is more similar)"""
     # Resize target if needed to match image dimensions
-    if image_array.shape != target_array.shape:
-        img = Image.fromarray(target_array)
-        img = img.resize((image_array.shape[1], image_array.shape[0]), Image.NEAREST)
-        target_array = np.array(img)
+    target_array = resize_target(target_array, image_array.shape)
     
     # Calculate mean squared error
     diff = image_array.astype(float) - target_array.astype(float)
@@ -94,20 +330,34 @@ def calculate_similarity(image_array, target_array):
 
 def ideal_observer_select(stimuli_arrays, target_array):
     """Simulate an ideal observer by selecting the stimulus most similar to target"""
-    similarities = []
-    
     # Resize target if needed to match stimuli dimensions
-    if stimuli_arrays[0].shape != target_array.shape:
-        from PIL import Image
-        img = Image.fromarray(target_array)
-        img = img.resize((stimuli_arrays[0].shape[1], stimuli_arrays[0].shape[0]), Image.NEAREST)
-        target_array = np.array(img)
-    
-    for stim_array in stimuli_arrays:
-        # Calculate mean squared error
-        diff = stim_array.astype(float) - target_array.astype(float)
-        similarity = np.sum(diff * diff)
-        similarities.append(similarity)
+    target_array = resize_target(target_array, stimuli_arrays[0].shape)
     
     # Return index of most similar stimulus (lowest difference)
-    return np.argmin(similarities)
\ No newline at end of file
+    return int(ideal_observer_select_batch(np.asarray(stimuli_arrays), target_array))
+
+def ideal_observer_rank(stimuli_arrays, target_array, k):
+    """Simulate an ideal observer marking the k stimuli most similar to the target, best first"""
+    target_array = resize_target(target_array, stimuli_arrays[0].shape)
+    return [int(i) for i in ideal_observer_rank_batch(np.asarray(stimuli_arrays), target_array, k)]
+
+def ideal_observer_rank_batch(stimuli, target_array, k):
+    """Indices of the k stimuli closest to the target along axis -3 of a (..., n, H, W) stack, closest first"""
+    similarities = _observer_distances(stimuli, target_array)
+    nearest = np.argpartition(similarities, k - 1, axis=-1)[..., :k]
+    order = np.argsort(np.take_along_axis(similarities, nearest, axis=-1), axis=-1, kind='stable')
+    return np.take_along_axis(nearest, order, axis=-1)
+
+def ideal_observer_select_batch(stimuli, target_array):
+    """Index of the stimulus closest to the target along axis -3 of a (..., n, H, W) stack"""
+    return np.argmin(_observer_distances(stimuli, target_array), axis=-1)
+
+def _observer_distances(stimuli, target_array):
+    """Squared distance to the target (up to a constant) of every stimulus in a (..., n, H, W) stack"""
+    # Sum of squared differences, computed as |x|^2 - 2 x.t (the |t|^2 term is constant).
+    # float32 is exact while every sum stays below 2^24 (true for 16x16 stimuli)
+    n_pixels = stimuli.shape[-1] * stimuli.shape[-2]
+    dtype = np.float32 if n_pixels * 255 * 255 < 2 ** 24 else np.float64
+    flat = stimuli.reshape(stimuli.shape[:-2] + (-1,)).astype(dtype)
+    target = target_array.reshape(-1).astype(dtype)
+    return np.einsum('...i,...i->...', flat, flat) - 2.0 * (flat @ target)
@@ -0,0 +1,247 @@
+#islands.py
+
+"""
+Island-model parallel GA for ideal-observer runs
+
+One simulated run is split into K island populations, each evolved by its
+own worker process from its own noise draws (a PopulationSimulator with one
+participant and a seed spawned from the run seed). After every generation
+each island publishes its filtered parents and their target errors into a
+shared-memory block; every `migration_interval` generations island i
+replaces its worst `migrants` parents with the best `migrants` of island
+i-1 (a ring). Results are written straight into shared memory as well, so
+nothing but the island index crosses a process boundary.
+
+The run's composite for a generation is the mean of every island's
+selections, i.e. K times the trials of a single population, which is what
+lowers the variance of the resulting image.
+
+processes=1 runs the islands in lockstep in this process, with identical
+results for the same seed.
+
+Usage: python islands.py [--islands 8] [--generations 12] [--interval 2] [--migrants 2] [--seed 0] [--repeats 5]
+"""
+
+import argparse
+import os
+import time
+from multiprocessing import get_context, shared_memory
+
+import numpy as np
+
+from simulator import PopulationSimulator
+from search_benchmark import generations_to_criterion
+
+class _SharedArrays:
+    """Named numpy arrays in one shared-memory block"""
+
+    def __init__(self, layout, name=None):
+        """layout: [(key, shape, dtype)]; name=None creates the block, otherwise attaches to it"""
+        self.layout = layout
+        offsets, size = [], 0
+        for _, shape, dtype in layout:
+            size = -(-size // 8) * 8  # Keep every array 8-byte aligned
+            offsets.append(size)
+            size += int(np.prod(shape)) * np.dtype(dtype).itemsize
+        self.owner = name is None
+        self.block = shared_memory.SharedMemory(name=name, create=self.owner, size=max(size, 1))
+        self.arrays = {key: np.ndarray(shape, dtype, buffer=self.block.buf, offset=offset)
+                       for (key, shape, dtype), offset in zip(layout, offsets)}
+        if self.owner:
+            for array in self.arrays.values():
+                array[...] = 0
+
+    def __getitem__(self, key):
+        return self.arrays[key]
+
+    def close(self):
+        self.arrays = {}
+        self.block.close()
+        if self.owner:
+            self.block.unlink()
+
+def _layout(n_islands, generations, trials, stim_size):
+    return [
+        ('parents', (n_islands, trials, stim_size, stim_size), np.uint8),
+        ('parent_errors', (n_islands, trials), np.float64),
+        ('selections', (n_islands, generations, trials, stim_size, stim_size), np.uint8),
+        ('similarity', (n_islands, generations), np.float64),
+        ('composites', (n_islands, generations, stim_size, stim_size), np.uint8),
+        ('seconds', (n_islands,), np.float64),
+    ]
+
+def parent_errors(parents, target):
+    """Squared-error sum of every parent against the target; (..., H, W) -> (...)"""
+    diff = parents.astype(np.float64) - target
+    return np.einsum('...ij,...ij->...', diff, diff)
+
+def migrate(parents, errors, island, migrants):
+    """New parents for `island`: its own, with the worst replaced by the best of island - 1"""
+    source = (island - 1) % len(parents)
+    own = parents[island].copy()
+    if migrants <= 0 or len(parents) < 2:
+        return own
+    best = np.argsort(errors[source], kind='stable')[:migrants]
+    worst = np.argsort(errors[island], kind='stable')[::-1][:migrants]
+    own[worst] = parents[source][best]
+    return own
+
+def _island_seeds(seed, n_islands):
+    return np.random.SeedSequence(seed).spawn(n_islands)
+
+class _Island:
+    """One island's simulator and its view of the shared arrays"""
+
+    def __init__(self, index, shared, target_array, generations, seed, simulator_kwargs):
+        self.index = index
+        self.shared = shared
+        self.simulator = PopulationSimulator(1, target_array, generations, seed=seed, **simulator_kwargs)
+
+    def step(self):
+        """Evolve one generation and publish its parents"""
+        sim = self.simulator
+        gen = sim.generation
+        sim.step()
+        self.shared['parents'][self.index] = sim.parents[0]
+        self.shared['parent_errors'][self.index] = parent_errors(sim.parents[0], sim.target)
+        self.shared['selections'][self.index, gen] = sim.selections[0, gen]
+        self.shared['similarity'][self.index, gen] = sim.similarity[0, gen]
+        self.shared['composites'][self.index, gen] = sim.composites[0, gen]
+
+    def receive(self, migrants):
+        """Take migrants from the neighbouring island (call once every island has published)"""
+        return migrate(self.shared['parents'], self.shared['parent_errors'], self.index, migrants)
+
+def _migration_due(gen, generations, interval):
+    return interval > 0 and (gen + 1) % interval == 0 and gen + 1 < generations
+
+def _run_worker(index, block_name, layout, barrier, target_array, generations, seed,
+                interval, migrants, simulator_kwargs):
+    """Worker process: evolve one island, meeting the others at the barrier every generation"""
+    shared = _SharedArrays(layout, block_name)
+    try:
+        start = time.perf_counter()
+        island = _Island(index, shared, target_array, generations, seed, simulator_kwargs)
+        for gen in range(generations):
+            island.step()
+            barrier.wait()  # Every island has published this generation's parents
+            if _migration_due(gen, generations, interval):
+                incoming = island.receive(migrants)
+                barrier.wait()  # Everyone has read before anyone publishes again
+                island.simulator.parents[0] = incoming
+        shared['seconds'][index] = time.perf_counter() - start
+    except BaseException:
+        barrier.abort()  # Release the other islands instead of leaving them waiting
+        raise
+    finally:
+        shared.close()
+
+def run_islands(target_array, n_islands=None, generations=12, migration_interval=2, migrants=2,
+                seed=None, processes=None, trials=12, stim_size=16, **simulator_kwargs):
+    """Evolve one run as n_islands populations (default: one per CPU) and return the combined results
+
+    processes=1 runs the islands in this process. Other simulator settings
+    (mutation_rate, resolution_schedule, basis...) are passed through.
+    """
+    n_islands = n_islands or os.cpu_count() or 1
+    processes = n_islands if processes is None else processes
+    if processes not in (1, n_islands):
+        raise ValueError("processes must be 1 or one per island")
+    if simulator_kwargs.get('top_k', 1) != 1:
+        raise ValueError("Islands exchange one parent per trial; top_k trials are not supported")
+    layout = _layout(n_islands, generations, trials, stim_size)
+    shared = _SharedArrays(layout)
+    seeds = _island_seeds(seed, n_islands)
+    simulator_kwargs = dict(simulator_kwargs, trials=trials, stim_size=stim_size)
+    try:
+        start = time.perf_counter()
+        if processes == 1:
+            _run_serial(shared, target_array, generations, seeds, migration_interval, migrants, simulator_kwargs)
+        else:
+            context = get_context()
+            barrier = context.Barrier(n_islands)
+            workers = [context.Process(target=_run_worker, name=f'island-{i}',
+                                       args=(i, shared.block.name, layout, barrier, target_array, generations,
+                                             seeds[i], migration_interval, migrants, simulator_kwargs))
+                       for i in range(n_islands)]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+            failed = [worker.name for worker in workers if worker.exitcode != 0]
+            if failed:
+                raise RuntimeError(f"Island workers failed: {', '.join(failed)}")
+        elapsed = time.perf_counter() - start
+
+        selections = shared['selections'].copy()
+        return {
+            'island_similarity': shared['similarity'].copy(),
+            'island_composites': shared['composites'].copy(),
+            'selections': selections,
+            # One run: every island's selections pooled per generation
+            'composites': selections.mean(axis=(0, 2)).astype(np.uint8),
+            'mega_composite': selections.reshape(-1, stim_size, stim_size).mean(axis=0).astype(np.uint8),
+            'best_similarity': shared['similarity'].min(axis=0),  # Best island per generation (a best-of-K sample)
+            'island_seconds': shared['seconds'].copy(),
+            'seconds': elapsed
+        }
+    finally:
+        shared.close()
+
+def _run_serial(shared, target_array, generations, seeds, interval, migrants, simulator_kwargs):
+    """All islands in this process, stepped in lockstep (same results as the worker processes)"""
+    islands = [_Island(i, shared, target_array, generations, seed, simulator_kwargs) for i, seed in enumerate(seeds)]
+    for gen in range(generations):
+        for island in islands:
+            start = time.perf_counter()
+            island.step()
+            shared['seconds'][island.index] += time.perf_counter() - start
+        if _migration_due(gen, generations, interval):
+            incoming = [island.receive(migrants) for island in islands]
+            for island, parents in zip(islands, incoming):
+                island.simulator.parents[0] = parents
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Island-model parallel GA for one ideal-observer run")
+    parser.add_argument('--islands', type=int, default=os.cpu_count())
+    parser.add_argument('--generations', type=int, default=12)
+    parser.add_argument('--interval', type=int, default=2, help="Generations between migrations (0: never)")
+    parser.add_argument('--migrants', type=int, default=2)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeats', type=int, default=5, help="Runs per configuration, for the variance")
+    args = parser.parse_args(argv)
+
+    from stimuli import create_target_s
+    from genetic_algorithm import resize_target
+    target_array, _ = create_target_s()
+    target = resize_target(target_array, (16, 16)).astype(np.float64)
+
+    # A single population is the baseline; its mean final composite error is the criterion.
+    # Every configuration is scored on the run's pooled composite, not on its best island
+    configurations = {
+        'single_population': dict(n_islands=1, processes=1),
+        f'{args.islands}_islands_isolated': dict(n_islands=args.islands, migration_interval=0),
+        f'{args.islands}_islands_migrating': dict(n_islands=args.islands, migration_interval=args.interval,
+                                                  migrants=args.migrants),
+    }
+    runs = {name: [run_islands(target_array, generations=args.generations, seed=args.seed + r, **settings)
+                   for r in range(args.repeats)]
+            for name, settings in configurations.items()}
+    composite_errors = {name: parent_errors(np.array([run['composites'] for run in results]), target)
+                        for name, results in runs.items()}
+    criterion = composite_errors['single_population'][:, -1].mean()
+
+    print(f"{args.repeats} runs each, {args.generations} generations, composite error criterion {criterion:.3g}")
+    print(f"{'configuration':<28}{'wall s':>9}{'reached':>9}{'gens to crit':>14}{'final error':>14}"
+          f"{'composite err sd':>18}")
+    for name, results in runs.items():
+        seconds = np.mean([run['seconds'] for run in results])
+        errors = composite_errors[name]
+        generations = generations_to_criterion(errors, criterion)
+        reached = generations[~np.isnan(generations)]
+        print(f"{name:<28}{seconds:>9.2f}{len(reached) / len(generations):>9.0%}"
+              f"{(np.mean(reached) if len(reached) else np.nan):>14.1f}"
+              f"{errors[:, -1].mean():>14.3g}{errors[:, -1].std():>18.3g}")
+
+if __name__ == "__main__":
+    main()
@@ -1,38 +1,170 @@
 #layout_utils.py
 
+"""
+Saved UI layouts
+
+Every section's layout (layout_settings/<section>_layout.json, written by the
+debug mode) is read once into the LayoutRegistry and compiled into
+name -> (pos, size) tuples, so applying it to a screen's elements on each
+trial is a dictionary lookup per element instead of a file read.
+Stimulus grid positions are precomputed once per grid shape.
+"""
+
+import glob
+import json
+import os
+from functools import lru_cache
+
+LAYOUT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'layout_settings')
+LAYOUT_SUFFIX = '_layout.json'
+
+def layout_path(section_name, layout_dir=LAYOUT_DIR):
+    """File a section's layout is saved to"""
+    return os.path.join(layout_dir, f"{section_name}{LAYOUT_SUFFIX}")
 
 def save_layout(elements_dict, filename="layout.json"):
     """Save element positions and sizes to a JSON file"""
-    import json
-    
     layout = {}
     for name, element in elements_dict.items():
+        # Convert positions and sizes to serializable format
+        pos = [float(element.pos[0]), float(element.pos[1])] if hasattr(element, 'pos') else None
+        size = [float(element.size[0]), float(element.size[1])] if hasattr(element, 'size') else None
+
         layout[name] = {
-            "pos": element.pos,
-            "size": element.size if hasattr(element, 'size') else None
+            "pos": pos,
+            "size": size
         }
-    
+
+    directory = os.path.dirname(filename)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
     with open(filename, 'w') as f:
-        json.dump(layout, f)
-    
+        json.dump(layout, f, indent=2)
+
     print(f"Layout saved to {filename}")
+    return layout
+
+def read_layout(filename):
+    """Read a layout JSON file and compile it, or return None if it is missing or unreadable"""
+    if not os.path.exists(filename):
+        return None
+    try:
+        with open(filename, 'r') as f:
+            return compile_layout(json.load(f))
+    except (OSError, ValueError, TypeError, KeyError, IndexError) as e:
+        print(f"Error loading layout {filename}: {e}")
+        return None
+
+def compile_layout(layout):
+    """Turn a saved layout into {name: (pos, size)} with tuples (or None) ready to assign"""
+    compiled = {}
+    for name, entry in layout.items():
+        pos = entry.get("pos")
+        size = entry.get("size")
+        compiled[name] = (
+            (float(pos[0]), float(pos[1])) if pos else None,
+            (float(size[0]), float(size[1])) if size else None
+        )
+
+    # Grid stimuli saved on top of each other or over the target are not a usable grid; keep the computed one
+    grid_positions = [entry[0] for name, entry in compiled.items() if name.startswith('stimulus_') and entry[0]]
+    if len(set(grid_positions)) < len(grid_positions) or _covers_target(compiled):
+        for name, (pos, size) in compiled.items():
+            if name.startswith('stimulus_'):
+                compiled[name] = (None, size)
+    return compiled
+
+def _overlaps(a, b):
+    """Whether two (pos, size) boxes overlap"""
+    (ax, ay), (aw, ah) = a
+    (bx, by), (bw, bh) = b
+    return abs(ax - bx) < (aw + bw) / 2 and abs(ay - by) < (ah + bh) / 2
+
+def _covers_target(compiled):
+    """Whether any saved grid stimulus would be drawn over a target image"""
+    targets = [entry for name, entry in compiled.items() if name.endswith('target_stim') and entry[0] and entry[1]]
+    return any(_overlaps(entry, target)
+               for name, entry in compiled.items() if name.startswith('stimulus_') and entry[0] and entry[1]
+               for target in targets)
+
+def apply_layout(elements_dict, compiled):
+    """Set the compiled positions and sizes on the elements that have an entry"""
+    for name, element in elements_dict.items():
+        entry = compiled.get(name)
+        if entry is None:
+            continue
+        pos, size = entry
+        if pos is not None:
+            element.pos = pos
+        # Text elements report their bounding box as size; only the height matters for them
+        if size is not None and hasattr(element, 'setSize') and not hasattr(element, 'text'):
+            element.setSize(size)
 
 def load_layout(elements_dict, filename="layout.json"):
     """Load element positions and sizes from a JSON file"""
-    import json
-    import os
-    
-    if not os.path.exists(filename):
+    compiled = read_layout(filename)
+    if compiled is None:
         print(f"Layout file {filename} not found")
-        return
-    
-    with open(filename, 'r') as f:
-        layout = json.load(f)
-    
-    for name, element in elements_dict.items():
-        if name in layout:
-            element.pos = layout[name]["pos"]
-            if hasattr(element, 'size') and layout[name]["size"]:
-                element.setSize(layout[name]["size"])
-    
+        return False
+    apply_layout(elements_dict, compiled)
     print(f"Layout loaded from {filename}")
+    return True
+
+@lru_cache(maxsize=None)
+def grid_positions(rows=3, cols=4, grid_width=0.8, grid_height=0.6, start_y=0.15):
+    """Positions of a rows x cols stimulus grid, row by row (computed once per shape)"""
+    # Calculate spacing between stimuli
+    x_spacing = grid_width / cols
+    y_spacing = grid_height / rows
+
+    # Calculate starting position (top-left of grid)
+    start_x = -grid_width / 2 + x_spacing / 2
+
+    return tuple(
+        (start_x + col * x_spacing, start_y - row * y_spacing)
+        for row in range(rows)
+        for col in range(cols)
+    )
+
+class LayoutRegistry:
+    """All saved section layouts, read from disk once and applied from memory"""
+
+    def __init__(self, layout_dir=LAYOUT_DIR):
+        self.layout_dir = layout_dir
+        self.sections = {}
+        self.loaded = False
+
+    def load(self):
+        """Read and compile every <section>_layout.json in the layout directory"""
+        self.sections = {}
+        for filename in sorted(glob.glob(os.path.join(self.layout_dir, f"*{LAYOUT_SUFFIX}"))):
+            section_name = os.path.basename(filename)[:-len(LAYOUT_SUFFIX)]
+            compiled = read_layout(filename)
+            if compiled is not None:
+                self.sections[section_name] = compiled
+        self.loaded = True
+        return self
+
+    def get(self, section_name):
+        """Compiled layout of a section, or None if it has never been saved"""
+        if not self.loaded:
+            self.load()
+        return self.sections.get(section_name)
+
+    def apply(self, section_name, elements_dict):
+        """Apply a section's saved layout to its elements; returns whether one existed"""
+        compiled = self.get(section_name)
+        if compiled is None:
+            return False
+        apply_layout(elements_dict, compiled)
+        return True
+
+    def save(self, section_name, elements_dict):
+        """Save the elements' current layout to disk and use it from now on"""
+        layout = save_layout(elements_dict, layout_path(section_name, self.layout_dir))
+        if not self.loaded:
+            self.load()
+        self.sections[section_name] = compile_layout(layout)
+
+# Process-wide registry used by the UI modules
+layouts = LayoutRegistry()
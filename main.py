@@ -12,16 +12,63 @@ from stimuli import create_target_s, create_training_target_j, create_target_s_s
 from ui_components import run_introduction, run_training_trials, show_break
 from experiment_logic import run_session
 from data_saving import ParticipantDataManager
+from shared_storage import open_store
+from tracing import tracer
+from metrics import metrics
+from layout_utils import layouts
+from checkpoint import TrialLog, checkpoint_path, trial_log_path, load_checkpoint
+import os
+import sys
 
-def main():
-    """Run the complete experiment"""
+def main(resume_from=None):
+    """Run the complete experiment
+    
+    resume_from: a checkpoint file or participant directory to continue a crashed session from
+    """
+    win = None
+    exp_handler = None
+    store = None
+    data_manager = None
+    completed = False
     try:
+        # Restore a crashed session before opening the window
+        resume = None
+        checkpoint_extra = {}
+        if resume_from is not None:
+            if os.path.isdir(resume_from):
+                resume_from = checkpoint_path(resume_from)
+            state, next_trial, checkpoint_extra = load_checkpoint(resume_from)
+            resume = (state, next_trial)
+            print(f"Resuming at generation {state.generation}, trial {next_trial}")
+        
         # Setup experiment
-        exp_handler, win, exp_info = setup_experiment()
+        exp_handler, win, exp_info = setup_experiment(checkpoint_extra.get('exp_info'))
+        
+        # Read every saved UI layout once, before the first screen
+        layouts.load()
         
         # Create data manager for this participant
         participant_id = exp_handler.extraInfo['participant']
-        data_manager = ParticipantDataManager(participant_id)
+        store = open_store(params)
+        data_manager = ParticipantDataManager(participant_id, checkpoint_extra.get('participant_dir'), store)
+        store.register_run(data_manager.run_id, participant_id=str(participant_id),
+                           participant_dir=data_manager.participant_dir,
+                           data_file=exp_handler.dataFileName, status='running')
+        if params.get("tracing", False):
+            tracer.configure(os.path.join(data_manager.participant_dir, 'traces'))
+        if params.get("metrics_port"):
+            metrics.set_participant(participant_id)
+            metrics.start(params["metrics_port"])
+        
+        # Append every trial row to a crash-safe log alongside the ExperimentHandler
+        exp_handler = TrialLog(exp_handler, trial_log_path(data_manager.participant_dir))
+        trial_log = exp_handler
+        metrics.register_gauge('write_queue_depth', 'Trial log rows not yet fsynced plus buffered file writes',
+                               lambda: trial_log.pending_sync + store.pending())
+        checkpoint_extra = {
+            'exp_info': dict(exp_info),
+            'participant_dir': data_manager.participant_dir
+        }
         
         # Check if in debug mode
         debug_mode = params.get("debug", False)
@@ -55,29 +102,50 @@ def main():
         target_stim = create_target_s_stim(win, target_display)
         training_target_stim = create_training_target_j_stim(win)
         
-        # Run introduction (skip in ideal observer mode)
-        if params["mode"] == "manual" and (not debug_mode or debug_section == 1):
+        # Run introduction (skip in ideal observer mode and when resuming)
+        if params["mode"] == "manual" and resume is None and (not debug_mode or debug_section == 1):
             run_introduction(win, training_target_stim, debug_mode)
             
         # Run training trials
-        if params["mode"] == "manual" and (not debug_mode or debug_section == 2):
+        if params["mode"] == "manual" and resume is None and (not debug_mode or debug_section == 2):
             run_training_trials(win, exp_handler, data_manager, debug_mode)
         
-        # Run main session
+        # Run main session, checkpointing after every trial
         if not debug_mode or debug_section == 3:
-            run_session(win, exp_handler, 1, target_stim, target_array, debug_mode, data_manager)
+            run_session(win, exp_handler, 1, target_stim, target_array, debug_mode, data_manager,
+                        checkpoint_file=checkpoint_path(data_manager.participant_dir),
+                        resume=resume, checkpoint_extra=checkpoint_extra)
         # Run rating task
         if params["mode"] == "manual" and (not debug_mode or debug_section == 4):
             from rating_task import run_rating_task
             run_rating_task(win, exp_handler, debug_mode)
+        completed = True
         
     except Exception as e:
         print(f"Error in experiment: {e}")
     finally:
         # Clean up
-        win.close()
+        tracer.flush()
+        metrics.stop()
+        if store is not None:
+            try:
+                store.flush()
+            except Exception as e:
+                completed = False
+                print(f"Error writing data files: {e}")
+            if data_manager is not None:
+                data_manager.update_run(status='completed' if completed else 'aborted')
+            store.close()
+        if isinstance(exp_handler, TrialLog):
+            exp_handler.close()
+        if win is not None:
+            win.close()
         core.quit()
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    # python main.py --resume <participant_dir or checkpoint file>
+    resume_from = None
+    if '--resume' in sys.argv:
+        resume_from = sys.argv[sys.argv.index('--resume') + 1]
+    main(resume_from)
\ No newline at end of file
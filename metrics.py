@@ -0,0 +1,204 @@
+#metrics.py
+
+"""
+Live session metrics over a localhost HTTP endpoint
+
+The trial loop records into a SessionMetrics object with plain attribute
+writes and bounded deque appends (a microsecond or two each); nothing is
+aggregated until the endpoint is scraped. start() serves the current values
+in Prometheus text format at http://127.0.0.1:<port>/metrics from a daemon
+thread:
+  - current session / generation / trial and seconds since the last trial
+  - rolling reaction-time quantiles
+  - frame (flip) interval quantiles while a trial is on screen
+  - disk write latency quantiles and the write-queue depth
+
+Point a Prometheus agent (or curl) on each booth at its own port to spot a
+stalled machine.
+"""
+
+import socket
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+PREFIX = 'pareidolia'
+QUANTILES = (0.5, 0.9, 0.99)
+
+class _Rolling:
+    """Last `window` observations plus all-time sum and count (as a Prometheus summary needs)"""
+    __slots__ = ('values', 'total', 'count')
+
+    def __init__(self, window):
+        self.values = deque(maxlen=window)
+        self.total = 0.0
+        self.count = 0
+
+    def add(self, value):
+        self.values.append(value)
+        self.total += value
+        self.count += 1
+
+class _DiskWrite:
+    """Context manager timing one disk write into the metrics"""
+    __slots__ = ('metrics', 'start')
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.write_latencies.add(time.perf_counter() - self.start)
+        return False
+
+class SessionMetrics:
+    """Cheap-to-update live values of the running session, rendered on demand"""
+
+    def __init__(self, window=200, frame_window=2000):
+        self.station = socket.gethostname()
+        self.participant = ''
+        self.session = 0
+        self.generation = 0
+        self.trial = 0
+        self.trials_completed = 0
+        self.last_trial_time = None
+        self.started = time.time()
+        self.reaction_times = _Rolling(window)
+        self.frame_intervals = _Rolling(frame_window)
+        self.write_latencies = _Rolling(window)
+        self.last_frame = None
+        self.gauges = {}  # name -> (help, callable) evaluated at scrape time
+        self.server = None
+        self.thread = None
+
+    def set_participant(self, participant):
+        """Label every metric with the participant id"""
+        self.participant = str(participant)
+
+    def set_position(self, session, generation, trial):
+        """Record where the session is; also restarts frame-interval timing for the new trial"""
+        self.session = session
+        self.generation = generation
+        self.trial = trial
+        self.last_frame = None
+
+    def frame(self):
+        """Call after each win.flip() of a trial to record the interval since the previous flip"""
+        now = time.perf_counter()
+        if self.last_frame is not None:
+            self.frame_intervals.add(now - self.last_frame)
+        self.last_frame = now
+
+    def observe_rt(self, seconds):
+        """Record a participant reaction time"""
+        self.reaction_times.add(seconds)
+
+    def trial_completed(self):
+        """Count a finished trial"""
+        self.trials_completed += 1
+        self.last_trial_time = time.time()
+        self.last_frame = None
+
+    def disk_write(self):
+        """`with metrics.disk_write(): ...` times a write into the disk latency window"""
+        return _DiskWrite(self)
+
+    def register_gauge(self, name, help_text, read):
+        """Expose read() (called at scrape time) as the gauge <prefix>_<name>"""
+        self.gauges[name] = (help_text, read)
+
+    def render(self):
+        """Current metrics in Prometheus text exposition format"""
+        labels = f'station="{_escape(self.station)}",participant="{_escape(self.participant)}"'
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append(f"# HELP {PREFIX}_{name} {help_text}")
+            lines.append(f"# TYPE {PREFIX}_{name} {kind}")
+            for suffix, extra, value in samples:
+                label_text = labels + (',' + extra if extra else '')
+                lines.append(f"{PREFIX}_{name}{suffix}{{{label_text}}} {_format(value)}")
+
+        def summary(name, help_text, rolling):
+            # Quantiles over the rolling window, sum and count over the whole process
+            values = np.asarray(list(rolling.values), dtype=np.float64)
+            samples = [('', f'quantile="{q}"', np.quantile(values, q) if len(values) else float('nan'))
+                       for q in QUANTILES]
+            samples += [('_sum', '', rolling.total), ('_count', '', rolling.count)]
+            metric(name, 'summary', help_text, samples)
+
+        since_last = time.time() - (self.last_trial_time or self.started)
+        metric('session', 'gauge', 'Current session number', [('', '', self.session)])
+        metric('generation', 'gauge', 'Current generation', [('', '', self.generation)])
+        metric('trial', 'gauge', 'Current trial within the generation', [('', '', self.trial)])
+        metric('trials_completed_total', 'counter', 'Trials finished in this process',
+               [('', '', self.trials_completed)])
+        metric('seconds_since_last_trial', 'gauge', 'Seconds since the last trial finished (or since start)',
+               [('', '', since_last)])
+        summary('reaction_time_seconds', 'Reaction times (quantiles over a rolling window)', self.reaction_times)
+        summary('frame_interval_seconds', 'Intervals between flips on trial screens (rolling quantiles)',
+                self.frame_intervals)
+        summary('disk_write_seconds', 'Disk write latencies (rolling quantiles)', self.write_latencies)
+        for name, (help_text, read) in list(self.gauges.items()):
+            try:
+                value = read()
+            except Exception:
+                value = float('nan')
+            metric(name, 'gauge', help_text, [('', '', value)])
+        return '\n'.join(lines) + '\n'
+
+    def start(self, port=9464):
+        """Serve /metrics on 127.0.0.1:<port> from a daemon thread"""
+        if self.server is not None:
+            return self.server.server_address[1]
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/metrics', '/'):
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass  # Keep scrapes out of the experiment console
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, name='metrics-server', daemon=True)
+        self.thread.start()
+        print(f"Metrics at http://127.0.0.1:{self.server.server_address[1]}/metrics")
+        return self.server.server_address[1]
+
+    def stop(self):
+        """Shut the endpoint down"""
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+            self.thread = None
+
+def _escape(value):
+    """Escape a Prometheus label value"""
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format(value):
+    """Prometheus sample value"""
+    value = float(value)
+    if np.isnan(value):
+        return 'NaN'
+    return repr(value) if not value.is_integer() else str(int(value))
+
+# Process-wide metrics used by the experiment modules
+metrics = SessionMetrics()
@@ -0,0 +1,141 @@
+#search_benchmark.py
+
+"""
+Ideal-observer benchmark of GA search strategies
+
+Runs the tensorized simulator once per strategy (same seed, same target) and
+reports how many generations each needs before a participant's composite
+(the mean of a generation's selections) reaches a target error, and what
+that costs in participant minutes. The criterion defaults to the mean
+composite error the baseline strategy reaches in its final generation.
+
+Errors are squared-error sums against the target, so lower is better. The
+composite is the criterion rather than the best-of-12 selection similarity,
+which is lower by construction for coarse genomes (fewer independent pixels)
+and for averaged unranked marks; that similarity is still reported. In top-k
+strategies the observer marks k stimuli per trial; their trials are charged
+SECONDS_PER_MARK for every extra mark, so participant minutes stay comparable.
+
+Usage: python search_benchmark.py [--participants 200] [--generations 12] [--seed 0]
+                                  [--strategies full_resolution coarse_to_fine] [--criterion 3.4e6]
+"""
+
+import argparse
+import time
+
+import numpy as np
+
+from simulator import simulate_participants
+from basis import load_basis
+
+# Simulator settings per strategy; the first one is the baseline
+STRATEGIES = {
+    'full_resolution': {},
+    'coarse_to_fine': {'resolution_schedule': [(0, 4), (3, 8), (6, 16)]},
+    'coarse_to_fine_8': {'resolution_schedule': [(0, 8), (4, 16)]},
+    'adaptive_mutation': {'adaptive_mutation': {}},
+    'gaussian_basis': {'basis': ('gaussian', 36)},
+    'gabor_basis': {'basis': ('gabor', 0)},
+    'pca_basis': {'basis': ('pca', 32)},
+    'top_2_ranked': {'top_k': 2},
+    'top_3_ranked': {'top_k': 3},
+    'top_3_unranked': {'top_k': 3, 'ranked': False}
+}
+
+SECONDS_PER_TRIAL = 3.0  # Rough manual-mode trial duration used for participant minutes
+SECONDS_PER_MARK = 1.5  # Extra time for each additional stimulus marked in a top-k trial
+
+def generations_to_criterion(similarity, criterion):
+    """First generation (1-based count) at which each participant's similarity is <= criterion, NaN if never"""
+    reached = similarity <= criterion
+    counts = reached.argmax(axis=1).astype(np.float64) + 1
+    counts[~reached.any(axis=1)] = np.nan
+    return counts
+
+def composite_errors(composites, target):
+    """Squared-error sum between each participant's composite and the target, per generation; (P, G)"""
+    diff = composites.astype(np.float64) - target
+    return np.einsum('pgij,pgij->pg', diff, diff)
+
+def composite_error(composites, target):
+    """Squared-error sum between each participant's final-generation composite and the target"""
+    return composite_errors(composites[:, -1:], target)[:, 0]
+
+def run_strategies(strategies, n_participants, target_array, generations=12, seed=0, **kwargs):
+    """Simulate every strategy with the same seed; returns {name: (results, seconds)}"""
+    runs = {}
+    for name in strategies:
+        start = time.perf_counter()
+        settings = {**kwargs, **STRATEGIES[name]}
+        if 'basis' in settings:
+            settings['basis'] = load_basis(settings['basis'][0], 16, settings['basis'][1])
+        results = simulate_participants(n_participants, target_array, generations, seed=seed, **settings)
+        runs[name] = (results, time.perf_counter() - start)
+    return runs
+
+def summarize(runs, target_array, criterion=None, trials=12, seconds_per_trial=SECONDS_PER_TRIAL,
+              seconds_per_mark=SECONDS_PER_MARK):
+    """Per-strategy generations-to-criterion and final quality, relative to the first strategy"""
+    names = list(runs)
+    target = target_array.astype(np.float64)
+    errors = {name: composite_errors(results['composites'], target) for name, (results, _) in runs.items()}
+    if criterion is None:
+        criterion = float(errors[names[0]][:, -1].mean())
+
+    rows = []
+    for name in names:
+        results, seconds = runs[name]
+        counts = generations_to_criterion(errors[name], criterion)
+        median = float(np.nanmedian(counts)) if np.isfinite(counts).any() else float('nan')
+        trial_seconds = seconds_per_trial + (STRATEGIES.get(name, {}).get('top_k', 1) - 1) * seconds_per_mark
+        rows.append({
+            'strategy': name,
+            'reached': float(np.isfinite(counts).mean()),
+            'median_generations': median,
+            'median_trials': median * trials,
+            'participant_minutes': median * trials * trial_seconds / 60,
+            'final_similarity': float(results['similarity'][:, -1].mean()),
+            'final_composite_error': float(errors[name][:, -1].mean()),
+            'seconds': seconds
+        })
+    return criterion, rows
+
+def print_summary(criterion, rows):
+    """Print the summary table"""
+    baseline = rows[0]['median_generations']
+    baseline_minutes = rows[0]['participant_minutes']
+    print(f"Criterion: composite error <= {criterion:.0f}")
+    print(f"{'strategy':<20} {'reached':>8} {'gens':>6} {'saved':>6} {'trials':>7} {'minutes':>8} {'vs base':>8} "
+          f"{'final sim':>10} {'composite':>10} {'sim s':>6}")
+    for row in rows:
+        saved = baseline - row['median_generations']
+        print(f"{row['strategy']:<20} {row['reached']:>7.0%} {row['median_generations']:>6.1f} {saved:>+6.1f} "
+              f"{row['median_trials']:>7.0f} "
+              f"{row['participant_minutes']:>8.1f} {row['participant_minutes'] - baseline_minutes:>+8.1f} "
+              f"{row['final_similarity']:>10.0f} "
+              f"{row['final_composite_error']:>10.0f} {row['seconds']:>6.2f}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare GA search strategies with simulated ideal observers")
+    parser.add_argument('--participants', type=int, default=200)
+    parser.add_argument('--generations', type=int, default=12)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--strategies', nargs='+', choices=list(STRATEGIES), default=list(STRATEGIES))
+    parser.add_argument('--criterion', type=float, default=None,
+                        help="Target composite error (default: the first strategy's final-generation mean)")
+    parser.add_argument('--seconds-per-trial', type=float, default=SECONDS_PER_TRIAL)
+    parser.add_argument('--seconds-per-mark', type=float, default=SECONDS_PER_MARK,
+                        help="Extra seconds per additional stimulus marked in top-k trials")
+    args = parser.parse_args(argv)
+
+    from stimuli import create_target_s
+    from genetic_algorithm import resize_target
+    target_array, _ = create_target_s()
+
+    runs = run_strategies(args.strategies, args.participants, target_array, args.generations, args.seed)
+    criterion, rows = summarize(runs, resize_target(target_array, (16, 16)), args.criterion,
+                                seconds_per_trial=args.seconds_per_trial, seconds_per_mark=args.seconds_per_mark)
+    print_summary(criterion, rows)
+
+if __name__ == "__main__":
+    main()
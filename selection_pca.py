@@ -0,0 +1,269 @@
+#selection_pca.py
+
+"""
+Streaming PCA over every participant's selections
+
+Selections are read one participant folder at a time (from compact.npz when
+the folder has been compacted, otherwise from its csv/ copies) and folded
+into running sums: the pixel sum and the pixel scatter matrix (d x d for
+d = stim_size^2 pixels) for the PCA, plus each participant's per-generation
+selection sums. The PCA is exact: the components are the eigenvectors of
+the accumulated covariance, identical whatever order the participants
+arrive in.
+
+Each run also keeps the selections it contributed (uint8, d bytes each)
+and a signature of its source files. A folder that has changed since it was
+folded in (a session analysed mid-run, or resumed after a crash into the
+same folder) has its old contribution subtracted exactly and is re-added.
+
+Because projection is linear, a participant's loadings (mean component
+scores of all their selections) and per-generation trajectory (mean scores
+per generation) follow from their stored sums, so both are recomputed
+against the current components whenever new participants are added.
+
+The state is checkpointed to <out>/selection_pca_state.npz; rerunning only
+reads participant folders it has not seen or whose files have changed.
+
+Usage: python selection_pca.py [--images-dir participant_images] [--components 10] [--out selection_pca]
+"""
+
+import argparse
+import csv
+import glob
+import io
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from compact_images import CONTAINER_FILE, load_selections, participant_from_dir
+from shared_storage import atomic_write
+
+OUTPUT_DIR = 'selection_pca'
+STATE_FILE = 'selection_pca_state.npz'
+
+class SelectionPCA:
+    """Running pixel moments of all selections, with per-participant per-generation sums"""
+
+    def __init__(self, stim_size=16, generations=12):
+        self.stim_size = stim_size
+        self.generations = generations
+        d = stim_size * stim_size
+        self.n = 0
+        self.pixel_sum = np.zeros(d)
+        self.scatter = np.zeros((d, d))
+        # run id -> {'participant', 'sums': (G, d), 'counts': (G,), 'selections': (n, d) uint8,
+        #            'generations': (n,), 'signature': source signature or None}
+        self.participants = {}
+
+    def add(self, run_id, participant, selections, generations, signature=None):
+        """Fold one participant folder's selections into the state, replacing what the run added before
+
+        Returns False if the run is already in the state with exactly these selections.
+        """
+        selections = np.asarray(selections, dtype=np.uint8).reshape(len(selections), -1)
+        generations = np.asarray(generations, dtype=np.int64)
+        if len(selections) and (generations.min() < 0 or generations.max() >= self.generations):
+            raise ValueError(f"{run_id}: generation outside 0..{self.generations - 1}")
+        old = self.participants.get(run_id)
+        if old is not None:
+            if np.array_equal(old['selections'], selections) and np.array_equal(old['generations'], generations):
+                old['signature'] = signature
+                return False
+            self.remove(run_id)
+        flat = selections.astype(np.float64)
+        self.n += len(flat)
+        self.pixel_sum += flat.sum(axis=0)
+        self.scatter += flat.T @ flat
+        sums = np.zeros((self.generations, flat.shape[1]))
+        np.add.at(sums, generations, flat)
+        self.participants[run_id] = {'participant': participant, 'sums': sums,
+                                     'counts': np.bincount(generations, minlength=self.generations),
+                                     'selections': selections, 'generations': generations, 'signature': signature}
+        return True
+
+    def remove(self, run_id):
+        """Subtract a run's contribution (exact: every term is an integer-valued float64 sum)"""
+        entry = self.participants.pop(run_id)
+        flat = entry['selections'].astype(np.float64)
+        self.n -= len(flat)
+        self.pixel_sum -= flat.sum(axis=0)
+        self.scatter -= flat.T @ flat
+
+    @property
+    def mean(self):
+        return self.pixel_sum / max(self.n, 1)
+
+    def components(self, n_components=10):
+        """(components (k, d), explained variance (k,), explained variance ratio (k,)) of all selections so far"""
+        if self.n < 2:
+            raise ValueError("Need at least two selections for a PCA")
+        covariance = (self.scatter - self.n * np.outer(self.mean, self.mean)) / (self.n - 1)
+        variances, vectors = np.linalg.eigh(covariance)
+        order = np.argsort(variances)[::-1][:n_components]
+        components = vectors[:, order].T
+        # Fix each component's sign (largest pixel weight positive) so outputs are stable across updates
+        largest = components[np.arange(len(components)), np.abs(components).argmax(axis=1)]
+        components *= np.where(largest < 0, -1.0, 1.0)[:, None]
+        variances = np.clip(variances[order], 0.0, None)
+        return components, variances, variances / max(np.trace(covariance), np.finfo(float).tiny)
+
+    def loadings(self, components):
+        """{run id: mean component scores of all that participant's selections}"""
+        result = {}
+        for run_id, entry in self.participants.items():
+            count = entry['counts'].sum()
+            if count:
+                result[run_id] = (entry['sums'].sum(axis=0) / count - self.mean) @ components.T
+        return result
+
+    def trajectories(self, components):
+        """{run id: (generations, k) mean component scores per generation (NaN where no selections)}"""
+        result = {}
+        for run_id, entry in self.participants.items():
+            with np.errstate(invalid='ignore', divide='ignore'):
+                means = entry['sums'] / entry['counts'][:, None]
+            result[run_id] = (means - self.mean) @ components.T
+        return result
+
+    def save(self, path):
+        """Checkpoint the state (write then rename)"""
+        run_ids = sorted(self.participants)
+        meta = {'stim_size': self.stim_size, 'generations': self.generations, 'n': self.n,
+                'run_ids': run_ids, 'participants': [self.participants[r]['participant'] for r in run_ids],
+                'signatures': [self.participants[r]['signature'] for r in run_ids]}
+        d = self.stim_size * self.stim_size
+        buffer = io.BytesIO()
+        np.savez(buffer,
+                 meta=np.frombuffer(json.dumps(meta).encode('utf-8'), dtype=np.uint8),
+                 pixel_sum=self.pixel_sum, scatter=self.scatter,
+                 sums=(np.stack([self.participants[r]['sums'] for r in run_ids]) if run_ids
+                       else np.zeros((0, self.generations, d))),
+                 counts=(np.stack([self.participants[r]['counts'] for r in run_ids]) if run_ids
+                         else np.zeros((0, self.generations), dtype=np.int64)),
+                 # Every run's selections back to back, split by selection_counts
+                 selection_counts=np.array([len(self.participants[r]['selections']) for r in run_ids], dtype=np.int64),
+                 selections=(np.concatenate([self.participants[r]['selections'] for r in run_ids]) if run_ids
+                             else np.zeros((0, d), dtype=np.uint8)),
+                 selection_generations=(np.concatenate([self.participants[r]['generations'] for r in run_ids])
+                                        if run_ids else np.zeros(0, dtype=np.int64)))
+        atomic_write(path, buffer.getvalue())
+
+    @classmethod
+    def load(cls, path):
+        """Restore a checkpointed state"""
+        with np.load(path) as data:
+            meta = json.loads(data['meta'].tobytes().decode('utf-8'))
+            state = cls(meta['stim_size'], meta['generations'])
+            state.n = meta['n']
+            state.pixel_sum = data['pixel_sum']
+            state.scatter = data['scatter']
+            if 'selection_counts' not in data:
+                raise ValueError(f"{path} predates per-run selections; rerun with --restart")
+            offsets = np.concatenate([[0], np.cumsum(data['selection_counts'])])
+            for i, (run_id, participant, sums, counts) in enumerate(zip(meta['run_ids'], meta['participants'],
+                                                                        data['sums'], data['counts'])):
+                state.participants[run_id] = {
+                    'participant': participant, 'sums': sums, 'counts': counts,
+                    'selections': data['selections'][offsets[i]:offsets[i + 1]],
+                    'generations': data['selection_generations'][offsets[i]:offsets[i + 1]],
+                    'signature': meta['signatures'][i]}
+        return state
+
+def source_signature(participant_dir):
+    """[file count, newest mtime (ns)] of the files load_selections reads from a folder"""
+    container = os.path.join(participant_dir, CONTAINER_FILE)
+    paths = [container] if os.path.exists(container) else glob.glob(os.path.join(participant_dir, 'csv', 'selection_*.csv'))
+    return [len(paths), max((os.stat(path).st_mtime_ns for path in paths), default=0)]
+
+def update(state, participant_dirs, workers=8):
+    """Add every folder not yet in the state and re-add any that changed since; returns the run ids added"""
+    added = []
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for participant_dir in participant_dirs:
+            run_id = os.path.basename(os.path.normpath(participant_dir))
+            signature = source_signature(participant_dir)
+            entry = state.participants.get(run_id)
+            if entry is not None and entry['signature'] == signature:
+                continue
+            selections, generations, _ = load_selections(participant_dir, pool, state.stim_size)
+            if len(selections) == 0:
+                continue
+            if state.add(run_id, participant_from_dir(participant_dir), selections, generations, signature):
+                added.append(run_id)
+    return added
+
+def write_outputs(state, out_dir, n_components=10):
+    """Components (.npy raw, PNG in screen orientation), explained variance, loadings and trajectories as CSV"""
+    from PIL import Image
+
+    components, variances, ratios = state.components(n_components)
+    k = len(components)
+    columns = [f"pc{i + 1}" for i in range(k)]
+    np.save(os.path.join(out_dir, 'components.npy'), components.reshape(k, state.stim_size, state.stim_size))
+    for i, component in enumerate(components):
+        scale = np.abs(component).max()
+        display = 127.5 + (127.5 * component / scale if scale > 0 else 0)
+        img = Image.fromarray(np.clip(np.rint(display), 0, 255).astype(np.uint8).reshape(state.stim_size, -1))
+        # Stored arrays are upside down relative to the screen; flip like data_saving does
+        img.transpose(Image.FLIP_TOP_BOTTOM).save(os.path.join(out_dir, f"component_{i + 1}.png"))
+
+    with open(os.path.join(out_dir, 'explained_variance.csv'), 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['component', 'variance', 'ratio'])
+        for i, (variance, ratio) in enumerate(zip(variances, ratios)):
+            writer.writerow([i + 1, f"{variance:.6g}", f"{ratio:.6g}"])
+
+    with open(os.path.join(out_dir, 'participant_loadings.csv'), 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['run_id', 'participant', 'selections'] + columns)
+        for run_id, scores in sorted(state.loadings(components).items()):
+            entry = state.participants[run_id]
+            writer.writerow([run_id, entry['participant'], int(entry['counts'].sum())] + [f"{s:.6g}" for s in scores])
+
+    with open(os.path.join(out_dir, 'generation_trajectories.csv'), 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['run_id', 'participant', 'generation', 'selections'] + columns)
+        for run_id, trajectory in sorted(state.trajectories(components).items()):
+            entry = state.participants[run_id]
+            for gen, scores in enumerate(trajectory):
+                if entry['counts'][gen]:
+                    writer.writerow([run_id, entry['participant'], gen, int(entry['counts'][gen])]
+                                    + [f"{s:.6g}" for s in scores])
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Streaming PCA over all participants' selections")
+    parser.add_argument('participant_dirs', nargs='*', help="Folders to add (default: all under --images-dir)")
+    parser.add_argument('--images-dir', default='participant_images')
+    parser.add_argument('--components', type=int, default=10)
+    parser.add_argument('--generations', type=int, default=12)
+    parser.add_argument('--stim-size', type=int, default=16)
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--out', default=OUTPUT_DIR)
+    parser.add_argument('--restart', action='store_true', help="Ignore the saved state and start over")
+    args = parser.parse_args(argv)
+
+    os.makedirs(args.out, exist_ok=True)
+    state_path = os.path.join(args.out, STATE_FILE)
+    if os.path.exists(state_path) and not args.restart:
+        state = SelectionPCA.load(state_path)
+    else:
+        state = SelectionPCA(args.stim_size, args.generations)
+
+    participant_dirs = args.participant_dirs or sorted(
+        path for path in glob.glob(os.path.join(args.images_dir, 'participant_*')) if os.path.isdir(path))
+    signatures = {run_id: entry['signature'] for run_id, entry in state.participants.items()}
+    added = update(state, participant_dirs, args.workers)
+    if added or any(entry['signature'] != signatures.get(run_id) for run_id, entry in state.participants.items()):
+        state.save(state_path)
+    print(f"Added or updated {len(added)} participant folders; {len(state.participants)} in total, "
+          f"{state.n} selections")
+    if state.n < 2:
+        print("Not enough selections for a PCA yet")
+        return
+    write_outputs(state, args.out, args.components)
+    print(f"Results in {args.out}")
+
+if __name__ == "__main__":
+    main()
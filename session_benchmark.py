@@ -0,0 +1,311 @@
+#session_benchmark.py
+
+"""
+End-to-end session throughput and memory benchmark
+
+Drives the complete run_session loop in ideal-observer mode - offspring,
+observer selection, filtering, composites, every data file, checkpoints and
+the trial log - with rendering and waits replaced by headless stand-ins:
+stimuli and text are plain objects, flips only count, core.wait returns at
+once, and the grid capture returns a blank frame of the real window size so
+its PNG encoding is still paid for. Each session writes into a fresh
+temporary storage root.
+
+Reports:
+  - sessions/s and seconds per session (timed sessions run without tracemalloc)
+  - per-generation wall time and the traced span breakdown (mean over sessions)
+  - peak RSS, and from one extra session under tracemalloc the Python heap
+    per generation and the top allocating lines at the last generation
+  - files and bytes written per session
+
+Exits with code 1 when a --max-* budget is exceeded.
+
+Usage: python session_benchmark.py [--sessions 3] [--buffered] [--max-session-seconds 5]
+                                   [--max-peak-rss-mb 500] [--max-files 3000] [--max-bytes-mb 50]
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import defaultdict
+from contextlib import contextmanager
+
+import numpy as np
+
+WINDOW_SIZE = (1920, 1080)  # As opened by setup_experiment
+
+class _HeadlessStim:
+    """Stands in for ImageStim/TextStim: accepts the attributes and calls the trial loop makes"""
+
+    def __init__(self, text=None, **kwargs):
+        self.text = text
+        self.pos = kwargs.get('pos', (0, 0))
+        self.size = kwargs.get('size', (0.2, 0.2))
+        self.height = kwargs.get('height', 0.05)
+
+    def draw(self):
+        pass
+
+    def setSize(self, size):
+        self.size = size
+
+class _HeadlessWindow:
+    """Counts flips and returns blank captures of the real window size"""
+
+    def __init__(self, size=WINDOW_SIZE):
+        from PIL import Image
+        self.size = size
+        self.frame = Image.new('RGB', size, (128, 128, 128))
+        self.movieFrames = []
+        self.flips = 0
+
+    def flip(self):
+        self.flips += 1
+
+    def getMovieFrame(self):
+        self.movieFrames.append(self.frame)
+        return self.frame
+
+class _InMemoryHandler:
+    """ExperimentHandler stand-in keeping rows in memory, as the real one does until it saves"""
+
+    def __init__(self, participant, data_file):
+        self.extraInfo = {'participant': participant, 'session': '001'}
+        self.dataFileName = data_file
+        self.rows = []
+        self.row = {}
+
+    def addData(self, name, value):
+        self.row[name] = value
+
+    def nextEntry(self):
+        self.rows.append(self.row)
+        self.row = {}
+
+class _GenerationProbe:
+    """Record time and traced heap at every generation boundary (via data_manager.update_run)"""
+
+    def __init__(self, data_manager):
+        self.marks = [(time.perf_counter(), None)]
+        self.heap = {}
+        self.snapshot = None  # Taken at the last boundary, while the session's data is still alive
+        update_run = data_manager.update_run
+
+        def probed(**fields):
+            update_run(**fields)
+            if 'generation' in fields:
+                self.marks.append((time.perf_counter(), fields['generation']))
+                if tracemalloc.is_tracing():
+                    self.heap[fields['generation']] = tracemalloc.get_traced_memory()[0]
+                    self.snapshot = tracemalloc.take_snapshot()
+        data_manager.update_run = probed
+
+    def generation_seconds(self):
+        """{generation: wall seconds from the previous boundary}"""
+        return {gen: end - start for (start, _), (end, gen) in zip(self.marks, self.marks[1:])}
+
+@contextmanager
+def headless_session(overrides=None):
+    """Patch the experiment modules for a headless ideal-observer session, restoring them afterwards"""
+    import types
+    import experiment_logic
+    from experiment_setup import params
+    from tracing import tracer
+
+    saved_params = dict(params)
+    saved = {name: getattr(experiment_logic, name) for name in ('core', 'create_image_from_array', 'create_text_screen')}
+    saved_tracer = (tracer.enabled, tracer.output_dir)
+    params.update({'mode': 'ideal_observer', 'debug': False, 'early_stopping': False, 'inter_trial_interval': 0})
+    params.update(overrides or {})
+    experiment_logic.core = types.SimpleNamespace(wait=lambda *args, **kwargs: None)
+    experiment_logic.create_image_from_array = lambda win, array: _HeadlessStim()
+    experiment_logic.create_text_screen = lambda win, text, **kwargs: _HeadlessStim(text, **kwargs)
+    # Spans stay in the ring buffer (no output_dir, so flush() writes nothing) for the breakdown
+    tracer.enabled, tracer.output_dir = True, None
+    tracer.buffer.clear()
+    try:
+        yield
+    finally:
+        params.clear()
+        params.update(saved_params)
+        for name, value in saved.items():
+            setattr(experiment_logic, name, value)
+        tracer.enabled, tracer.output_dir = saved_tracer
+        tracer.buffer.clear()
+
+def _disk_usage(root):
+    """(files, bytes) under root"""
+    files = size = 0
+    for directory, _, names in os.walk(root):
+        for name in names:
+            files += 1
+            size += os.path.getsize(os.path.join(directory, name))
+    return files, size
+
+def _span_breakdown(tracer):
+    """{generation: {span name: seconds}} from the tracer's buffered spans, emptying the buffer"""
+    breakdown = defaultdict(lambda: defaultdict(float))
+    for phase, name, _, duration, _, args in tracer.buffer:
+        if phase == 'X' and 'generation' in args:
+            breakdown[args['generation']][name] += duration / 1e9
+    tracer.buffer.clear()
+    return breakdown
+
+def run_one_session(target_array, seed, buffered=False, checkpoints=True, window_size=WINDOW_SIZE):
+    """One full headless session in a temporary storage root; returns its measurements"""
+    from experiment_logic import run_session
+    from data_saving import ParticipantDataManager
+    from shared_storage import SharedStore
+    from checkpoint import TrialLog, checkpoint_path, trial_log_path
+    from tracing import tracer
+
+    root = tempfile.mkdtemp(prefix='grc_session_bench_')
+    store = SharedStore(root, 'bench', buffered)
+    try:
+        data_manager = ParticipantDataManager('bench', store=store)
+        probe = _GenerationProbe(data_manager)
+        handler = _InMemoryHandler('bench', os.path.join(root, 'data', 'participant_bench'))
+        exp_handler = TrialLog(handler, trial_log_path(data_manager.participant_dir))
+        win = _HeadlessWindow(window_size)
+
+        start = time.perf_counter()
+        try:
+            run_session(win, exp_handler, 1, _HeadlessStim(), target_array, False, data_manager, seed=seed,
+                        checkpoint_file=checkpoint_path(data_manager.participant_dir) if checkpoints else None,
+                        checkpoint_extra={'participant_dir': data_manager.participant_dir})
+        finally:
+            exp_handler.close()
+            store.close()
+        seconds = time.perf_counter() - start
+        files, size = _disk_usage(root)
+        return {
+            'seconds': seconds,
+            'generation_seconds': probe.generation_seconds(),
+            'spans': _span_breakdown(tracer),
+            'heap': probe.heap,
+            'snapshot': probe.snapshot,
+            'files': files,
+            'bytes': size,
+            'flips': win.flips,
+            'rows': len(handler.rows)
+        }
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+def peak_rss_mb():
+    """Peak resident set size of this process in MB (None where the resource module is missing)"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+def run_benchmark(sessions=3, buffered=False, checkpoints=True, top=10, seed=0, window_size=WINDOW_SIZE,
+                  overrides=None):
+    """Run `sessions` timed sessions and one tracemalloc session; returns a summary dict"""
+    from stimuli import create_target_s
+    target_array, _ = create_target_s()
+
+    with headless_session(overrides):
+        run_one_session(target_array, seed, buffered, checkpoints, window_size)  # Warm-up (imports, caches)
+        runs = [run_one_session(target_array, seed + i + 1, buffered, checkpoints, window_size)
+                for i in range(sessions)]
+
+        tracemalloc.start(25)
+        try:
+            traced = run_one_session(target_array, seed, buffered, checkpoints, window_size)
+            traced_peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    snapshot = traced['snapshot'].filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+    allocators = [(str(stat.traceback[0]), stat.size, stat.count)
+                  for stat in snapshot.statistics('lineno')[:top]]
+
+    generations = sorted(runs[0]['generation_seconds'])
+    span_names = sorted({name for run in runs for spans in run['spans'].values() for name in spans})
+    total = sum(run['seconds'] for run in runs)
+    return {
+        'sessions': sessions,
+        'sessions_per_second': sessions / total,
+        'session_seconds': total / sessions,
+        'generation_seconds': {gen: np.mean([run['generation_seconds'][gen] for run in runs]) for gen in generations},
+        'spans': {gen: {name: np.mean([run['spans'][gen].get(name, 0.0) for run in runs]) for name in span_names}
+                  for gen in generations},
+        'heap': traced['heap'],
+        'traced_peak_mb': traced_peak / 2 ** 20,
+        'peak_rss_mb': peak_rss_mb(),
+        'allocators': allocators,
+        'files': np.mean([run['files'] for run in runs]),
+        'bytes': np.mean([run['bytes'] for run in runs]),
+        'rows': runs[0]['rows'],
+        'flips': runs[0]['flips']
+    }
+
+def print_report(summary):
+    """Human-readable report of run_benchmark's summary"""
+    print(f"{summary['sessions']} sessions: {summary['sessions_per_second']:.3f} sessions/s "
+          f"({summary['session_seconds']:.2f} s per session, {summary['rows']} rows, {summary['flips']} flips)")
+    print(f"Written per session: {summary['files']:.0f} files, {summary['bytes'] / 2 ** 20:.2f} MB")
+    rss = summary['peak_rss_mb']
+    print(f"Peak RSS: {rss:.1f} MB" if rss is not None else "Peak RSS: unavailable")
+    print(f"Traced Python heap peak: {summary['traced_peak_mb']:.1f} MB")
+
+    span_names = sorted({name for spans in summary['spans'].values() for name in spans})
+    header = f"{'gen':>4}{'total ms':>10}" + ''.join(f"{name[:14]:>16}" for name in span_names) + f"{'heap MB':>10}"
+    print("\nPer-generation breakdown (ms, mean over sessions)")
+    print(header)
+    for gen, seconds in summary['generation_seconds'].items():
+        spans = summary['spans'][gen]
+        heap = summary['heap'].get(gen)
+        print(f"{gen:>4}{seconds * 1e3:>10.1f}" + ''.join(f"{spans[name] * 1e3:>16.1f}" for name in span_names)
+              + (f"{heap / 2 ** 20:>10.2f}" if heap is not None else f"{'':>10}"))
+
+    print("\nTop allocators (traced session)")
+    for location, size, count in summary['allocators']:
+        print(f"{size / 1024:>10.1f} KiB {count:>8} blocks  {location}")
+
+def check_budget(summary, max_session_seconds=None, max_peak_rss_mb=None, max_files=None, max_bytes_mb=None):
+    """Budget violations as messages (empty if within budget)"""
+    checks = [
+        ('seconds per session', summary['session_seconds'], max_session_seconds),
+        ('peak RSS (MB)', summary['peak_rss_mb'], max_peak_rss_mb),
+        ('files per session', summary['files'], max_files),
+        ('MB written per session', summary['bytes'] / 2 ** 20, max_bytes_mb),
+    ]
+    return [f"{name} {value:.2f} exceeds budget {limit}" for name, value, limit in checks
+            if limit is not None and value is not None and value > limit]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Headless end-to-end session throughput and memory benchmark")
+    parser.add_argument('--sessions', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--buffered', action='store_true', help="write files on the background station writer")
+    parser.add_argument('--no-checkpoints', action='store_true')
+    parser.add_argument('--generations', type=int, default=None)
+    parser.add_argument('--top', type=int, default=10, help="allocators to list")
+    parser.add_argument('--max-session-seconds', type=float, default=None)
+    parser.add_argument('--max-peak-rss-mb', type=float, default=None)
+    parser.add_argument('--max-files', type=float, default=None)
+    parser.add_argument('--max-bytes-mb', type=float, default=None)
+    args = parser.parse_args(argv)
+
+    overrides = {'generations': args.generations} if args.generations else None
+    summary = run_benchmark(args.sessions, args.buffered, not args.no_checkpoints, args.top, args.seed,
+                            overrides=overrides)
+    print_report(summary)
+
+    violations = check_budget(summary, args.max_session_seconds, args.max_peak_rss_mb,
+                              args.max_files, args.max_bytes_mb)
+    for violation in violations:
+        print(f"OVER BUDGET: {violation}")
+    return 1 if violations else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
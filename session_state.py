@@ -0,0 +1,93 @@
+#session_state.py
+
+import numpy as np
+from stimuli import generate_noise_pattern
+from genetic_algorithm import OffspringSource, AdaptiveMutation, genome_resolution
+from convergence import ConvergenceMonitor
+
+class SessionState:
+    """All mutable state of one running session, passed explicitly through the trial loop
+
+    Each session owns its own parents, offspring batches, selections,
+    convergence monitor and random generator, so several sessions can run
+    side by side in one interpreter (threads, parameter sweeps, notebooks).
+    """
+
+    def __init__(self, session_num=1, generations=12, stim_size=16, target_array=None, seed=None,
+                 resolution_schedule=None, adaptive_mutation=False, basis=None, selections_per_trial=1,
+                 rank_selections=True):
+        """Create an empty session state for generation 0"""
+        self.session_num = session_num
+        self.generations = generations
+        self.stim_size = stim_size
+        self.resolution_schedule = [tuple(step) for step in resolution_schedule] if resolution_schedule else None
+        self.generation = 0
+        self.resolution = genome_resolution(0, self.resolution_schedule, stim_size)
+        self.selections_per_trial = selections_per_trial  # Top-k trials: every marked stimulus is a weighted parent
+        self.rank_selections = selections_per_trial == 1 or rank_selections  # Marks weighted best first, or equally
+        self.parents = []
+        self.next_generation_parents = []
+        self.parent_weights = []
+        self.next_generation_weights = []
+        self.offspring = None  # Lazy OffspringSource for the current generation
+        self.batch_index = 0
+        self.selections = {gen: [] for gen in range(generations)}  # All selections by generation
+        self.convergence = ConvergenceMonitor(target_array, stim_size)
+        self.mutation = AdaptiveMutation() if adaptive_mutation else None  # None: fixed 1% mutation
+        self.basis = basis  # BasisBank when stimuli are evolved as basis coefficients
+        self.rng = np.random.default_rng(seed)
+
+    def start_generation(self, generation):
+        """Move to a new generation, breeding offspring from last generation's parents"""
+        self.generation = generation
+        self.resolution = genome_resolution(generation, self.resolution_schedule, self.stim_size)
+        if generation > 0:
+            self.parents = self.next_generation_parents
+            self.parent_weights = self.next_generation_weights
+            self.next_generation_parents = []
+            self.next_generation_weights = []
+            if self.mutation is not None:
+                self.mutation.update(self.parents, self.composite(generation - 1), self.composite(generation - 2))
+            self.offspring = OffspringSource(self.parents, self.stim_size, self.rng, resolution=self.resolution,
+                                             mutation=self.mutation, basis=self.basis, weights=self.breeding_weights())
+            self.batch_index = 0
+
+    def next_stimuli(self):
+        """Stimuli for the next trial: noise in generation 0, otherwise the next offspring batch (bred on demand)"""
+        if self.generation == 0 and self.basis is not None:
+            return list(self.basis.render(self.basis.random_coefficients(self.rng, 12)))
+        if self.generation == 0:
+            return [generate_noise_pattern(self.stim_size, self.rng, self.resolution) for _ in range(12)]
+        stimuli_arrays = self.offspring.next_batch()
+        self.batch_index += 1
+        return stimuli_arrays
+
+    def breeding_weights(self):
+        """Parent weights for the offspring source, or None for uniform breeding (one selection per trial)"""
+        if self.selections_per_trial > 1 and self.parent_weights:
+            return self.parent_weights
+        return None
+
+    def record_selections(self, stimuli_arrays, selected_array, filtered_arrays, weights):
+        """Track a top-k trial: its selection (see marked_selection) for composites, every filtered mark as a weighted parent"""
+        self.selections[self.generation].append(selected_array)
+        self.convergence.update(stimuli_arrays, selected_array)
+        for filtered_array, weight in zip(filtered_arrays, weights):
+            if filtered_array is not None:
+                self.next_generation_parents.append(filtered_array)
+                self.next_generation_weights.append(float(weight))
+
+    def composite(self, generation):
+        """Mean of a generation's selections, or None if it has none"""
+        if generation < 0 or not self.selections.get(generation):
+            return None
+        return np.mean(self.selections[generation], axis=0)
+
+    def all_selections(self, last_generation=None):
+        """Every selection up to and including last_generation, in order"""
+        if last_generation is None:
+            last_generation = self.generations - 1
+        selections = []
+        for gen in range(last_generation + 1):
+            selections.extend(self.selections[gen])
+        return selections
@@ -0,0 +1,377 @@
+#shared_storage.py
+
+"""
+Storage for several lab stations writing to one shared drive
+
+SharedStore is what ParticipantDataManager writes through:
+  - every file is written to a station-unique temporary name in the target
+    folder and renamed into place, so readers never see partial files and two
+    stations can never interleave writes to one file
+  - participant folders are created with an exclusive mkdir, so two runs
+    started in the same second get distinct timestamps instead of sharing a folder
+  - with buffering on, writes (including PNG/TIFF encoding) happen on a
+    per-station background thread; flush() waits for them
+  - run metadata (register / update events) is appended by each station to
+    its own journal, <storage_root>/run_journal/<station>.jsonl, so every file
+    on the shared drive has exactly one writer
+  - one indexer process folds the journals into a SQLite run index on its own
+    local disk, so listing runs is one query instead of a directory scan.
+    SQLite must not be shared between hosts over a network filesystem, so no
+    station ever opens the index. A single-station setup may instead write
+    straight to a local index (params['run_index']).
+
+Usage: python shared_storage.py --root <storage_root> --index <local path>/run_index.sqlite [--watch 10]
+"""
+
+import argparse
+import csv
+import io
+import json
+import os
+import re
+import time
+import queue
+import socket
+import sqlite3
+import threading
+from datetime import datetime, timedelta
+
+RUN_INDEX_FILE = 'run_index.sqlite'
+RUN_JOURNAL_DIR = 'run_journal'
+
+def atomic_write(path, data, station=None):
+    """Write bytes to path via a unique temporary file and an atomic rename"""
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp_path = os.path.join(directory, f".{os.path.basename(path)}.{station or socket.gethostname()}.{os.getpid()}."
+                                       f"{threading.get_ident()}.tmp")
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def encode_image(img, image_format):
+    """PIL image -> file bytes in the given format ('PNG', 'TIFF')"""
+    buffer = io.BytesIO()
+    img.save(buffer, format=image_format)
+    return buffer.getvalue()
+
+def encode_csv(rows):
+    """Rows -> CSV bytes, identical to csv.writer output"""
+    buffer = io.StringIO(newline='')
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow(row)
+    return buffer.getvalue().encode('utf-8')
+
+class StationWriter:
+    """Background thread that performs this station's queued writes in order"""
+
+    def __init__(self, station, max_pending=1024):
+        self.station = station
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.errors = []
+        self.thread = threading.Thread(target=self._run, name='station-writer', daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                path, data = item
+                atomic_write(path, data() if callable(data) else data, self.station)
+            except Exception as e:
+                self.errors.append(e)
+            finally:
+                self.queue.task_done()
+
+    def submit(self, path, data):
+        """Queue a write; data is bytes or a zero-argument callable producing them (run on the writer thread)"""
+        self.queue.put((path, data))
+
+    def pending(self):
+        """Writes queued but not finished"""
+        return self.queue.unfinished_tasks
+
+    def flush(self):
+        """Wait until every queued write is on disk; re-raise the first write error"""
+        self.queue.join()
+        if self.errors:
+            error, self.errors = self.errors[0], []
+            raise error
+
+    def close(self):
+        """Flush and stop the thread"""
+        self.flush()
+        self.queue.put(None)
+        self.thread.join()
+
+def _now():
+    return datetime.now().isoformat(timespec='seconds')
+
+class RunJournal:
+    """This station's append-only run-metadata journal on the shared drive (the station is its only writer)"""
+
+    def __init__(self, journal_dir, station):
+        self.station = station
+        self.path = os.path.join(journal_dir, re.sub(r'[^\w.-]', '_', station) + '.jsonl')
+        os.makedirs(journal_dir, exist_ok=True)
+        self.lock = threading.Lock()
+        self.file = open(self.path, 'ab')
+        # A crash mid-append leaves a partial line; end it so the next record starts cleanly
+        if self.file.tell() and not _ends_with_newline(self.path):
+            self._append(b'\n')
+
+    def _append(self, data):
+        with self.lock:
+            self.file.write(data)
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def _record(self, event, run_id, fields):
+        record = {'event': event, 'run_id': run_id, 'at': _now(),
+                  'fields': {key: value for key, value in fields.items() if key in RunIndex.COLUMNS}}
+        self._append((json.dumps(record) + '\n').encode('utf-8'))
+
+    def register_run(self, run_id, **fields):
+        """Record a new (or resumed) run"""
+        self._record('register', run_id, dict(fields, station=self.station))
+
+    def update_run(self, run_id, **fields):
+        """Record new values for some fields of a run"""
+        self._record('update', run_id, fields)
+
+    def close(self):
+        self.file.close()
+
+def _ends_with_newline(path):
+    with open(path, 'rb') as f:
+        f.seek(-1, os.SEEK_END)
+        return f.read(1) == b'\n'
+
+class RunIndex:
+    """SQLite index of runs: who ran where, into which folders, and how far they got
+
+    Keep it on a local disk with one writing process: the indexer folding the
+    station journals (fold_journals), or a single station writing directly.
+    """
+
+    COLUMNS = ('participant_id', 'station', 'participant_dir', 'data_file', 'status',
+               'started_at', 'updated_at', 'generation')
+
+    def __init__(self, path, timeout=30.0):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, timeout=timeout, isolation_level=None, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=DELETE')
+        self._write("""CREATE TABLE IF NOT EXISTS runs (
+            run_id TEXT PRIMARY KEY,
+            participant_id TEXT,
+            station TEXT,
+            participant_dir TEXT,
+            data_file TEXT,
+            status TEXT,
+            started_at TEXT,
+            updated_at TEXT,
+            generation INTEGER)""")
+        self._write('CREATE INDEX IF NOT EXISTS runs_participant ON runs (participant_id)')
+        # How far each station journal has been folded in
+        self._write('CREATE TABLE IF NOT EXISTS journal_offsets (journal TEXT PRIMARY KEY, position INTEGER)')
+
+    def _write(self, sql, args=()):
+        """Run one statement in its own IMMEDIATE transaction (takes the writer lock up front)"""
+        self._transaction([(sql, args)])
+
+    def _transaction(self, statements):
+        """Run (sql, args) statements in one IMMEDIATE transaction"""
+        with self.lock:
+            self.connection.execute('BEGIN IMMEDIATE')
+            try:
+                for sql, args in statements:
+                    self.connection.execute(sql, args)
+                self.connection.execute('COMMIT')
+            except BaseException:
+                self.connection.execute('ROLLBACK')
+                raise
+
+    def _register_sql(self, run_id, fields, at=None):
+        fields = {key: value for key, value in fields.items() if key in self.COLUMNS}
+        fields.setdefault('started_at', at or _now())
+        fields['updated_at'] = at or _now()
+        columns = ['run_id'] + list(fields)
+        updates = ', '.join(f"{key} = excluded.{key}" for key in fields if key != 'started_at')
+        return (f"INSERT INTO runs ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))}) "
+                f"ON CONFLICT(run_id) DO UPDATE SET {updates}", [run_id] + list(fields.values()))
+
+    def _update_sql(self, run_id, fields, at=None):
+        fields = {key: value for key, value in fields.items() if key in self.COLUMNS}
+        fields['updated_at'] = at or _now()
+        assignments = ', '.join(f"{key} = ?" for key in fields)
+        return f"UPDATE runs SET {assignments} WHERE run_id = ?", list(fields.values()) + [run_id]
+
+    def register_run(self, run_id, **fields):
+        """Insert a run, or update it if it is already indexed (e.g. on resume)"""
+        self._write(*self._register_sql(run_id, fields))
+
+    def update_run(self, run_id, **fields):
+        """Update some fields of an indexed run"""
+        self._write(*self._update_sql(run_id, fields))
+
+    def fold_journal(self, path):
+        """Apply the complete records a station journal gained since the last fold; returns how many"""
+        name = os.path.basename(path)
+        with self.lock:
+            row = self.connection.execute('SELECT position FROM journal_offsets WHERE journal = ?', (name,)).fetchone()
+        offset = row[0] if row else 0
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            data = f.read()
+        complete = data[:data.rfind(b'\n') + 1]  # A line still being appended is left for the next fold
+        statements = []
+        for line in complete.splitlines():
+            try:
+                record = json.loads(line)
+                make_sql = self._register_sql if record['event'] == 'register' else self._update_sql
+                statements.append(make_sql(record['run_id'], record['fields'], record.get('at')))
+            except (ValueError, KeyError, TypeError):
+                if line.strip():
+                    print(f"Skipping unreadable record in {path}: {line[:80]!r}")
+        statements.append(('INSERT INTO journal_offsets (journal, position) VALUES (?, ?) '
+                           'ON CONFLICT(journal) DO UPDATE SET position = excluded.position',
+                           (name, offset + len(complete))))
+        self._transaction(statements)
+        return len(statements) - 1
+
+    def fold_journals(self, journal_dir):
+        """Fold every station journal in journal_dir; returns the number of records applied"""
+        return sum(self.fold_journal(path) for path in sorted(
+            os.path.join(journal_dir, name) for name in os.listdir(journal_dir) if name.endswith('.jsonl')))
+
+    def runs(self, **filters):
+        """Indexed runs as dicts, optionally filtered by column values"""
+        filters = {key: value for key, value in filters.items() if key in self.COLUMNS}
+        where = ' AND '.join(f"{key} = ?" for key in filters)
+        sql = 'SELECT run_id, ' + ', '.join(self.COLUMNS) + ' FROM runs'
+        if where:
+            sql += ' WHERE ' + where
+        with self.lock:
+            rows = self.connection.execute(sql + ' ORDER BY started_at', list(filters.values())).fetchall()
+        return [dict(zip(('run_id',) + self.COLUMNS, row)) for row in rows]
+
+    def close(self):
+        self.connection.close()
+
+class SharedStore:
+    """Where a station's participant folders, data files and run metadata go, and how files get written"""
+
+    def __init__(self, root=None, station=None, buffered=False, index_path=None, journal_dir=None):
+        """root defaults to the working directory
+
+        Run metadata is appended to a journal in journal_dir (shared setups), or
+        written straight to a local SQLite index at index_path (one station only);
+        with neither it is not recorded.
+        """
+        self.root = root or os.getcwd()
+        self.station = station or socket.gethostname()
+        self.images_dir = os.path.join(self.root, 'participant_images')
+        self.data_dir = os.path.join(self.root, 'data')
+        self.writer = StationWriter(self.station) if buffered else None
+        if index_path:
+            self.index = RunIndex(index_path)
+        elif journal_dir:
+            self.index = RunJournal(journal_dir, self.station)
+        else:
+            self.index = None
+
+    def create_participant_dir(self, participant_id, timestamp=None):
+        """Exclusively create participant_<id>_<timestamp>, moving the timestamp on a second if it is taken"""
+        os.makedirs(self.images_dir, exist_ok=True)
+        moment = datetime.now() if timestamp is None else datetime.strptime(timestamp, "%Y%m%d_%H%M%S")
+        while True:
+            timestamp = moment.strftime("%Y%m%d_%H%M%S")
+            path = os.path.join(self.images_dir, f'participant_{participant_id}_{timestamp}')
+            try:
+                os.mkdir(path)
+                return path, timestamp
+            except FileExistsError:
+                moment += timedelta(seconds=1)
+
+    def write(self, path, data):
+        """Write bytes (or a callable producing them) atomically, on the writer thread if buffered"""
+        if self.writer is not None:
+            self.writer.submit(path, data)
+        else:
+            atomic_write(path, data() if callable(data) else data, self.station)
+
+    def write_image(self, path, img, image_format):
+        """Write a PIL image; encoding happens on the writer thread when buffered"""
+        self.write(path, lambda: encode_image(img, image_format))
+
+    def write_csv(self, path, rows):
+        """Write rows as CSV (rows must not change afterwards)"""
+        self.write(path, lambda: encode_csv(rows))
+
+    def pending(self):
+        """Buffered writes not yet on disk"""
+        return self.writer.pending() if self.writer is not None else 0
+
+    def flush(self):
+        """Wait for buffered writes"""
+        if self.writer is not None:
+            self.writer.flush()
+
+    def register_run(self, run_id, **fields):
+        if self.index is not None:
+            self.index.register_run(run_id, station=self.station, **fields)
+
+    def update_run(self, run_id, **fields):
+        if self.index is not None:
+            self.index.update_run(run_id, **fields)
+
+    def close(self):
+        """Flush buffered writes and close the writer and index"""
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        if self.index is not None:
+            self.index.close()
+            self.index = None
+
+def open_store(params):
+    """SharedStore configured from the experiment params"""
+    root = params.get('storage_root') or os.getcwd()
+    journal_dir = os.path.join(root, RUN_JOURNAL_DIR) if params.get('storage_root') else None
+    return SharedStore(root, params.get('station'), params.get('buffered_writes', False),
+                       params.get('run_index'), journal_dir)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Fold the stations' run journals into the SQLite run index")
+    parser.add_argument('--root', required=True, help="Shared storage root holding run_journal/")
+    parser.add_argument('--index', required=True, help="Run index path, on this machine's local disk")
+    parser.add_argument('--watch', type=float, default=None, help="Keep folding every N seconds")
+    args = parser.parse_args(argv)
+
+    journal_dir = os.path.join(args.root, RUN_JOURNAL_DIR)
+    index = RunIndex(args.index)
+    try:
+        while True:
+            applied = index.fold_journals(journal_dir) if os.path.isdir(journal_dir) else 0
+            print(f"Folded {applied} records; {len(index.runs())} runs indexed")
+            if args.watch is None:
+                break
+            time.sleep(args.watch)
+    finally:
+        index.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,234 @@
+#simulator.py
+
+"""
+Tensorized multi-participant GA simulator
+
+Simulates P ideal-observer participants at once. Each generation's stimuli
+for every participant live in one (P, trials, 12, H, W) uint8 tensor, and
+noise generation, observer selection, filtering and crossover are each a
+single batched numpy operation over all participants. No PsychoPy needed.
+With top_k > 1 each observer marks its k best stimuli per trial and every
+marked stimulus becomes a weighted parent. Ranked marks are best first and
+the best is the trial's selection; unranked marks are shuffled (the order
+of a participant's clicks carries no rank) and the selection is their mean,
+with selected_ids set to -1.
+
+Usage: python simulator.py --participants 200 [--generations 12] [--seed 0]
+"""
+
+import argparse
+import time
+
+import numpy as np
+
+from genetic_algorithm import (filter_selection_batch, ideal_observer_select_batch, resize_target,
+                               filter_top_k_batch, ideal_observer_rank_batch, rank_weights, marked_selection,
+                               downsample_genome, upsample_genome, genome_resolution, population_diversity,
+                               selection_consistency, adaptive_mutation_schedule, gaussian_mutation)
+
+class PopulationSimulator:
+    """Advance P simulated participants one generation at a time, writing into preallocated results"""
+
+    def __init__(self, n_participants, target_array, generations=12, trials=12, n_stimuli=12,
+                 stim_size=16, seed=None, mutation_rate=0.01, threshold=30,
+                 preservation_factor=0.95, noise_reduction_factor=0.1, resolution_schedule=None,
+                 adaptive_mutation=None, basis=None, top_k=1, ranked=True):
+        self.n_participants = n_participants
+        self.generations = generations
+        self.trials = trials
+        self.n_stimuli = n_stimuli
+        self.stim_size = stim_size
+        self.mutation_rate = mutation_rate
+        self.resolution_schedule = resolution_schedule
+        # None: fixed mutation_rate uniform replacement; otherwise adaptive_mutation_schedule keyword arguments
+        self.adaptive_mutation = adaptive_mutation
+        self.basis = basis  # BasisBank: evolve coefficient vectors instead of pixels
+        if not 1 <= top_k < n_stimuli:
+            raise ValueError(f'top_k must be between 1 and {n_stimuli - 1}')
+        self.top_k = top_k  # Stimuli the observer marks per trial, each becoming a weighted parent
+        self.ranked = ranked or top_k == 1
+        self.selection_weights = rank_weights(top_k, self.ranked)
+        self.filter_args = (threshold, preservation_factor, noise_reduction_factor)
+        self.rng = np.random.default_rng(seed)
+        self.target = resize_target(target_array, (stim_size, stim_size)).astype(np.float64)
+        self.generation = 0
+
+        # Current stimuli and parents for every participant
+        self.stimuli = np.empty((n_participants, trials, n_stimuli, stim_size, stim_size), dtype=np.uint8)
+        self.parents = None
+        self.parent_weights = None  # (P, trials * top_k) breeding weights when top_k > 1
+
+        # Preallocated results
+        self.selected_ids = np.zeros((n_participants, generations, trials), dtype=np.int8)
+        self.selections = np.zeros((n_participants, generations, trials, stim_size, stim_size), dtype=np.uint8)
+        self.similarity = np.zeros((n_participants, generations), dtype=np.float64)
+        self.composites = np.zeros((n_participants, generations, stim_size, stim_size), dtype=np.uint8)
+        self.mutation_rates = np.full((n_participants, generations), mutation_rate, dtype=np.float64)
+        self.mutation_sigmas = np.full((n_participants, generations), np.nan, dtype=np.float64)
+
+    def _noise(self, resolution):
+        """Generation 0: independent noise for every participant, trial and stimulus"""
+        if self.basis is not None:
+            self.stimuli[...] = self.basis.render(self.basis.random_coefficients(self.rng, self.stimuli.shape[:-2]))
+            return
+        shape = self.stimuli.shape[:-2] + (resolution, resolution)
+        self.stimuli[...] = upsample_genome(self.rng.integers(0, 256, shape, dtype=np.uint8), self.stim_size)
+
+    def _breed(self, resolution, gen):
+        """Later generations: every participant breeds trials x n_stimuli children from its parents"""
+        P, T, N = self.n_participants, self.trials, self.n_stimuli
+        if self.basis is not None:
+            parents = self.basis.project(self.parents)
+        else:
+            parents = downsample_genome(self.parents, resolution)
+        n_parents = parents.shape[1]
+        n_children = T * N
+
+        # Sample ordered parent pairs without replacement, per participant
+        n_pairs = n_parents * n_parents
+        if n_children > n_pairs:
+            raise ValueError('Not enough parent pairs to fill a generation')
+        keys = self.rng.random((P, n_pairs))
+        if self.parent_weights is not None:
+            # Exponential keys divided by the pair weight: the smallest are a weighted sample without replacement
+            pair_weights = self.parent_weights[:, :, None] * self.parent_weights[:, None, :]
+            keys = -np.log1p(-keys) / pair_weights.reshape(P, n_pairs)
+        pairs = np.argpartition(keys, n_children - 1, axis=1)[:, :n_children]
+        first, second = np.divmod(pairs, n_parents)
+
+        # Gather parents through a flat (P * n_parents, H * W) view
+        flat_parents = parents.reshape(P * n_parents, -1)
+        offsets = (np.arange(P) * n_parents)[:, None]
+        mother = flat_parents.take((first + offsets).ravel(), axis=0)
+        children = flat_parents.take((second + offsets).ravel(), axis=0)
+
+        if self.basis is not None:
+            # Crossover and mutation of coefficients, then one matrix multiply renders every child
+            children = self.basis.crossbreed(mother, children, self.rng)
+            self.stimuli[...] = self.basis.render(children).reshape(self.stimuli.shape)
+            return
+
+        # Uniform crossover: one random bit per pixel picks the mother instead of the father,
+        # blended bitwise (0xFF / 0x00 masks) which is much faster than a boolean where
+        n_pixels = children.size
+        bits = np.unpackbits(self.rng.integers(0, 256, -(-n_pixels // 8), dtype=np.uint8))[:n_pixels]
+        mask = np.negative(bits).reshape(children.shape)
+        children ^= (children ^ mother) & mask
+
+        if self.adaptive_mutation is not None:
+            # Per-participant Gaussian mutation tuned to its parents' diversity and selection consistency
+            previous = self.composites[:, gen - 2] if gen >= 2 else None
+            rate, sigma = adaptive_mutation_schedule(
+                population_diversity(self.parents), selection_consistency(self.composites[:, gen - 1], previous),
+                **self.adaptive_mutation)
+            gaussian_mutation(children.reshape(P, -1), rate, sigma, self.rng)
+            self.mutation_rates[:, gen], self.mutation_sigmas[:, gen] = rate, sigma
+        else:
+            # Per-pixel mutation to a random grey value, drawing only the mutated positions
+            positions = _bernoulli_positions(self.rng, n_pixels, self.mutation_rate)
+            children.reshape(-1)[positions] = self.rng.integers(0, 256, len(positions), dtype=np.uint8)
+
+        children = children.reshape(self.stimuli.shape[:-2] + parents.shape[-2:])
+        self.stimuli[...] = upsample_genome(children, self.stim_size)
+
+    def step(self):
+        """Run one generation for all participants"""
+        gen = self.generation
+        resolution = genome_resolution(gen, self.resolution_schedule, self.stim_size)
+        if gen == 0:
+            self._noise(resolution)
+        else:
+            self._breed(resolution, gen)
+
+        totals = self.stimuli.sum(axis=2, dtype=np.float64)
+        if self.top_k == 1:
+            # Ideal observer: closest stimulus to the target in every trial
+            selected_ids = ideal_observer_select_batch(self.stimuli, self.target)
+            selected = np.take_along_axis(
+                self.stimuli, selected_ids[:, :, None, None, None], axis=2
+            )[:, :, 0]
+
+            # Filter each selection against the mean of the other stimuli in its trial
+            avg_non_selected = (totals - selected) / (self.n_stimuli - 1)
+            self.parents = filter_selection_batch(selected, avg_non_selected, *self.filter_args)
+        else:
+            # Ideal observer marks the top_k closest stimuli, best first unless unranked
+            chosen_ids = ideal_observer_rank_batch(self.stimuli, self.target, self.top_k)
+            if not self.ranked:
+                chosen_ids = self.rng.permuted(chosen_ids, axis=-1)
+            chosen = np.take_along_axis(self.stimuli, chosen_ids[:, :, :, None, None], axis=2)
+            selected = marked_selection(chosen, self.ranked)
+            selected_ids = chosen_ids[:, :, 0] if self.ranked else np.full(chosen_ids.shape[:2], -1)
+
+            # Every marked stimulus is filtered by the trial's weighted contrast and becomes a weighted parent
+            avg_non_chosen = (totals - chosen.sum(axis=2, dtype=np.float64)) / (self.n_stimuli - self.top_k)
+            parents = filter_top_k_batch(chosen, self.selection_weights, avg_non_chosen, *self.filter_args)
+            self.parents = parents.reshape((self.n_participants, -1) + parents.shape[-2:])
+            self.parent_weights = np.broadcast_to(
+                self.selection_weights, (self.n_participants, self.trials, self.top_k)
+            ).reshape(self.n_participants, -1)
+
+        # Record results for this generation
+        self.selected_ids[:, gen] = selected_ids
+        self.selections[:, gen] = selected
+        diff = selected.astype(np.float64) - self.target
+        self.similarity[:, gen] = np.einsum('ptij,ptij->p', diff, diff) / self.trials
+        self.composites[:, gen] = selected.mean(axis=1).astype(np.uint8)
+
+        self.generation += 1
+
+    def run(self):
+        """Run all remaining generations and return the results"""
+        while self.generation < self.generations:
+            self.step()
+        return {
+            'selected_ids': self.selected_ids,
+            'selections': self.selections,
+            'similarity': self.similarity,
+            'composites': self.composites,
+            'mutation_rates': self.mutation_rates,
+            'mutation_sigmas': self.mutation_sigmas,
+            'mega_composites': self.selections.reshape(
+                self.n_participants, -1, self.stim_size, self.stim_size).mean(axis=1).astype(np.uint8)
+        }
+
+def _bernoulli_positions(rng, n, p):
+    """Indices in [0, n) each chosen independently with probability p, via geometric gaps"""
+    if p <= 0:
+        return np.zeros(0, dtype=np.int64)
+    positions = []
+    start = -1
+    while True:
+        gaps = rng.geometric(p, int(n * p * 1.1) + 16)
+        chunk = start + np.cumsum(gaps)
+        positions.append(chunk[chunk < n])
+        if chunk[-1] >= n:
+            return np.concatenate(positions)
+        start = chunk[-1]
+
+def simulate_participants(n_participants, target_array, generations=12, seed=None, **kwargs):
+    """Simulate n_participants ideal observers and return their results"""
+    return PopulationSimulator(n_participants, target_array, generations, seed=seed, **kwargs).run()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Tensorized ideal-observer GA simulator")
+    parser.add_argument('--participants', type=int, default=200)
+    parser.add_argument('--generations', type=int, default=12)
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args(argv)
+
+    from stimuli import create_target_s
+    target_array, _ = create_target_s()
+
+    start = time.perf_counter()
+    results = simulate_participants(args.participants, target_array, args.generations, args.seed)
+    elapsed = time.perf_counter() - start
+
+    similarity = results['similarity'].mean(axis=0)
+    print(f"Simulated {args.participants} participants x {args.generations} generations "
+          f"in {elapsed:.2f}s ({args.participants / elapsed:.0f} participants/s)")
+    print("Mean selected-vs-target similarity per generation:")
+    print(' '.join(f"{s:.0f}" for s in similarity))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,294 @@
+#spectral_analysis.py
+
+"""
+Batched spatial-frequency analysis of composites
+
+Loads every composite in organised_by_imagery/<group>/ and
+participant_images/*/composites/ into one (N, H, W) stack, computes all 2D
+FFTs at once and reduces the power spectra to radial (spatial frequency) and
+orientation profiles with a single matrix multiply against precomputed bin
+masks. Per-group mean log power and pairwise group contrasts (difference and
+Welch t per bin) follow from the same arrays.
+
+Composites are analysed as stored arrays (the orientation of the CSVs and
+of the organised_by_imagery TIFFs), so a participant composite is read from
+its CSV. ParticipantDataManager flips its PNG/TIFF copies top to bottom, so
+when only an image is left (a pruned folder) the array comes from the
+folder's compact.npz, or the image is oriented by the folder's compaction
+manifest or by comparing a selection's PNG with its CSV.
+
+Spectra are cached in <out>/spectral_cache.npz keyed by the SHA-1 of each
+file's contents, so reruns only transform new or changed composites.
+
+Usage: python spectral_analysis.py [--out spectral_analysis] [--orientations 8]
+"""
+
+import argparse
+import csv
+import glob
+import hashlib
+import itertools
+import os
+import re
+
+import numpy as np
+
+from classification_images import GROUPS_FILE, load_groups
+from compact_images import COMPOSITE_PATTERN, load_container, read_manifest, recorded_orientation
+
+OUTPUT_DIR = 'spectral_analysis'
+CACHE_FILE = 'spectral_cache.npz'
+IMAGERY_DIR = 'organised_by_imagery'
+PARTICIPANT_IMAGES_DIR = 'participant_images'
+UNASSIGNED_GROUP = 'unassigned'
+
+# Preferred file per composite when the same image was saved in several formats: the CSV is the stored array
+FORMAT_PREFERENCE = ('.csv', '.tiff', '.tif', '.png')
+# Bumped when the array a file loads as changes, so cached results from before are recomputed
+LOADER_VERSION = 2
+
+def file_hash(path):
+    """SHA-1 of a file's contents"""
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def _load_image(path):
+    from PIL import Image
+    with Image.open(path) as img:
+        return np.asarray(img.convert('L'), dtype=np.float64)
+
+def image_orientation(participant_dir):
+    """'flipped' or 'unflipped' for a participant folder's PNG/TIFF copies, or None if it cannot be told"""
+    orientation = recorded_orientation(read_manifest(participant_dir))
+    if orientation is not None:
+        return orientation
+    # Compare a selection's PNG with its CSV, as compact_images does (symmetric arrays cannot tell)
+    for csv_path in sorted(glob.glob(os.path.join(participant_dir, 'csv', 'selection_*.csv'))):
+        png_path = os.path.join(participant_dir, 'png', os.path.splitext(os.path.basename(csv_path))[0] + '.png')
+        if not os.path.exists(png_path):
+            continue
+        array = np.loadtxt(csv_path, delimiter=',', dtype=np.float64, ndmin=2)
+        image = _load_image(png_path)
+        if image.shape != array.shape or np.array_equal(array, np.flipud(array)):
+            continue
+        if np.array_equal(image, np.flipud(array)):
+            return 'flipped'
+        if np.array_equal(image, array):
+            return 'unflipped'
+    return None
+
+def load_composite(path):
+    """A composite as a float64 array in stored-array (CSV) orientation"""
+    if path.endswith('.csv'):
+        return np.loadtxt(path, delimiter=',', dtype=np.float64, ndmin=2)
+    image = _load_image(path)
+    composites_dir = os.path.dirname(os.path.abspath(path))
+    if os.path.basename(composites_dir) != 'composites':
+        return image  # organised_by_imagery copies are stored unflipped
+
+    # An image copy in participant_images/<participant dir>/composites/
+    participant_dir = os.path.dirname(composites_dir)
+    container = load_container(participant_dir)
+    match = COMPOSITE_PATTERN.match(os.path.splitext(os.path.basename(path))[0])
+    if container is not None and match:
+        rows = np.flatnonzero(container['composite_generation'] == int(match.group('generation') or -1))
+        if len(rows) == 1:
+            return container['composites'][rows[0]].astype(np.float64)
+    orientation = image_orientation(participant_dir)
+    if orientation is None:
+        raise ValueError(f"{path}: no CSV or compact.npz copy, and the image orientation of "
+                         f"{participant_dir} cannot be told")
+    return np.flipud(image) if orientation == 'flipped' else image
+
+def _preferred_files(paths):
+    """Keep one file per composite, by FORMAT_PREFERENCE"""
+    chosen = {}
+    for path in paths:
+        stem, ext = os.path.splitext(path)
+        ext = ext.lower()
+        if ext not in FORMAT_PREFERENCE:
+            continue
+        if stem not in chosen or FORMAT_PREFERENCE.index(ext) < FORMAT_PREFERENCE.index(os.path.splitext(chosen[stem])[1].lower()):
+            chosen[stem] = path
+    return sorted(chosen.values())
+
+def collect_composites(imagery_dir=IMAGERY_DIR, participant_images_dir=PARTICIPANT_IMAGES_DIR, groups=None):
+    """List (path, group, participant, generation) for every composite; generation is 'all' for mega-composites"""
+    groups = groups or {}
+    entries = []
+
+    # organised_by_imagery/<group>/P<id>_S<session>_G<generation>_composite.tiff
+    for group_dir in sorted(glob.glob(os.path.join(imagery_dir, '*'))):
+        if not os.path.isdir(group_dir):
+            continue
+        for path in _preferred_files(glob.glob(os.path.join(group_dir, '*'))):
+            match = re.match(r'P(?P<participant>[^_]+)_S\d+_G(?P<generation>\d+)', os.path.basename(path))
+            participant, generation = (match.group('participant'), match.group('generation')) if match else ('', '')
+            entries.append((path, os.path.basename(group_dir), participant, generation))
+
+    # participant_images/<participant dir>/composites/composite_p<id>_g<generation>.tiff
+    pattern = os.path.join(participant_images_dir, '*', 'composites', '*')
+    for path in _preferred_files(glob.glob(pattern)):
+        match = re.match(r'composite_p(?P<participant>.+)_(?:g(?P<generation>\d+)|all)$',
+                         os.path.splitext(os.path.basename(path))[0])
+        if not match:
+            continue
+        participant = match.group('participant')
+        entries.append((path, groups.get(participant, UNASSIGNED_GROUP), participant,
+                        match.group('generation') or 'all'))
+    return entries
+
+class SpectralBins:
+    """Radial and orientation bin masks for one image shape, applied to a batch with one matmul"""
+
+    def __init__(self, shape, n_orientations=8):
+        height, width = shape
+        fy = np.fft.fftfreq(height)[:, None] * height
+        fx = np.fft.fftfreq(width)[None, :] * width
+        radius = np.sqrt(fx ** 2 + fy ** 2)
+        angle = np.degrees(np.arctan2(fy, fx)) % 180.0
+
+        # Integer radial bins 1..Nyquist (DC excluded), orientation bins over 0-180 degrees (DC excluded)
+        self.n_radial = min(height, width) // 2
+        radial_index = np.rint(radius).astype(np.int64)
+        orientation_index = np.minimum((angle / (180.0 / n_orientations)).astype(np.int64), n_orientations - 1)
+        in_band = ((radius > 0) & (radial_index <= self.n_radial)).ravel()
+
+        self.frequencies = np.arange(1, self.n_radial + 1)
+        self.orientations = np.arange(n_orientations) * (180.0 / n_orientations)
+        n_bins = self.n_radial + n_orientations
+        masks = np.zeros((height * width, n_bins))
+        rows = np.flatnonzero(in_band)
+        masks[rows, radial_index.ravel()[rows] - 1] = 1.0
+        masks[rows, self.n_radial + orientation_index.ravel()[rows]] = 1.0
+        self.masks = masks / np.maximum(masks.sum(axis=0), 1.0)
+
+    def spectra(self, stack):
+        """(N, H, W) images -> (N, n_radial) radial and (N, n_orientations) orientation mean power"""
+        stack = np.asarray(stack, dtype=np.float64)
+        stack = stack - stack.mean(axis=(-2, -1), keepdims=True)
+        power = np.abs(np.fft.fft2(stack)) ** 2 / (stack.shape[-1] * stack.shape[-2])
+        binned = power.reshape(len(stack), -1) @ self.masks
+        return binned[:, :self.n_radial], binned[:, self.n_radial:]
+
+def load_cache(path):
+    """{content hash: (radial, orientation)} from a previous run"""
+    if not os.path.exists(path):
+        return {}
+    with np.load(path) as data:
+        return {key: (radial, orientation)
+                for key, radial, orientation in zip(data['hashes'], data['radial'], data['orientation'])}
+
+def save_cache(path, cache):
+    """Write the spectra cache atomically"""
+    if not cache:
+        return
+    keys = sorted(cache)
+    tmp_path = f"{path}.tmp.npz"
+    np.savez(tmp_path, hashes=np.array(keys),
+             radial=np.stack([cache[key][0] for key in keys]),
+             orientation=np.stack([cache[key][1] for key in keys]))
+    os.replace(tmp_path, path)
+
+def compute_spectra(paths, cache_path=None, n_orientations=8):
+    """Radial and orientation spectra for every path, transforming only files not already cached"""
+    # Keys include the orientation binning, so changing it recomputes instead of mixing lengths
+    hashes = [f"{file_hash(path)}-o{n_orientations}-v{LOADER_VERSION}" for path in paths]
+    cache = load_cache(cache_path) if cache_path else {}
+    missing = sorted({h: path for h, path in zip(hashes, paths) if h not in cache}.items())
+
+    if missing:
+        # All new composites are transformed together in one batch
+        images = [load_composite(path) for _, path in missing]
+        shapes = {image.shape for image in images}
+        if len(shapes) > 1:
+            raise ValueError(f"Composites have different sizes: {sorted(shapes)}")
+        radial, orientation = SpectralBins(images[0].shape, n_orientations).spectra(np.stack(images))
+        for row, (key, _) in enumerate(missing):
+            cache[key] = (radial[row], orientation[row])
+        if cache_path:
+            save_cache(cache_path, cache)
+        print(f"Transformed {len(missing)} new composites, {len(paths) - len(missing)} from cache")
+
+    radial = np.stack([cache[h][0] for h in hashes]) if hashes else np.zeros((0, 0))
+    orientation = np.stack([cache[h][1] for h in hashes]) if hashes else np.zeros((0, 0))
+    return radial, orientation
+
+def group_contrasts(log_power, labels):
+    """Mean log power per group, and for each pair of groups the difference and Welch t per bin"""
+    labels = np.asarray(labels)
+    names = sorted(set(labels.tolist()))
+    summaries = {}
+    for name in names:
+        values = log_power[labels == name]
+        summaries[name] = (values.mean(axis=0), values.var(axis=0, ddof=1) if len(values) > 1 else
+                           np.full(values.shape[1], np.nan), len(values))
+
+    contrasts = {}
+    for a, b in itertools.combinations(names, 2):
+        mean_a, var_a, n_a = summaries[a]
+        mean_b, var_b, n_b = summaries[b]
+        difference = mean_a - mean_b
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t = difference / np.sqrt(var_a / n_a + var_b / n_b)
+        contrasts[(a, b)] = (difference, t)
+    return {name: summary[0] for name, summary in summaries.items()}, contrasts
+
+def write_outputs(out_dir, entries, radial, orientation, bins_labels, group_means, contrasts):
+    """Per-image spectra and group contrasts as CSV"""
+    frequency_labels, orientation_labels = bins_labels
+    columns = [f"radial_{f}" for f in frequency_labels] + [f"orientation_{o:g}" for o in orientation_labels]
+
+    with open(os.path.join(out_dir, 'composite_spectra.csv'), 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['path', 'group', 'participant', 'generation'] + columns)
+        for entry, r, o in zip(entries, radial, orientation):
+            writer.writerow(list(entry) + [f"{v:.6g}" for v in np.concatenate([r, o])])
+
+    with open(os.path.join(out_dir, 'group_contrasts.csv'), 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['statistic', 'group_a', 'group_b'] + columns)
+        for name, mean in group_means.items():
+            writer.writerow(['mean_log10_power', name, ''] + [f"{v:.6g}" for v in mean])
+        for (a, b), (difference, t) in contrasts.items():
+            writer.writerow(['log10_power_difference', a, b] + [f"{v:.6g}" for v in difference])
+            writer.writerow(['welch_t', a, b] + [f"{v:.6g}" for v in t])
+
+def analyse(imagery_dir=IMAGERY_DIR, participant_images_dir=PARTICIPANT_IMAGES_DIR, out_dir=OUTPUT_DIR,
+            groups_file=GROUPS_FILE, n_orientations=8, use_cache=True):
+    """Run the full analysis and write CSVs to out_dir; returns (entries, radial, orientation, group_means, contrasts)"""
+    os.makedirs(out_dir, exist_ok=True)
+    entries = collect_composites(imagery_dir, participant_images_dir, load_groups(groups_file))
+    if not entries:
+        print("No composites found")
+        return entries, None, None, {}, {}
+
+    cache_path = os.path.join(out_dir, CACHE_FILE) if use_cache else None
+    radial, orientation = compute_spectra([entry[0] for entry in entries], cache_path, n_orientations)
+
+    # Contrasts over log power; the tiny floor keeps flat (all-equal) composites finite
+    log_power = np.log10(np.concatenate([radial, orientation], axis=1) + 1e-12)
+    group_means, contrasts = group_contrasts(log_power, [entry[1] for entry in entries])
+
+    n_radial = radial.shape[1]
+    labels = (np.arange(1, n_radial + 1), np.arange(orientation.shape[1]) * (180.0 / orientation.shape[1]))
+    write_outputs(out_dir, entries, radial, orientation, labels, group_means, contrasts)
+    print(f"Analysed {len(entries)} composites in {len(group_means)} groups; results in {out_dir}")
+    return entries, radial, orientation, group_means, contrasts
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Batched spatial-frequency analysis of composites")
+    parser.add_argument('--imagery-dir', default=IMAGERY_DIR)
+    parser.add_argument('--participant-images', default=PARTICIPANT_IMAGES_DIR)
+    parser.add_argument('--groups', default=GROUPS_FILE)
+    parser.add_argument('--orientations', type=int, default=8)
+    parser.add_argument('--out', default=OUTPUT_DIR)
+    parser.add_argument('--no-cache', action='store_true')
+    args = parser.parse_args(argv)
+    analyse(args.imagery_dir, args.participant_images, args.out, args.groups, args.orientations, not args.no_cache)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+#startup_report.py
+
+"""
+Startup-time report
+
+Imports each module in a fresh interpreter and reports how long the import
+took and which heavy dependencies (PsychoPy, scipy, pandas) it pulled in.
+The GA, stimulus-generation and data modules should not load any of them.
+
+Usage: python startup_report.py [module ...]
+"""
+
+import json
+import os
+import subprocess
+import sys
+
+CORE_MODULES = ['genetic_algorithm', 'stimuli', 'data_saving', 'convergence', 'experiment_setup']
+HEAVY_MODULES = ['psychopy', 'scipy', 'pandas']
+
+_PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+print(json.dumps({{'seconds': elapsed,
+                   'heavy': [m for m in {heavy!r} if m in sys.modules]}}))
+"""
+
+def measure_import(module):
+    """Import a module in a fresh interpreter and return its timing and heavy imports"""
+    probe = _PROBE.format(module=module, heavy=HEAVY_MODULES)
+    result = subprocess.run(
+        [sys.executable, '-c', probe],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        capture_output=True,
+        text=True
+    )
+    if result.returncode != 0:
+        error = result.stderr.strip().splitlines()[-1] if result.stderr.strip() else 'unknown error'
+        return {'module': module, 'seconds': None, 'heavy': [], 'error': error}
+    report = json.loads(result.stdout.strip().splitlines()[-1])
+    report['module'] = module
+    return report
+
+def startup_report(modules=None):
+    """Measure every module and print a startup-time table"""
+    modules = modules or CORE_MODULES
+    reports = [measure_import(module) for module in modules]
+
+    print(f"{'module':<20} {'import (ms)':>12}  heavy imports")
+    for report in reports:
+        if report['seconds'] is None:
+            print(f"{report['module']:<20} {'failed':>12}  {report['error']}")
+        else:
+            heavy = ', '.join(report['heavy']) or '-'
+            print(f"{report['module']:<20} {report['seconds'] * 1000:>12.1f}  {heavy}")
+
+    return reports
+
+if __name__ == "__main__":
+    reports = startup_report(sys.argv[1:])
+    # Non-zero exit if a core module fails to import or drags in a heavy dependency
+    sys.exit(1 if any(r['heavy'] or r.get('error') for r in reports if r['module'] in CORE_MODULES) else 0)
@@ -3,15 +3,85 @@
 
 import numpy as np
 from PIL import Image, ImageDraw, ImageFont
-from psychopy import visual
+import hashlib
+import os
+from genetic_algorithm import upsample_genome
 
-def generate_noise_pattern(stim_size=16):
-    """Generate a random noise pattern"""
-    noise = np.random.randint(0, 256, (stim_size, stim_size), dtype=np.uint8)
-    return noise
+TRAINING_FONT = r"C:/Windows/Fonts/ARIALN.TTF"
+GLYPH_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'glyph_cache')
+
+# In-memory glyph cache keyed by (char, canvas_size, font, font_size)
+_glyph_cache = {}
+
+def _glyph_cache_path(key):
+    """Path of the on-disk copy of a cached glyph"""
+    digest = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()[:16]
+    return os.path.join(GLYPH_CACHE_DIR, f"glyph_{ord(key[0])}_{key[1]}_{digest}.npy")
+
+def _draw_glyph(char, canvas_size, font_name, font_size, allow_default):
+    """Render a black character centred on a white canvas with PIL"""
+    img = Image.new('L', (canvas_size, canvas_size), color=255)
+    draw = ImageDraw.Draw(img)
+    
+    used_default = False
+    try:
+        font = ImageFont.truetype(font_name, font_size)
+    except IOError:
+        if not allow_default:
+            raise
+        font = ImageFont.load_default()
+        used_default = True
+    
+    # Draw text centered (compatible with older PIL versions)
+    centre = canvas_size / 2
+    try:
+        draw.text((centre, centre), char, fill=0, font=font, anchor="mm")
+    except TypeError:
+        text_width, text_height = font.getsize(char)
+        draw.text((centre - text_width//2, centre - text_height//2), char, fill=0, font=font)
+    
+    return np.array(img), used_default
+
+def render_glyph(char, canvas_size, font_name, font_size, allow_default=True):
+    """Return a rendered glyph as a read-only uint8 array, using the memory and disk caches"""
+    key = (char, canvas_size, font_name, font_size)
+    glyph = _glyph_cache.get(key)
+    if glyph is not None:
+        return glyph
+    
+    cache_path = _glyph_cache_path(key)
+    try:
+        glyph = np.load(cache_path)
+    except (OSError, ValueError):
+        glyph, used_default = _draw_glyph(char, canvas_size, font_name, font_size, allow_default)
+        # Only persist glyphs drawn with the requested font, so installing it later takes effect
+        if not used_default:
+            try:
+                os.makedirs(GLYPH_CACHE_DIR, exist_ok=True)
+                tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+                with open(tmp_path, 'wb') as f:
+                    np.save(f, glyph)
+                os.replace(tmp_path, cache_path)
+            except OSError as e:
+                print(f"Could not persist glyph cache entry: {e}")
+    
+    glyph.flags.writeable = False
+    _glyph_cache[key] = glyph
+    return glyph
+
+def generate_noise_pattern(stim_size=16, rng=None, resolution=None):
+    """Generate a random noise pattern (coarse resolution x resolution noise upsampled, if given)"""
+    size = resolution if resolution is not None and resolution < stim_size else stim_size
+    if rng is not None:
+        noise = rng.integers(0, 256, (size, size), dtype=np.uint8)
+    else:
+        noise = np.random.randint(0, 256, (size, size), dtype=np.uint8)
+    return upsample_genome(noise, stim_size)
 
 def create_image_from_array(win, array):
     """Convert numpy array to PsychoPy stimulus with pixelated rendering"""
+    from psychopy import visual
+    
     # Convert to PIL Image
     img = Image.fromarray(array)
     img = img.resize((192, 192), Image.NEAREST)  # Resize with nearest neighbor for pixelated look
@@ -34,44 +104,12 @@ def create_image_from_array(win, array):
 
 
 def create_target_s():
-    # Create a canvas
-    img = Image.new('L', (32, 32), color=255)
-    draw = ImageDraw.Draw(img)
-    
-    # Draw the letter 'S'
-    try:
-        font = ImageFont.truetype("arial.ttf", 24)
-    except IOError:
-        font = ImageFont.load_default()
-    
-    # Draw text centered
-    try:
-        draw.text((16, 16), "S", fill=0, font=font, anchor="mm")
-    except TypeError:
-        text_width, text_height = font.getsize("S")
-        draw.text((16 - text_width//2, 16 - text_height//2), "S", fill=0, font=font)
-    
+    """Create the target 'S' (32x32 for matching, 96x96 for display)"""
     # Convert to numpy array and flip vertically to correct orientation
-    target_array = np.array(img)
-    target_array = np.flipud(target_array)  # Flip vertically
+    target_array = np.flipud(render_glyph("S", 32, "arial.ttf", 24))
     
     # Create larger display version (also flipped)
-    display_img = Image.new('L', (96, 96), color=255)
-    display_draw = ImageDraw.Draw(display_img)
-    
-    try:
-        display_font = ImageFont.truetype("arial.ttf", 72)
-    except IOError:
-        display_font = ImageFont.load_default()
-    
-    try:
-        display_draw.text((48, 48), "S", fill=0, font=display_font, anchor="mm")
-    except TypeError:
-        text_width, text_height = display_font.getsize("S")
-        display_draw.text((48 - text_width//2, 48 - text_height//2), "S", fill=0, font=display_font)
-    
-    display_array = np.array(display_img)
-    display_array = np.flipud(display_array)  # Flip vertically
+    display_array = np.flipud(render_glyph("S", 96, "arial.ttf", 72))
     
     return target_array, display_array
 
@@ -81,30 +119,25 @@ def create_target_s_stim(win, target_display):
 
 def create_training_target_j():
     """Create the training target 'J' image"""
-    img = Image.new('L', (64, 64), color=255)
-    draw = ImageDraw.Draw(img)
-    
-    try:
-        font = ImageFont.truetype("arial.ttf", 48)
-    except IOError:
-        font = ImageFont.load_default()
-    
-    # Draw the letter 'J' (compatible with older PIL versions)
-    try:
-        draw.text((32, 32), "J", fill=0, font=font, anchor="mm")
-    except TypeError:
-        text_width, text_height = font.getsize("J")
-        draw.text((32 - text_width//2, 32 - text_height//2), "J", fill=0, font=font)
-    
     # Flip vertically to correct orientation
-    return np.flipud(np.array(img))
+    return np.flipud(render_glyph("J", 64, "arial.ttf", 48))
 
 
 def create_training_target_j_stim(win):
     """Create PsychoPy stimulus from training target image"""
     return create_image_from_array(win, create_training_target_j())
 
-from scipy import ndimage
+def training_visibility(trial_numbers):
+    """Visibility of the training 'J' for 1-based trial number(s), fading from 1.0 to 0.65"""
+    max_visibility = 1.0  # Maximum visibility (darkest J)
+    min_visibility = 0.65  # Minimum visibility (faintest J)
+    step = (max_visibility - min_visibility) / 11
+    return np.maximum(min_visibility, max_visibility - (np.asarray(trial_numbers) - 1) * step)
+
+def training_mask(stim_size=16):
+    """Binary mask where 'J' pixels are <255 (rendered once, then cached)"""
+    font_size = int(stim_size * 1)  # Font size ratio fixed at 0.8
+    return render_glyph("J", stim_size, TRAINING_FONT, font_size, allow_default=False) < 255
 
 def create_training_stimulus(has_target, trial_number, stim_size=16):
     """Create a training stimulus using pixel-wise subtraction for visibility control."""
@@ -112,30 +145,10 @@ def create_training_stimulus(has_target, trial_number, stim_size=16):
     noise = generate_noise_pattern(stim_size)
 
     if has_target:
-        # Create the 'J' canvas as a binary mask
-        img = Image.new('L', (stim_size, stim_size), color=255)
-        draw = ImageDraw.Draw(img)
-
-        
-        font_size = int(stim_size * 1)  # Font size ratio fixed at 0.8
-        font = ImageFont.truetype(r"C:/Windows/Fonts/ARIALN.TTF", font_size)
-
-        # Draw the letter 'J' centered in the canvas
-        try:
-            draw.text((stim_size / 2, stim_size / 2), "J", fill=0, font=font, anchor="mm")
-        except TypeError:
-            text_width, text_height = font.getsize("J")
-            x = stim_size / 2 - text_width // 2
-            y = stim_size / 2 - text_height // 2
-            draw.text((x, y), "J", fill=0, font=font)
-
-        # Convert the image to a numpy array (binary mask where 'J' pixels are <255)
-        j_canvas = np.array(img) < 255
+        j_canvas = training_mask(stim_size)
 
         # Calculate visibility scaling factor for this trial
-        max_visibility = 1.0  # Maximum visibility (darkest J)
-        min_visibility = 0.65  # Minimum visibility (faintest J)
-        visibility = max(min_visibility, max_visibility - (trial_number - 1) * ((max_visibility - min_visibility) / 11))
+        visibility = float(training_visibility(trial_number))
 
         # Perform pixel-wise operation: noise + scaled 'J'
         stimulus = noise.copy()
@@ -143,4 +156,24 @@ def create_training_stimulus(has_target, trial_number, stim_size=16):
 
         return np.flipud(np.array(stimulus))
 
-    return noise
\ No newline at end of file
+    return noise
+
+def generate_training_set(n_trials=12, n_stimuli=12, stim_size=16):
+    """Pregenerate the whole training phase in one vectorized call
+
+    Returns a (n_trials, n_stimuli, stim_size, stim_size) uint8 tensor, the
+    index of the 'J' stimulus in each trial and the per-trial visibility.
+    Each target stimulus matches create_training_stimulus(True, trial_number).
+    """
+    stimuli = np.random.randint(0, 256, (n_trials, n_stimuli, stim_size, stim_size), dtype=np.uint8)
+    target_indices = np.random.randint(0, n_stimuli, n_trials)
+    visibilities = training_visibility(np.arange(1, n_trials + 1))
+
+    # create_training_stimulus flips after masking, so mask the flipped canvas instead
+    mask = np.flipud(training_mask(stim_size))
+    trial_index = np.arange(n_trials)
+    targets = stimuli[trial_index, target_indices]
+    darkened = np.clip(targets * (1 - visibilities)[:, None, None], 0, 255).astype(np.uint8)
+    stimuli[trial_index, target_indices] = np.where(mask, darkened, targets)
+
+    return stimuli, target_indices, visibilities
@@ -0,0 +1,139 @@
+#tracing.py
+
+"""
+Low-overhead tracing of where the time between trials goes
+
+Spans are recorded into an in-memory ring buffer and written out when flush()
+is called (at generation boundaries) to:
+  - trace.json   Chrome trace event format, open with chrome://tracing or Perfetto
+  - events.jsonl one JSON object per span/event, for scripted analysis
+
+When tracing is disabled span() returns a shared no-op context manager, so
+instrumented code costs one attribute check per span.
+"""
+
+import json
+import os
+import threading
+import time
+from collections import deque
+
+class _NullSpan:
+    """Context manager used when tracing is disabled"""
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NULL_SPAN = _NullSpan()
+
+class _Span:
+    """A named, timed region recorded into the tracer's ring buffer on exit"""
+    __slots__ = ('tracer', 'name', 'args', 'start')
+
+    def __init__(self, tracer, name, args):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc):
+        end = time.perf_counter_ns()
+        self.tracer._record('X', self.name, self.start, end - self.start, self.args)
+        return False
+
+class Tracer:
+    """Collect spans in a bounded ring buffer and flush them to disk on demand"""
+
+    def __init__(self, capacity=65536):
+        self.enabled = False
+        self.output_dir = None
+        self.buffer = deque(maxlen=capacity)
+        self.dropped = 0
+        self.pid = os.getpid()
+        self._origin = time.perf_counter_ns()
+        self._lock = threading.Lock()
+
+    def configure(self, output_dir, enabled=True):
+        """Enable tracing and set the directory trace.json / events.jsonl go to"""
+        self.output_dir = output_dir
+        self.enabled = enabled
+        if enabled:
+            os.makedirs(output_dir, exist_ok=True)
+
+    def span(self, name, **args):
+        """Time a block: `with tracer.span('filter_selection', generation=g): ...`"""
+        if not self.enabled:
+            return _NULL_SPAN
+        return _Span(self, name, args)
+
+    def instant(self, name, **args):
+        """Record a point-in-time event"""
+        if self.enabled:
+            self._record('i', name, time.perf_counter_ns(), 0, args)
+
+    def _record(self, phase, name, start, duration, args):
+        """Append one event to the ring buffer, counting events that fall off the end"""
+        if len(self.buffer) == self.buffer.maxlen:
+            self.dropped += 1
+        self.buffer.append((phase, name, start, duration, threading.get_ident(), args))
+
+    def flush(self):
+        """Write buffered events to trace.json and events.jsonl and empty the buffer"""
+        if not self.enabled or self.output_dir is None:
+            return 0
+
+        with self._lock:
+            events = list(self.buffer)
+            self.buffer.clear()
+            dropped, self.dropped = self.dropped, 0
+
+        if dropped:
+            print(f"Tracing ring buffer overflowed, {dropped} events dropped")
+        if not events:
+            return 0
+
+        trace_path = os.path.join(self.output_dir, 'trace.json')
+        jsonl_path = os.path.join(self.output_dir, 'events.jsonl')
+        new_trace = not os.path.exists(trace_path)
+
+        chrome_lines = []
+        jsonl_lines = []
+        for phase, name, start, duration, tid, args in events:
+            ts_us = (start - self._origin) / 1000.0
+            chrome_event = {'name': name, 'ph': phase, 'ts': ts_us, 'pid': self.pid, 'tid': tid}
+            if phase == 'X':
+                chrome_event['dur'] = duration / 1000.0
+            else:
+                chrome_event['s'] = 't'
+            if args:
+                chrome_event['args'] = args
+            chrome_lines.append(json.dumps(chrome_event, default=str))
+            jsonl_lines.append(json.dumps({
+                'name': name,
+                'type': 'span' if phase == 'X' else 'event',
+                'start_ms': ts_us / 1000.0,
+                'duration_ms': duration / 1e6,
+                'thread': tid,
+                **args
+            }, default=str))
+
+        # The Chrome trace array format allows a missing closing bracket, so
+        # each flush can simply append events to the open array
+        with open(trace_path, 'a') as f:
+            if new_trace:
+                f.write('[\n')
+            f.write(',\n'.join(chrome_lines) + ',\n')
+        with open(jsonl_path, 'a') as f:
+            f.write('\n'.join(jsonl_lines) + '\n')
+
+        return len(events)
+
+# Process-wide tracer used by the experiment modules
+tracer = Tracer()
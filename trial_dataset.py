@@ -0,0 +1,229 @@
+#trial_dataset.py
+
+"""
+Columnar cross-participant trial dataset
+
+export_dataset() reads every ExperimentHandler CSV in data/ once and writes
+all main-task, training, rating and generation-summary rows into a Parquet
+dataset partitioned by row kind and participant:
+
+    trial_dataset/kind=main/participant=<id>/...parquet
+    trial_dataset/kind=training/participant=<id>/...parquet
+    trial_dataset/kind=rating/participant=<id>/...parquet
+
+The 12 stimuli shown on a trial are loaded from the participant's
+stimuli_csv folder and stored as one fixed-width binary column
+(12 * stim_size * stim_size bytes, row-major uint8), so the pixels travel
+with the rows. read_dataset() only reads the columns and partitions asked for.
+
+Needs pandas and pyarrow (imported only when used).
+
+Usage: python trial_dataset.py [--data-dir data] [--images-dir participant_images] [--out trial_dataset]
+"""
+
+import argparse
+import ast
+import glob
+import ntpath
+import os
+
+import numpy as np
+
+from compact_images import load_container, stimuli_lookup
+
+DATASET_DIR = 'trial_dataset'
+STIMULI_PER_TRIAL = 12
+
+# Columns (and their types) kept per row kind; anything else in the CSVs is dropped
+KIND_COLUMNS = {
+    'main': {'session': 'Int64', 'generation': 'Int64', 'trial': 'Int64', 'selected_id': 'Int64',
+             'selected_ids': 'string', 'selection_weights': 'string',
+             'rt': 'float64', 'mode': 'string', 'genome_resolution': 'Int64', 'stimuli_grid': 'string'},
+    'training': {'trial_number': 'Int64', 'target_index': 'Int64', 'visibility': 'float64',
+                 'selected_id': 'Int64', 'correct': 'boolean', 'rt': 'float64', 'stimuli_grid': 'string'},
+    'rating': {'participant_class': 'string', 'participant_id': 'string', 'generation': 'string',
+               'image_session': 'string', 'image_path': 'string', 'rating': 'float64'},
+    'generation_summary': {'generation': 'Int64', 'selected_target_similarity': 'float64',
+                           'mean_pairwise_distance': 'float64', 'pixel_entropy': 'float64',
+                           'mutation_rate': 'float64', 'mutation_sigma': 'float64'}
+}
+
+def _row_kind(frame):
+    """Classify each ExperimentHandler row as main / training / rating / generation_summary"""
+    kind = np.full(len(frame), None, dtype=object)
+    trial_type = frame.get('trial_type')
+    task = frame.get('task')
+    if trial_type is not None:
+        kind[(trial_type == 'training').to_numpy()] = 'training'
+        kind[(trial_type == 'generation_summary').to_numpy()] = 'generation_summary'
+    if task is not None:
+        kind[(task == 'rating').to_numpy()] = 'rating'
+    if 'trial' in frame and 'generation' in frame:
+        is_main = frame['trial'].notna().to_numpy() & (kind == None)  # noqa: E711
+        kind[is_main] = 'main'
+    return kind
+
+def _participant_image_dir(images_dir, participant, data_file, frame):
+    """Find the participant_images folder that belongs to a data file"""
+    # Paths recorded in the rows name the folder directly (they may be Windows paths)
+    for column in ('stimuli_grid', 'stimuli_csv'):
+        if column in frame:
+            for value in frame[column].dropna():
+                parts = ntpath.normpath(str(value).strip("[]'\" ")).replace('/', '\\').split('\\')
+                for part in parts:
+                    if part.startswith(f'participant_{participant}_'):
+                        candidate = os.path.join(images_dir, part)
+                        if os.path.isdir(candidate):
+                            return candidate
+    # Otherwise use the folder whose timestamp is closest to the data file's
+    stem = os.path.splitext(os.path.basename(data_file))[0]
+    candidates = sorted(glob.glob(os.path.join(images_dir, f'participant_{participant}_*')))
+    if not candidates:
+        return None
+    return min(candidates, key=lambda path: abs(_timestamp_number(path) - _timestamp_number(stem)))
+
+def _timestamp_number(name):
+    """participant_<id>_<YYYYmmdd>_<HHMMSS> -> YYYYmmddHHMMSS as an int (0 if missing)"""
+    digits = ''.join(os.path.basename(name).split('_')[-2:])
+    return int(digits) if digits.isdigit() else 0
+
+def _read_stimulus_csv(path):
+    """Load one stimulus CSV as a uint8 array"""
+    return np.loadtxt(path, delimiter=',', dtype=np.uint8, ndmin=2)
+
+def _trial_stimuli_paths(stimuli_dir, participant, phase, trial, cell):
+    """The 12 stimulus CSVs of a trial, by naming convention or from the stimuli_csv cell"""
+    paths = [os.path.join(stimuli_dir, f"{participant}_{phase}_T{trial}_stim{i}.csv")
+             for i in range(STIMULI_PER_TRIAL)]
+    if all(os.path.exists(path) for path in paths):
+        return paths
+    if isinstance(cell, str) and cell.startswith('['):
+        names = [ntpath.basename(p) for p in ast.literal_eval(cell)]
+        paths = [os.path.join(stimuli_dir, name) for name in names]
+        if len(paths) == STIMULI_PER_TRIAL and all(os.path.exists(path) for path in paths):
+            return paths
+    return None
+
+def _stimuli_column(frame, kind, participant, participant_dir):
+    """Fixed-width pixel bytes (or None) for every row of one kind"""
+    stimuli_dir = os.path.join(participant_dir, 'stimuli_csv') if participant_dir else None
+    # Folders compacted by compact_images.py keep the stimuli in one container instead
+    container = load_container(participant_dir) if participant_dir else None
+    compacted = stimuli_lookup(container) if container is not None else {}
+    cells = frame['stimuli_csv'] if 'stimuli_csv' in frame else [None] * len(frame)
+    values = []
+    for (_, row), cell in zip(frame.iterrows(), cells):
+        paths = stimuli = None
+        has_csv = stimuli_dir and os.path.isdir(stimuli_dir)
+        if has_csv or compacted:
+            if kind == 'main':
+                phase, trial = f"G{int(row['generation'])}", int(row['trial'])
+            else:
+                phase, trial = 'training', int(row['trial_number'])
+            if has_csv:
+                paths = _trial_stimuli_paths(stimuli_dir, participant, phase, trial, cell)
+            stimuli = compacted.get((phase, trial))
+        if paths is not None:
+            values.append(np.stack([_read_stimulus_csv(path) for path in paths]).tobytes())
+        elif stimuli is not None and len(stimuli) == STIMULI_PER_TRIAL:
+            values.append(stimuli.tobytes())
+        else:
+            values.append(None)
+    return values
+
+def load_participant_rows(data_file, images_dir='participant_images'):
+    """Read one ExperimentHandler CSV and return {kind: DataFrame} with pixel columns attached"""
+    import pandas as pd
+
+    frame = pd.read_csv(data_file, encoding='utf-8-sig', low_memory=False)
+    frame = frame.loc[:, ~frame.columns.str.startswith('Unnamed')]
+    if 'participant' in frame and frame['participant'].notna().any():
+        participant = str(frame['participant'].dropna().iloc[0])
+    else:
+        participant = os.path.basename(data_file).split('_')[1]
+    participant_dir = _participant_image_dir(images_dir, participant, data_file, frame)
+    kinds = _row_kind(frame)
+
+    tables = {}
+    for kind, columns in KIND_COLUMNS.items():
+        rows = frame[kinds == kind]
+        if rows.empty:
+            continue
+        table = pd.DataFrame(index=range(len(rows)))
+        for column, dtype in columns.items():
+            values = rows[column].reset_index(drop=True) if column in rows else pd.Series([None] * len(rows))
+            if dtype in ('Int64', 'float64'):
+                values = pd.to_numeric(values, errors='coerce')
+            elif dtype == 'boolean':
+                values = values.map({True: True, False: False, 'True': True, 'False': False})
+            table[column] = values.astype(dtype)
+        if kind in ('main', 'training'):
+            table['stimuli'] = _stimuli_column(rows, kind, participant, participant_dir)
+        table['source_file'] = os.path.basename(data_file)
+        tables[kind] = table
+    return participant, tables
+
+def export_dataset(data_dir='data', images_dir='participant_images', out_dir=DATASET_DIR, stim_size=16):
+    """Consolidate every participant CSV into a partitioned Parquet dataset"""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    data_files = sorted(glob.glob(os.path.join(data_dir, 'participant_*.csv')))
+    pixel_type = pa.binary(STIMULI_PER_TRIAL * stim_size * stim_size)
+    written = 0
+
+    for data_file in data_files:
+        participant, tables = load_participant_rows(data_file, images_dir)
+        for kind, table in tables.items():
+            table['participant'] = participant
+            arrow_table = pa.Table.from_pandas(table, preserve_index=False)
+            if 'stimuli' in table:
+                index = arrow_table.schema.get_field_index('stimuli')
+                arrow_table = arrow_table.set_column(
+                    index, pa.field('stimuli', pixel_type),
+                    pa.array(table['stimuli'].tolist(), type=pixel_type))
+            # One file per source CSV, so re-exporting a participant overwrites instead of duplicating
+            arrow_table = arrow_table.append_column('kind', pa.array([kind] * len(table)))
+            pq.write_to_dataset(
+                arrow_table, out_dir, partition_cols=['kind', 'participant'],
+                basename_template=os.path.splitext(os.path.basename(data_file))[0] + '-{i}.parquet',
+                existing_data_behavior='overwrite_or_ignore')
+            written += len(table)
+        print(f"Exported {data_file}")
+
+    print(f"Wrote {written} rows from {len(data_files)} files to {out_dir}")
+    return written
+
+def read_dataset(kind, path=DATASET_DIR, columns=None, participants=None):
+    """Read selected columns of one row kind (optionally only some participants) into a DataFrame"""
+    import pandas as pd
+
+    # Each kind has its own schema, so read its partition directory directly
+    filters = [('participant', 'in', list(participants))] if participants is not None else None
+    return pd.read_parquet(os.path.join(path, f'kind={kind}'), columns=columns, filters=filters)
+
+def decode_stimuli(column, stim_size=16):
+    """Turn a stimuli column into a (rows, 12, stim_size, stim_size) uint8 array, one per row
+
+    Raises ValueError on missing rows rather than dropping them, so the result
+    stays aligned with the other columns; filter with notna() first.
+    """
+    values = list(column)
+    missing = [i for i, value in enumerate(values) if not isinstance(value, (bytes, bytearray, memoryview))]
+    if missing:
+        raise ValueError(f"{len(missing)} rows have no stimuli (first at position {missing[0]}); filter them first")
+    if not values:
+        return np.zeros((0, STIMULI_PER_TRIAL, stim_size, stim_size), dtype=np.uint8)
+    return np.frombuffer(b''.join(values), dtype=np.uint8).reshape(-1, STIMULI_PER_TRIAL, stim_size, stim_size)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Export all trial rows to a partitioned Parquet dataset")
+    parser.add_argument('--data-dir', default='data')
+    parser.add_argument('--images-dir', default='participant_images')
+    parser.add_argument('--out', default=DATASET_DIR)
+    parser.add_argument('--stim-size', type=int, default=16)
+    args = parser.parse_args(argv)
+    export_dataset(args.data_dir, args.images_dir, args.out, args.stim_size)
+
+if __name__ == "__main__":
+    main()
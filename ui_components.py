@@ -1,11 +1,13 @@
 #ui_components.py
 
 from psychopy import visual, event, core
-from stimuli import generate_noise_pattern, create_image_from_array, create_training_stimulus, create_training_target_j_stim, create_training_target_j
+from stimuli import generate_noise_pattern, create_image_from_array, create_training_stimulus, create_training_target_j_stim, create_training_target_j, generate_training_set
 from data_saving import ParticipantDataManager
 import random
 from datetime import datetime
 from experiment_setup import params
+from tracing import tracer
+from layout_utils import layouts, grid_positions
 
 def create_text_screen(win, text, pos=(0, 0), height=0.05, color='black'):
     """Create a text stimulus"""
@@ -35,19 +37,21 @@ def show_message(win, message, button_text="Continue", height=0.05, debug_mode=F
     )
     button_label = create_text_screen(win, button_text, pos=(0, -0.4), height=0.05, color='white')
     
+    # Create a dictionary of all UI elements
+    ui_elements = {
+        "text_stim": text_stim,
+        "button": button,
+        "button_label": button_label
+    }
+    
     # If in debug mode, allow adjusting the UI elements
     if debug_mode:
         from debug_utils import debug_ui_section
         
-        # Create a dictionary of all UI elements
-        ui_elements = {
-            "text_stim": text_stim,
-            "button": button,
-            "button_label": button_label
-        }
-        
         # Debug the UI elements
         debug_ui_section(win, ui_elements, "message_screen")
+    else:
+        apply_saved_layout("message_screen", ui_elements)
     
     mouse = event.Mouse(visible=True, win=win)
     
@@ -66,29 +70,14 @@ def show_message(win, message, button_text="Continue", height=0.05, debug_mode=F
             core.quit()
 
 def create_stimuli_grid(stimuli, rows=3, cols=4):
-    """Create a grid of stimuli and return their positions"""
-    positions = []
-    
-    # Calculate grid dimensions based on window height
-    grid_width = 0.8  # 80% of window width
-    grid_height = 0.6  # 60% of window height
-    
-    # Calculate spacing between stimuli
-    x_spacing = grid_width / cols
-    y_spacing = grid_height / rows
-    
-    # Calculate starting position (top-left of grid)
-    start_x = -grid_width / 2 + x_spacing / 2
-    start_y = 0.15  # Position grid below the target
-    
-    # Position each stimulus
-    for row in range(rows):
-        for col in range(cols):
-            x = start_x + col * x_spacing
-            y = start_y - row * y_spacing
-            positions.append((x, y))
-    
-    return positions
+    """Return the grid positions for the stimuli (precomputed once per grid shape)"""
+    # Grid spans 80% of the window width and 60% of its height, top row below the target
+    return grid_positions(rows, cols)
+
+def apply_saved_layout(section_name, ui_elements):
+    """Apply a section's saved layout outside debug mode, if layouts are enabled"""
+    if params.get("apply_layouts", True):
+        layouts.apply(section_name, ui_elements)
 
 def run_introduction(win, training_target_stim, debug_mode=False):
     """Show introduction screens"""
@@ -135,20 +124,22 @@ def run_introduction(win, training_target_stim, debug_mode=False):
     # Set target position
     training_target_stim.pos = (0, 0.10)
     
+    # Create a dictionary of all UI elements
+    ui_elements = {
+        "training_instructions": training_instructions,
+        "training_target_stim": training_target_stim,
+        "button": button,
+        "button_label": button_label
+    }
+    
     # If in debug mode, allow adjusting the UI elements
     if debug_mode:
         from debug_utils import debug_ui_section
         
-        # Create a dictionary of all UI elements
-        ui_elements = {
-            "training_instructions": training_instructions,
-            "training_target_stim": training_target_stim,
-            "button": button,
-            "button_label": button_label
-        }
-        
         # Debug the UI elements
         debug_ui_section(win, ui_elements, "introduction")
+    else:
+        apply_saved_layout("introduction", ui_elements)
     
     # Draw elements
     training_target_stim.draw()
@@ -171,60 +162,63 @@ def run_training_trials(win, exp_handler, data_manager, debug_mode=False):
     """Run the training trials"""
     training_target_stim = create_image_from_array(win, create_training_target_j())
 
-    print("crash after training_target_stim")
-    for trial_number in range(1, 13):
-        # Create stimuli for this trial 
-        stimuli = []
-        stimuli_arrays = []
-        target_index = random.randint(0, 11)
+    # Pregenerate every trial's stimuli and upload all textures before the phase starts
+    n_trials = 12
+    with tracer.span('training_stimulus_generation'):
+        training_set, target_indices, visibilities = generate_training_set(n_trials, 12, params['stim_size'])
+    positions = create_stimuli_grid(range(12), rows=3, cols=4)
+    trial_stimuli = []
+    with tracer.span('training_imagestim_construction'):
+        for trial_arrays in training_set:
+            stimuli = [create_image_from_array(win, stim_array) for stim_array in trial_arrays]
+            for i, stim in enumerate(stimuli):
+                stim.pos = positions[i]
+                stim.setSize((0.14, 0.14))  # Consistent size
+            trial_stimuli.append(stimuli)
 
-        for i in range(12):
-            if i == target_index:
-                stim_array = create_training_stimulus(True, trial_number)
-            else:
-                stim_array = generate_noise_pattern()
-            stimuli_arrays.append(stim_array)
-            
-            stim = create_image_from_array(win, stim_array)
-            stimuli.append(stim)
+    # Create UI elements
+    target_label = create_text_screen(win, "Target Letter", pos=(0, 0.8), height=0.05)
+    training_target_stim.pos = (0, 0.35)
 
-        csv_filepaths = data_manager.save_stimuli_as_csv(stimuli_arrays, "training", trial_number)
+    for trial_number in range(1, n_trials + 1):
+        # Look up the pregenerated stimuli for this trial
+        stimuli = trial_stimuli[trial_number - 1]
+        stimuli_arrays = list(training_set[trial_number - 1])
+        target_index = int(target_indices[trial_number - 1])
 
-        # Create UI elements
-        target_label = create_text_screen(win, "Target Letter", pos=(0, 0.8), height=0.05)
-        training_target_stim.pos = (0, 0.35)
+        with tracer.span('stimuli_csv_write', phase='training', trial=trial_number):
+            csv_filepaths = data_manager.save_stimuli_as_csv(stimuli_arrays, "training", trial_number)
+        
+        # Create a dictionary of all UI elements
+        ui_elements = {
+            "target_label": target_label,
+            "training_target_stim": training_target_stim
+        }
         
-        # Position stimuli in a grid
-        positions = create_stimuli_grid(stimuli, rows=3, cols=4)
+        # Add stimuli to the UI elements dictionary
         for i, stim in enumerate(stimuli):
-            stim.pos = positions[i]
-            stim.setSize((0.14, 0.14))  # Consistent size
+            ui_elements[f"stimulus_{i}"] = stim
         
-        # If in debug mode and this is the first trial, allow adjusting the UI elements
+        # If in debug mode and this is the first trial, allow adjusting the UI elements;
+        # later trials pick up the adjusted layout from the registry
         if debug_mode and trial_number == 1:
             from debug_utils import debug_ui_section
             
-            # Create a dictionary of all UI elements
-            ui_elements = {
-                "target_label": target_label,
-                "training_target_stim": training_target_stim
-            }
-            
-            # Add stimuli to the UI elements dictionary
-            for i, stim in enumerate(stimuli):
-                ui_elements[f"stimulus_{i}"] = stim
-            
             # Debug the UI elements
             debug_ui_section(win, ui_elements, "training_trial")
+        elif debug_mode or params.get("apply_layouts", True):
+            layouts.apply("training_trial", ui_elements)
         
         # Draw elements
         training_target_stim.draw()
         for i, stim in enumerate(stimuli):
             stim.draw()
-        win.flip()
+        with tracer.span('first_flip', phase='training', trial=trial_number):
+            win.flip()
 
         # Save the stimuli grid
-        grid_filepath = data_manager.save_stimuli_grid(win, "training", trial_number)
+        with tracer.span('grid_capture', phase='training', trial=trial_number):
+            grid_filepath = data_manager.save_stimuli_grid(win, "training", trial_number)
         
         # Wait for mouse click on a stimulus
         mouse = event.Mouse(visible=True, win=win)
@@ -269,6 +263,7 @@ def run_training_trials(win, exp_handler, data_manager, debug_mode=False):
                         exp_handler.addData('trial_type', 'training')
                         exp_handler.addData('trial_number', trial_number)
                         exp_handler.addData('target_index', target_index)
+                        exp_handler.addData('visibility', float(visibilities[trial_number - 1]))
                         exp_handler.addData('selected_id', selected_id)
                         exp_handler.addData('correct', is_correct)
                         exp_handler.addData('rt', reaction_time)
@@ -288,6 +283,8 @@ def run_training_trials(win, exp_handler, data_manager, debug_mode=False):
         while any(mouse.getPressed()):
             core.wait(0.01)
     
+    tracer.flush()
+    
     # Show training completion message
     training_complete_text = """
     Training Complete!